@@ -1,24 +1,71 @@
 """
 CARLA Traffic Simulation Dashboard Server
 Real-time web-based control and monitoring system
+
+Server modes (DASHBOARD_ASYNC_MODE or --eventlet / --gevent):
+    threading  one OS thread per connection (default)
+    eventlet   green threads; blocking file I/O is handed to a thread pool
+    gevent     same with gevent
 """
 
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for
-from flask_socketio import SocketIO, emit
+import os
+import sys
+
+ASYNC_MODE = os.environ.get('DASHBOARD_ASYNC_MODE', 'threading').lower()
+if '--eventlet' in sys.argv:
+    ASYNC_MODE = 'eventlet'
+elif '--gevent' in sys.argv:
+    ASYNC_MODE = 'gevent'
+
+# Green modes must patch the standard library before anything else imports it
+if ASYNC_MODE == 'eventlet':
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        print("Warning: eventlet not installed, falling back to threading mode")
+        ASYNC_MODE = 'threading'
+elif ASYNC_MODE == 'gevent':
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        print("Warning: gevent not installed, falling back to threading mode")
+        ASYNC_MODE = 'threading'
+else:
+    ASYNC_MODE = 'threading'
+
+from flask import Flask, Response, render_template, jsonify, request, session, redirect, url_for
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
 import threading
 import time
 import json
-import sys
-import os
 import random
 import math
 import io
+import copy
+import collections
+import gzip
+import hashlib
+import socket
+import subprocess
+import uuid
+from datetime import datetime
+
+from sim_channel import StateSubscriber, FrameSubscriber, CommandJournal, VEHICLE_FRAME_DTYPE, channel_names
+from results_store import ResultsStore
 
 # Fix Unicode encoding for Windows console
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 # Try to import CARLA (optional for testing)
 try:
     sys.path.append('C:/Users/moham/Documents/CARLA/WindowsNoEditor/PythonAPI/carla/dist/carla-0.9.15-py3.7-win-amd64.egg')
@@ -28,6 +75,39 @@ except:
     CARLA_AVAILABLE = False
     print("Warning: CARLA not available. Dashboard will run in demo mode.")
 
+STATE_POLL_INTERVAL = 0.005  # seconds between shared-memory state polls
+ACK_POLL_INTERVAL = 0.1      # seconds between command acknowledgement file reads
+STATE_EMIT_INTERVAL = 0.5    # default seconds between state deltas per client
+STATE_MIN_EMIT_INTERVAL = 0.05
+STATE_MAX_EMIT_INTERVAL = 10.0
+BROADCAST_QUEUE_SIZE = 256       # pending emits before the oldest are dropped
+BROADCAST_IDLE_WAIT = 0.05       # seconds the broadcaster sleeps without new work
+BROADCAST_ROOM_INTERVALS = {     # minimum seconds between coalesced emits per room
+    'admin': 0.0,
+    'observer': 0.0,
+    'metrics': 1.0,
+}
+DASHBOARD_ROOMS = ['admin', 'observer']
+METRICS_CHECK_INTERVAL = 2.0     # seconds between results store checks for 'metrics_update'
+SESSION_MAX_WORKERS = 4          # simulators the session manager runs at once
+SESSION_PORT_STRIDE = 10         # worker slot i uses CARLA_PORT + i * stride and TM_PORT + i * stride
+                                 # (slots start at 1; slot 0 is the /api/start simulator's CARLA_PORT/TM_PORT)
+SESSION_BACKENDS = ('headless', 'carla')
+SESSION_PYTHON = sys.executable  # interpreter for managed test_carla.py workers
+VEHICLE_NAMESPACE = '/vehicles'  # optional per-vehicle binary frame stream
+VEHICLE_FRAME_FPS = 10           # default frames per second per client
+VEHICLE_FRAME_MAX_FPS = 20
+VEHICLE_FRAMES_IN_FLIGHT = 2     # unacknowledged frames before a client is skipped
+VEHICLE_ACK_TIMEOUT = 2.0        # seconds before unacknowledged frames are written off
+HISTORY_PAGE_SIZE = 100      # runs returned by /api/metrics/history by default
+HISTORY_MAX_PAGE_SIZE = 1000
+COMPRESS_MIN_BYTES = 1024    # responses smaller than this are sent uncompressed
+CARLA_HOST = 'localhost'
+CARLA_PORT = 2000
+TM_PORT = 8000
+CARLA_PROBE_TIMEOUT = 2.0    # seconds per health probe
+CARLA_HEALTH_INTERVAL = 5.0  # seconds between background health probes
+
 # Authentication credentials
 USERS = {
     'admin': 'admin123',
@@ -38,7 +118,22 @@ USERS = {
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'carla-traffic-sim-secret-key-2025'
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Run blocking file I/O without stalling the server.
+    
+    In the green modes the call goes to the native thread pool so other
+    connections keep being served; in threading mode it runs inline.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    if ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
 
 # Global simulation state
 simulation_state = {
@@ -86,6 +181,320 @@ camera_positions = []
 current_camera_index = 0
 fpv_vehicle = None
 
+# Command queue to test_carla.py (append-only journal, acknowledged per command)
+default_channels = channel_names(None, os.path.dirname(os.path.abspath(__file__)))
+command_journal = CommandJournal(default_channels['command_file'], default_channels['ack_file'])
+command_acks = {}  # seq -> latest acknowledgement from the simulator
+MAX_TRACKED_ACKS = 1000
+
+# Simulation results written by test_carla.py (append-only, indexed)
+results_store = ResultsStore('simulation_results')
+
+class Broadcaster:
+    """
+    Decouples producers from client delivery.
+    
+    publish() only queues and never blocks; a background task does the
+    emitting. The queue is bounded (oldest entries are dropped when full)
+    and coalescing: a newer update of the same event for the same target
+    replaces the queued one in place (latest wins), and coalesced updates to
+    a room are held back until BROADCAST_ROOM_INTERVALS allows it.
+    Per-room counters track emits, the emit rate, coalesced updates,
+    drops and emit errors.
+    """
+    def __init__(self, maxsize=BROADCAST_QUEUE_SIZE, room_intervals=BROADCAST_ROOM_INTERVALS):
+        self.maxsize = maxsize
+        self.room_intervals = room_intervals
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = collections.OrderedDict()  # key -> entry, oldest first
+        self.next_id = 0
+        self.rooms = {}  # label -> counters
+        self.task = None
+    
+    def _room(self, label):
+        if label not in self.rooms:
+            self.rooms[label] = {'emitted': 0, 'coalesced': 0, 'dropped': 0, 'errors': 0, 'rate': 0.0,
+                                 'last_emit': 0.0, 'window_start': time.time(), 'window_count': 0}
+        return self.rooms[label]
+    
+    def publish(self, event, data, to=DASHBOARD_ROOMS, namespace='/', coalesce=True, label=None, on_discard=None):
+        """
+        Queue an emit.
+        
+        Args:
+            event (str): SocketIO event name
+            data: Payload
+            to (str or list): Room name(s) or client sids
+            namespace (str): SocketIO namespace
+            coalesce (bool): Latest wins against a queued emit of the same event and target
+            label (str): Room name for the counters when `to` is a list of sids
+            on_discard (callable): Called with the sids that will not get this
+                payload (coalesced or dropped), so per-client bookkeeping can be undone
+        """
+        labels = [label] if label else ([to] if isinstance(to, str) else list(to))
+        entry = {'event': event, 'data': data, 'to': to, 'namespace': namespace,
+                 'labels': labels, 'coalesce': coalesce, 'on_discard': on_discard}
+        with self.lock:
+            if coalesce:
+                key = (namespace, event, label or (to if isinstance(to, str) else tuple(to)))
+                queued = self.pending.get(key)
+                if queued is not None:
+                    if isinstance(queued['to'], list) and isinstance(to, list):
+                        # Merge recipients; those in both only get one payload
+                        overlap = [sid for sid in queued['to'] if sid in to]
+                        entry['to'] = list(dict.fromkeys(queued['to'] + to))
+                        if overlap and queued['on_discard'] is not None:
+                            queued['on_discard'](overlap)
+                    for name in labels:
+                        self._room(name)['coalesced'] += 1
+                    self.pending[key] = entry  # Keeps the queued position
+                    self.wakeup.set()
+                    return
+            else:
+                key = ('unique', self.next_id)
+                self.next_id += 1
+            
+            if len(self.pending) >= self.maxsize:
+                _, dropped = self.pending.popitem(last=False)
+                for name in dropped['labels']:
+                    self._room(name)['dropped'] += 1
+                if dropped['on_discard'] is not None and isinstance(dropped['to'], list):
+                    dropped['on_discard'](dropped['to'])
+            self.pending[key] = entry
+        self.ensure_started()
+        self.wakeup.set()
+    
+    def _take(self, now):
+        """Remove and return the entries that may be emitted now"""
+        with self.lock:
+            ready = []
+            for key, entry in list(self.pending.items()):
+                if entry['coalesce'] and any(now - self._room(name)['last_emit'] < self.room_intervals.get(name, 0.0)
+                                             for name in entry['labels']):
+                    continue  # Room rate limit; a newer update may still replace it
+                ready.append(self.pending.pop(key))
+            return ready
+    
+    def _record(self, entry, now, error=False):
+        with self.lock:
+            for name in entry['labels']:
+                room = self._room(name)
+                if error:
+                    room['errors'] += 1
+                    continue
+                room['emitted'] += 1
+                room['last_emit'] = now
+                room['window_count'] += 1
+                if now - room['window_start'] >= 1.0:
+                    room['rate'] = room['window_count'] / (now - room['window_start'])
+                    room['window_start'] = now
+                    room['window_count'] = 0
+    
+    def ensure_started(self):
+        if self.task is None:
+            self.task = socketio.start_background_task(self._run)
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(BROADCAST_IDLE_WAIT)
+            self.wakeup.clear()
+            for entry in self._take(time.time()):
+                try:
+                    socketio.emit(entry['event'], entry['data'], to=entry['to'], namespace=entry['namespace'])
+                    self._record(entry, time.time())
+                except Exception as e:
+                    # A bad payload only costs its own emit
+                    print(f"Broadcast error ({entry['event']}): {e}")
+                    self._record(entry, time.time(), error=True)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': len(self.pending),
+                'rooms': {name: {k: (round(v, 2) if k == 'rate' else v) for k, v in room.items()
+                                 if k not in ('last_emit', 'window_start', 'window_count')}
+                          for name, room in self.rooms.items()}
+            }
+
+broadcaster = Broadcaster()
+
+class StateBroadcaster:
+    """
+    Delta-encoded simulation state stream for SocketIO clients.
+    
+    Every key remembers the seq at which it last changed, so the delta for a
+    client that has seen up to `base` is the set of keys changed after `base`.
+    Deltas are built and encoded once per distinct base and sent to all
+    clients sharing it, and nothing is sent while the state is unchanged.
+    
+    Protocol:
+        'simulation_snapshot' {seq, state}: on connect and on 'resync'
+        'simulation_delta' {seq, base, changes}: at the client's own rate;
+            a client whose last seq is not `base` missed one and resyncs
+    """
+    def __init__(self, exclude=('process', 'process_pid')):
+        self.exclude = set(exclude)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.state = {}
+        self.changed_at = {}  # key -> seq of its last change
+        self.clients = {}     # sid -> {'seq', 'interval', 'next_emit'}
+    
+    def publish(self, state):
+        """
+        Fold the current state in.
+        
+        Returns:
+            list: Keys that changed (empty if nothing did)
+        """
+        with self.lock:
+            changed = [k for k, v in state.items()
+                       if k not in self.exclude and (k not in self.state or self.state[k] != v)]
+            if changed:
+                self.seq += 1
+                for k in changed:
+                    # Copy so later in-place edits of nested values still register as changes
+                    self.state[k] = copy.deepcopy(state[k])
+                    self.changed_at[k] = self.seq
+            return changed
+    
+    def add_client(self, sid, interval=STATE_EMIT_INTERVAL):
+        """Register a client and return its full snapshot"""
+        with self.lock:
+            self.clients[sid] = {'seq': self.seq, 'interval': interval, 'next_emit': 0.0}
+            return {'seq': self.seq, 'state': dict(self.state)}
+    
+    def snapshot(self, sid):
+        """Full snapshot for a resync; the client continues from its seq"""
+        with self.lock:
+            if sid in self.clients:
+                self.clients[sid]['seq'] = self.seq
+            return {'seq': self.seq, 'state': dict(self.state)}
+    
+    def remove_client(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+    
+    def set_interval(self, sid, interval):
+        """Set a client's update interval (clamped), returns the value in effect"""
+        interval = min(max(float(interval), STATE_MIN_EMIT_INTERVAL), STATE_MAX_EMIT_INTERVAL)
+        with self.lock:
+            if sid in self.clients:
+                self.clients[sid]['interval'] = interval
+                self.clients[sid]['next_emit'] = 0.0
+        return interval
+    
+    def due(self, now):
+        """
+        Collect the deltas owed to clients whose interval has elapsed.
+        
+        Returns:
+            list: (payload, [sid, ...]) with one payload per distinct base seq
+        """
+        with self.lock:
+            groups = {}
+            for sid, client in self.clients.items():
+                if client['seq'] == self.seq or now < client['next_emit']:
+                    continue
+                groups.setdefault(client['seq'], []).append(sid)
+                client['seq'] = self.seq
+                client['next_emit'] = now + client['interval']
+            
+            deltas = []
+            for base, sids in groups.items():
+                changes = {k: self.state[k] for k, at in self.changed_at.items() if at > base}
+                deltas.append(({'seq': self.seq, 'base': base, 'changes': changes}, sids))
+            return deltas
+
+state_broadcaster = StateBroadcaster()
+
+class FrameRelay:
+    """
+    Forwards packed per-vehicle frames to '/vehicles' clients as-is (binary).
+    
+    Decimation: each client receives at most its own fps; frames in between
+    are skipped, and only the newest frame is ever sent.
+    Back-pressure: a client acknowledges each frame with 'frame_ack'; once
+    VEHICLE_FRAMES_IN_FLIGHT frames are unacknowledged it is skipped until it
+    catches up (or VEHICLE_ACK_TIMEOUT passes), so a slow client never builds
+    up a queue on the server.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # sid -> {'interval', 'next_emit', 'in_flight', 'last_ack', 'sent', 'skipped'}
+    
+    def __len__(self):
+        return len(self.clients)
+    
+    def add_client(self, sid, fps=VEHICLE_FRAME_FPS):
+        with self.lock:
+            self.clients[sid] = {'interval': 1.0 / fps, 'next_emit': 0.0, 'in_flight': 0,
+                                 'last_ack': time.time(), 'sent': 0, 'skipped': 0}
+    
+    def remove_client(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+    
+    def set_fps(self, sid, fps):
+        """Set a client's maximum frame rate (clamped), returns the value in effect"""
+        fps = min(max(float(fps), 0.1), VEHICLE_FRAME_MAX_FPS)
+        with self.lock:
+            if sid in self.clients:
+                self.clients[sid]['interval'] = 1.0 / fps
+        return fps
+    
+    def release(self, sids):
+        """Undo the in-flight count for frames that were never sent"""
+        with self.lock:
+            for sid in sids:
+                client = self.clients.get(sid)
+                if client is not None:
+                    client['in_flight'] = max(client['in_flight'] - 1, 0)
+                    client['sent'] -= 1
+    
+    def ack(self, sid):
+        with self.lock:
+            client = self.clients.get(sid)
+            if client is not None:
+                client['in_flight'] = max(client['in_flight'] - 1, 0)
+                client['last_ack'] = time.time()
+    
+    def due(self, now):
+        """
+        Pick the clients that should get the newest frame.
+        
+        Returns:
+            list: sids to send the frame to
+        """
+        with self.lock:
+            sids = []
+            for sid, client in self.clients.items():
+                if now < client['next_emit']:
+                    continue  # decimated
+                # Keep to the client's rate; restart the schedule after a gap
+                if now - client['next_emit'] < client['interval']:
+                    client['next_emit'] += client['interval']
+                else:
+                    client['next_emit'] = now + client['interval']
+                if client['in_flight'] >= VEHICLE_FRAMES_IN_FLIGHT:
+                    if now - client['last_ack'] < VEHICLE_ACK_TIMEOUT:
+                        client['skipped'] += 1
+                        continue
+                    client['in_flight'] = 0
+                sids.append(sid)
+                client['in_flight'] += 1
+                client['sent'] += 1
+            return sids
+    
+    def stats(self, sid):
+        with self.lock:
+            client = self.clients.get(sid, {})
+            return {'fps': round(1.0 / client['interval'], 2) if client else 0,
+                    'sent': client.get('sent', 0), 'skipped': client.get('skipped', 0)}
+
+frame_relay = FrameRelay()
+
 class SimulationController:
     def __init__(self):
         self.running = False
@@ -116,9 +525,8 @@ class SimulationController:
     def start_simulation(self):
         if not self.running:
             self.running = True
-            self.thread = threading.Thread(target=self.simulation_loop)
-            self.thread.daemon = True
-            self.thread.start()
+            # A green thread in eventlet/gevent mode, a daemon thread otherwise
+            self.thread = socketio.start_background_task(self.simulation_loop)
             
     def stop_simulation(self):
         self.running = False
@@ -129,65 +537,99 @@ class SimulationController:
         """Main simulation loop running in background thread"""
         global simulation_state
         
-        state_file = os.path.join(os.path.dirname(__file__), 'simulation_state.json')
+        subscriber = StateSubscriber(default_channels['state_file'])
+        frame_subscriber = FrameSubscriber()
         
         print("Dashboard monitoring loop started...")
         
-        # Track if we've seen the state file
+        # Track if we've seen the simulator
         file_seen = False
-        last_modified = 0
+        last_ack_poll = 0
+        last_metrics_check = 0
+        metrics_version = None
         self.last_mode = None  # Track mode changes for automatic shift detection
         
         while self.running:
             try:
-                # Read state from test_carla.py shared file
-                if os.path.exists(state_file):
-                    # Check if file was modified
-                    current_modified = os.path.getmtime(state_file)
+                # Read the newest state published by test_carla.py
+                file_state = subscriber.poll()
+                
+                if file_state is not None:
+                    # Update simulation state with real data
+                    simulation_state.update(file_state)
                     
-                    if current_modified != last_modified:
-                        try:
-                            with open(state_file, 'r') as f:
-                                file_state = json.load(f)
-                                # Update simulation state with real data
-                                simulation_state.update(file_state)
-                                
-                                if not file_seen:
-                                    print(f"✓ Connected to simulation (vehicles: {file_state.get('total_vehicles', 0)})")
-                                    file_seen = True
-                                
-                                last_modified = current_modified
-                        except Exception as e:
-                            pass
-                else:
-                    # File doesn't exist - simulation not running yet
-                    if file_seen:
-                        simulation_state['running'] = False
-                        file_seen = False
-                        print("⚠ Lost connection to simulation")
+                    if not file_seen:
+                        print(f"✓ Connected to simulation (vehicles: {file_state.get('total_vehicles', 0)})")
+                        file_seen = True
+                elif file_seen and not subscriber.connected:
+                    # Simulator closed the channel; collect its last acks, then clear the
+                    # journal so a manually launched simulator does not replay old commands
+                    simulation_state['running'] = False
+                    file_seen = False
+                    print("⚠ Lost connection to simulation")
+                    for ack in run_blocking(command_journal.poll_acks):
+                        command_acks[ack['seq']] = ack
+                        broadcaster.publish('command_ack', ack, coalesce=False)
+                    run_blocking(command_journal.reset)
+                
+                # Forward command acknowledgements from the simulator
+                now = time.time()
+                if now - last_ack_poll >= ACK_POLL_INTERVAL:
+                    last_ack_poll = now
+                    for ack in run_blocking(command_journal.poll_acks):
+                        command_acks[ack['seq']] = ack
+                        broadcaster.publish('command_ack', ack, coalesce=False)
+                    if len(command_acks) > MAX_TRACKED_ACKS:
+                        for old_seq in sorted(command_acks)[:len(command_acks) - MAX_TRACKED_ACKS]:
+                            del command_acks[old_seq]
                 
-                # Emit updates to all connected clients
-                # Make sure we don't try to serialize non-JSON objects
-                safe_state = {k: v for k, v in simulation_state.items() if k != 'process_pid'}
-                socketio.emit('simulation_update', safe_state)
+                # Send each client the keys changed since its last update, at its own rate
+                state_broadcaster.publish(simulation_state)
+                for payload, sids in state_broadcaster.due(time.time()):
+                    broadcaster.publish('simulation_delta', payload, to=sids, coalesce=False, label='state')
+                
+                # Newest vehicle frame, read only while someone is watching
+                if len(frame_relay):
+                    frame = frame_subscriber.poll()
+                    if frame is not None:
+                        sids = frame_relay.due(time.time())
+                        if sids:
+                            broadcaster.publish('frame', frame, to=sids, namespace=VEHICLE_NAMESPACE,
+                                                label='vehicles', on_discard=frame_relay.release)
                 
                 # If median position changed (automatic shift), notify all clients
-                if hasattr(self, 'last_mode') and self.last_mode != simulation_state.get('mode'):
+                if self.last_mode is not None and self.last_mode != simulation_state.get('mode'):
                     median_pos = simulation_state.get('median_position', 0)
-                    socketio.emit('median_update', {
+                    broadcaster.publish('median_update', {
                         'position': median_pos,
                         'mode': simulation_state.get('mode', '3-3')
                     })
                     print(f"📡 Broadcasting automatic median shift: {simulation_state.get('mode')}")
                 self.last_mode = simulation_state.get('mode')
+                
+                # Tell metrics pages when a finished run lands in the results store
+                now = time.time()
+                if now - last_metrics_check >= METRICS_CHECK_INTERVAL:
+                    last_metrics_check = now
+                    version = run_blocking(results_store.version)
+                    if metrics_version is not None and version != metrics_version:
+                        latest = run_blocking(results_store.latest) or {}
+                        broadcaster.publish('metrics_update', {
+                            'count': run_blocking(len, results_store),
+                            'latest_session': latest.get('session_id')
+                        }, to='metrics')
+                    metrics_version = version
                     
-                time.sleep(0.5)  # Update every 500ms
+                socketio.sleep(STATE_POLL_INTERVAL)
                 
             except Exception as e:
                 # Don't spam errors
                 if "JSON serializable" not in str(e):
                     print(f"Simulation loop error: {e}")
-                time.sleep(1)
+                socketio.sleep(1)
+        
+        subscriber.close()
+        frame_subscriber.close()
     
     def update_traffic_data(self):
         """Update traffic statistics from CARLA world"""
@@ -225,6 +667,262 @@ class SimulationController:
 
 controller = SimulationController()
 
+class CarlaHealthMonitor:
+    """
+    Background CARLA health check.
+    
+    Probes the CARLA port every CARLA_HEALTH_INTERVAL seconds from a
+    background task (a green thread in eventlet/gevent mode, where the
+    socket connect yields instead of blocking), so request handlers read
+    the cached result instead of waiting on a probe.
+    """
+    def __init__(self, host=CARLA_HOST, port=CARLA_PORT):
+        self.host = host
+        self.port = port
+        self.status = {'running': False, 'checked_at': None, 'latency_ms': None, 'error': None}
+        self.task = None
+    
+    def probe(self):
+        """Check the port once and update status"""
+        start = time.time()
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=CARLA_PROBE_TIMEOUT)
+            sock.close()
+            self.status = {'running': True, 'checked_at': time.time(),
+                           'latency_ms': round((time.time() - start) * 1000, 1), 'error': None}
+        except OSError as e:
+            self.status = {'running': False, 'checked_at': time.time(), 'latency_ms': None, 'error': str(e)}
+        return self.status
+    
+    def ensure_started(self):
+        if self.task is None:
+            self.task = socketio.start_background_task(self._run)
+    
+    def _run(self):
+        while True:
+            self.probe()
+            socketio.sleep(CARLA_HEALTH_INTERVAL)
+    
+    def is_running(self):
+        """Cached result, probing now only if there is none recent enough"""
+        self.ensure_started()
+        checked_at = self.status['checked_at']
+        if checked_at is None or time.time() - checked_at > 2 * CARLA_HEALTH_INTERVAL:
+            self.probe()
+        return self.status['running']
+
+carla_health = CarlaHealthMonitor()
+
+class SimulationSession:
+    """
+    One managed test_carla.py worker with its own state and command
+    channels (channel_names(session_id)), ports and SocketIO room.
+    """
+    def __init__(self, session_id, slot, backend='headless', duration=None, seed=None):
+        self.id = session_id
+        self.slot = slot
+        self.backend = backend
+        self.duration = duration
+        self.seed = seed
+        self.carla_port = CARLA_PORT + slot * SESSION_PORT_STRIDE
+        self.tm_port = TM_PORT + slot * SESSION_PORT_STRIDE
+        self.room = f'session:{session_id}'
+        
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.base_dir = base_dir
+        self.channels = channel_names(session_id, base_dir)
+        self.log_file = os.path.join(base_dir, f'session_{session_id}.log')
+        
+        self.state = {'running': False}
+        self.states = StateBroadcaster()  # Delta stream for clients in this session's room
+        self.subscriber = StateSubscriber(self.channels['state_file'], name=self.channels['state_channel'])
+        self.journal = CommandJournal(self.channels['command_file'], self.channels['ack_file'])
+        self.acks = {}
+        self.last_ack_poll = 0
+        
+        self.process = None
+        self.status = 'starting'
+        self.started_at = time.time()
+        self.ended_at = None
+        self.exit_code = None
+    
+    def start(self):
+        self.journal.reset()
+        args = [SESSION_PYTHON, os.path.join(self.base_dir, 'test_carla.py'), '--session', self.id,
+                '--carla-port', str(self.carla_port), '--tm-port', str(self.tm_port)]
+        if self.backend == 'headless':
+            args.append('--headless')
+        if self.duration is not None:
+            args += ['--duration', str(self.duration)]
+        if self.seed is not None:
+            args += ['--seed', str(self.seed)]
+        
+        with open(self.log_file, 'w') as log:
+            self.process = subprocess.Popen(args, cwd=self.base_dir, stdout=log, stderr=subprocess.STDOUT)
+        self.status = 'running'
+    
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.terminate()
+                self.process.wait(timeout=5)
+            except Exception as e:
+                print(f"Error stopping session {self.id}: {e}")
+                self.process.kill()
+        self._finish('stopped')
+    
+    def _finish(self, status):
+        if self.ended_at is None:
+            self.status = status
+            self.ended_at = time.time()
+            self.exit_code = self.process.poll() if self.process is not None else None
+            self.state['running'] = False
+            self.subscriber.close()
+    
+    def poll(self):
+        """
+        Ingest new state and acknowledgements from the worker.
+        
+        Returns:
+            bool: True if the worker has exited since the last call
+        """
+        state = self.subscriber.poll()
+        if state is not None:
+            self.state.update(state)
+        now = time.time()
+        exiting = self.process is not None and self.process.poll() is not None  # Read its final acks too
+        if exiting or now - self.last_ack_poll >= ACK_POLL_INTERVAL:
+            self.last_ack_poll = now
+            for ack in run_blocking(self.journal.poll_acks):
+                self.acks[ack['seq']] = ack
+                broadcaster.publish('command_ack', dict(ack, session=self.id), to=self.room, coalesce=False)
+            if len(self.acks) > MAX_TRACKED_ACKS:
+                for old_seq in sorted(self.acks)[:len(self.acks) - MAX_TRACKED_ACKS]:
+                    del self.acks[old_seq]
+        
+        if self.status == 'running' and self.process.poll() is not None:
+            self._finish('finished' if self.process.returncode == 0 else 'failed')
+            return True
+        return False
+    
+    def info(self):
+        return {
+            'id': self.id,
+            'backend': self.backend,
+            'status': self.status,
+            'carla_port': self.carla_port,
+            'tm_port': self.tm_port,
+            'pid': self.process.pid if self.process is not None else None,
+            'started_at': self.started_at,
+            'ended_at': self.ended_at,
+            'exit_code': self.exit_code,
+            'log_file': os.path.basename(self.log_file),
+            'room': self.room
+        }
+
+class SessionManager:
+    """
+    Launches and tracks up to SESSION_MAX_WORKERS simulator workers.
+    
+    Each worker gets a free port slot from 1 up (slot 0's ports belong to
+    the /api/start simulator), and one background task polls every
+    running worker's channels and streams its state as 'session_delta'
+    (the same delta protocol as simulation_delta) to clients that joined
+    its room.
+    """
+    def __init__(self, max_workers=SESSION_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()
+        self.task = None
+    
+    def start(self, backend='headless', duration=None, seed=None):
+        """
+        Launch a worker.
+        
+        Returns:
+            SimulationSession: The new session
+        
+        Raises:
+            ValueError: Unknown backend
+            RuntimeError: No free worker slot, or CARLA is not running on the slot's port
+        """
+        if backend not in SESSION_BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}' (use one of {', '.join(SESSION_BACKENDS)})")
+        # Probe CARLA outside the lock (up to 2 s), then claim the slot if it is still free
+        slot = self._free_slot()
+        carla_port = CARLA_PORT + slot * SESSION_PORT_STRIDE
+        if backend == 'carla' and not CarlaHealthMonitor(CARLA_HOST, carla_port).probe()['running']:
+            raise RuntimeError(f"CARLA is not running on port {carla_port}")
+        with self.lock:
+            if slot in self._busy_slots():
+                if backend == 'carla':  # Its probe was for another slot's port
+                    raise RuntimeError(f"Worker slot {slot} was taken while CARLA was probed; try again")
+                slot = self._free_slot()
+            sim_session = SimulationSession(uuid.uuid4().hex[:8], slot, backend, duration, seed)
+            sim_session.start()
+            self.sessions[sim_session.id] = sim_session
+        self.ensure_started()
+        broadcaster.publish('session_started', sim_session.info(), to=DASHBOARD_ROOMS, coalesce=False)
+        return sim_session
+    
+    def _busy_slots(self):
+        return {s.slot for s in self.sessions.values() if s.status == 'running'}
+    
+    def _free_slot(self):
+        """Lowest free worker slot"""
+        free = [slot for slot in range(1, self.max_workers + 1) if slot not in self._busy_slots()]
+        if not free:
+            raise RuntimeError(f"All {self.max_workers} simulator workers are busy")
+        return free[0]
+    
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+    
+    def stop(self, session_id):
+        sim_session = self.sessions.get(session_id)
+        if sim_session is not None:
+            sim_session.stop()
+            broadcaster.publish('session_stopped', sim_session.info(), to=DASHBOARD_ROOMS + [sim_session.room], coalesce=False)
+        return sim_session
+    
+    def list(self):
+        return [sim_session.info() for sim_session in self.sessions.values()]
+    
+    def remove_client(self, sid):
+        for sim_session in list(self.sessions.values()):
+            sim_session.states.remove_client(sid)
+    
+    def set_interval(self, sid, interval):
+        for sim_session in list(self.sessions.values()):
+            sim_session.states.set_interval(sid, interval)
+    
+    def ensure_started(self):
+        if self.task is None:
+            self.task = socketio.start_background_task(self._run)
+    
+    def _run(self):
+        while True:
+            now = time.time()
+            for sim_session in list(self.sessions.values()):
+                if sim_session.status != 'running':
+                    continue
+                try:
+                    exited = sim_session.poll()
+                    sim_session.states.publish(sim_session.state)
+                    for payload, sids in sim_session.states.due(now):
+                        broadcaster.publish('session_delta', dict(payload, session=sim_session.id), to=sids,
+                                            coalesce=False, label=sim_session.room)
+                    if exited:
+                        print(f"Session {sim_session.id} {sim_session.status} (exit code {sim_session.exit_code})")
+                        broadcaster.publish('session_stopped', sim_session.info(),
+                                            to=DASHBOARD_ROOMS + [sim_session.room], coalesce=False)
+                except Exception as e:
+                    print(f"Session {sim_session.id} poll error: {e}")
+            socketio.sleep(STATE_POLL_INTERVAL)
+
+session_manager = SessionManager()
+
 # ============================================================================
 # AUTHENTICATION ROUTES
 # ============================================================================
@@ -268,27 +966,24 @@ def logout():
 def get_status():
     return jsonify(simulation_state)
 
+@app.route('/api/broadcast/stats')
+def get_broadcast_stats():
+    """Queue depth and per-room emit counters of the broadcaster"""
+    return jsonify({'success': True, 'broadcast': broadcaster.stats()})
+
+@app.route('/api/health')
+def get_health():
+    """Server mode and the last CARLA health probe"""
+    carla_health.ensure_started()
+    return jsonify({'async_mode': ASYNC_MODE, 'carla': carla_health.status})
+
 @app.route('/api/start', methods=['POST'])
 def start_simulation():
     if 'username' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    # Run test_carla.py script
-    import subprocess
-    import socket
-    
-    # Check if CARLA is running
-    def is_carla_running():
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(2)
-            result = sock.connect_ex(('localhost', 2000))
-            sock.close()
-            return result == 0
-        except:
-            return False
-    
-    if not is_carla_running():
+    # Check if CARLA is running (cached by the background health check)
+    if not carla_health.is_running():
         print("✗ CARLA is not running on localhost:2000")
         return jsonify({'error': 'CARLA is not running! Please start CarlaUE4.exe first.'}), 400
     
@@ -301,6 +996,10 @@ def start_simulation():
     print(f"Using Python: {venv_python}")
     
     try:
+        # Fresh command queue for the new simulator process
+        run_blocking(command_journal.reset)
+        command_acks.clear()
+        
         # Start test_carla.py in a completely separate process
         # Use CREATE_NEW_CONSOLE to run in a new window
         CREATE_NEW_CONSOLE = 0x00000010
@@ -318,7 +1017,7 @@ def start_simulation():
         simulation_state['process_pid'] = process.pid
         simulation_state['running'] = True
         
-        socketio.emit('simulation_started', {'success': True})
+        broadcaster.publish('simulation_started', {'success': True})
         
         print(f"Started test_carla.py (PID: {process.pid}) in new window")
         print(f"Started dashboard monitoring loop")
@@ -349,7 +1048,7 @@ def stop_simulation():
     simulation_state['running'] = False
     simulation_state['process'] = None
     
-    socketio.emit('simulation_stopped', {'success': True})
+    broadcaster.publish('simulation_stopped', {'success': True})
     
     return jsonify({'success': True, 'message': 'Simulation stopped'})
 
@@ -373,7 +1072,8 @@ def shift_median():
     else:
         simulation_state['mode'] = '3-3'  # Center: 3 forward, 3 backward
     
-    # Write command to file for test_carla.py to read
+    # Queue command for test_carla.py to read
+    seq = None
     try:
         command = {
             'action': 'shift_median',
@@ -381,15 +1081,13 @@ def shift_median():
             'mode': simulation_state['mode'],
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"✓ Sent median shift command: {simulation_state['mode']} ({amount}m)")
     except Exception as e:
         print(f"✗ Error writing command: {e}")
     
     # Broadcast update to ALL connected clients
-    socketio.emit('median_update', {
+    broadcaster.publish('median_update', {
         'position': amount,
         'mode': simulation_state['mode']
     })
@@ -397,7 +1095,8 @@ def shift_median():
     return jsonify({
         'success': True, 
         'position': amount,
-        'mode': simulation_state['mode']
+        'mode': simulation_state['mode'],
+        'seq': seq
     })
 
 @app.route('/api/spawn/forward', methods=['POST'])
@@ -407,7 +1106,8 @@ def spawn_forward():
     
     count = request.json.get('count', 10)
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'spawn_vehicles',
@@ -415,20 +1115,18 @@ def spawn_forward():
             'count': count,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"✓ Sent spawn command: {count} forward vehicles")
     except Exception as e:
         print(f"✗ Error writing command: {e}")
     
     # Broadcast spawn event
-    socketio.emit('vehicle_spawned', {
+    broadcaster.publish('vehicle_spawned', {
         'direction': 'forward',
         'count': count
-    })
+    }, coalesce=False)
     
-    return jsonify({'success': True, 'spawned': count})
+    return jsonify({'success': True, 'spawned': count, 'seq': seq})
 
 @app.route('/api/spawn/backward', methods=['POST'])
 def spawn_backward():
@@ -437,7 +1135,8 @@ def spawn_backward():
     
     count = request.json.get('count', 10)
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'spawn_vehicles',
@@ -445,20 +1144,18 @@ def spawn_backward():
             'count': count,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"✓ Sent spawn command: {count} backward vehicles")
     except Exception as e:
         print(f"✗ Error writing command: {e}")
     
     # Broadcast spawn event
-    socketio.emit('vehicle_spawned', {
+    broadcaster.publish('vehicle_spawned', {
         'direction': 'backward',
         'count': count
-    })
+    }, coalesce=False)
     
-    return jsonify({'success': True, 'spawned': count})
+    return jsonify({'success': True, 'spawned': count, 'seq': seq})
 
 @app.route('/api/speed/set', methods=['POST'])
 def set_speed_multiplier():
@@ -468,26 +1165,25 @@ def set_speed_multiplier():
     multiplier = float(request.json.get('multiplier', 1.0))
     simulation_state['speed_multiplier'] = max(0.1, min(10.0, multiplier))
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'set_speed',
             'multiplier': simulation_state['speed_multiplier'],
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"Speed multiplier set to {simulation_state['speed_multiplier']}x")
     except Exception as e:
         print(f"Error writing speed command: {e}")
     
     # Broadcast to all clients
-    socketio.emit('speed_update', {
+    broadcaster.publish('speed_update', {
         'multiplier': simulation_state['speed_multiplier']
     })
     
-    return jsonify({'success': True, 'multiplier': simulation_state['speed_multiplier']})
+    return jsonify({'success': True, 'multiplier': simulation_state['speed_multiplier'], 'seq': seq})
 
 @app.route('/api/camera/switch', methods=['POST'])
 def switch_camera():
@@ -497,26 +1193,25 @@ def switch_camera():
     view = request.json.get('view', 'overview')
     simulation_state['camera_view'] = view.capitalize()
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'camera_switch',
             'view': view,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"Camera view set to {view}")
     except Exception as e:
         print(f"Error writing camera command: {e}")
     
     # Broadcast to all clients
-    socketio.emit('camera_update', {
+    broadcaster.publish('camera_update', {
         'view': simulation_state['camera_view']
     })
     
-    return jsonify({'success': True, 'view': simulation_state['camera_view']})
+    return jsonify({'success': True, 'view': simulation_state['camera_view'], 'seq': seq})
 
 @app.route('/api/weather/set', methods=['POST'])
 def set_weather():
@@ -526,26 +1221,25 @@ def set_weather():
     weather = request.json.get('weather', 'Clear')
     simulation_state['weather'] = weather
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'set_weather',
             'weather': weather,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"Weather set to {weather}")
     except Exception as e:
         print(f"Error writing weather command: {e}")
     
     # Broadcast to all clients
-    socketio.emit('weather_update', {
+    broadcaster.publish('weather_update', {
         'weather': weather
     })
     
-    return jsonify({'success': True, 'weather': weather})
+    return jsonify({'success': True, 'weather': weather, 'seq': seq})
 
 @app.route('/api/congestion/create', methods=['POST'])
 def create_congestion():
@@ -555,7 +1249,8 @@ def create_congestion():
     direction = request.json.get('direction', 'forward')
     intensity = request.json.get('intensity', 0.5)
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'create_congestion',
@@ -563,14 +1258,26 @@ def create_congestion():
             'intensity': intensity,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"Creating {intensity*100:.0f}% congestion in {direction} lanes")
     except Exception as e:
         print(f"Error writing congestion command: {e}")
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'seq': seq})
+
+@app.route('/api/commands/<int:seq>')
+def get_command_status(seq):
+    """Acknowledgement status of a queued command"""
+    if seq >= command_journal.next_seq:
+        return jsonify({'success': False, 'error': 'Unknown command'}), 404
+    
+    ack = command_acks.get(seq)
+    return jsonify({
+        'success': True,
+        'seq': seq,
+        'status': ack['status'] if ack else 'pending',
+        'ack': ack
+    })
 
 @app.route('/api/mode/toggle', methods=['POST'])
 def toggle_mode():
@@ -588,21 +1295,96 @@ def toggle_traffic_lights():
     
     state = request.json.get('state', 'green')
     
-    # Write command for test_carla.py
+    # Queue command for test_carla.py
+    seq = None
     try:
         command = {
             'action': 'traffic_lights',
             'state': state,
             'timestamp': time.time()
         }
-        command_path = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-        with open(command_path, 'w') as f:
-            json.dump(command, f)
+        seq = run_blocking(command_journal.send, command)
         print(f"Traffic lights set to {state}")
     except Exception as e:
         print(f"Error writing traffic light command: {e}")
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'seq': seq})
+
+# ============================================================================
+# SESSION API ROUTES (several simulators side by side)
+# ============================================================================
+
+@app.route('/api/sessions')
+def list_sessions():
+    return jsonify({'success': True, 'sessions': session_manager.list(), 'max_workers': session_manager.max_workers})
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.json or {}
+    try:
+        duration = float(data['duration']) if data.get('duration') is not None else None
+        seed = int(data['seed']) if data.get('seed') is not None else None
+        sim_session = session_manager.start(data.get('backend', 'headless'), duration, seed)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    print(f"Started session {sim_session.id} ({sim_session.backend}, PID {sim_session.process.pid})")
+    return jsonify({'success': True, 'session': sim_session.info()})
+
+@app.route('/api/sessions/<session_id>')
+def get_session(session_id):
+    sim_session = session_manager.get(session_id)
+    if sim_session is None:
+        return jsonify({'success': False, 'error': f'Session {session_id} not found'}), 404
+    state = {k: v for k, v in sim_session.state.items() if k != 'process_pid'}
+    return jsonify({'success': True, 'session': sim_session.info(), 'state': state})
+
+@app.route('/api/sessions/<session_id>/stop', methods=['POST'])
+def stop_session(session_id):
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    sim_session = run_blocking(session_manager.stop, session_id)
+    if sim_session is None:
+        return jsonify({'success': False, 'error': f'Session {session_id} not found'}), 404
+    return jsonify({'success': True, 'session': sim_session.info()})
+
+@app.route('/api/sessions/<session_id>/command', methods=['POST'])
+def send_session_command(session_id):
+    """Queue a command ({'action': ..., ...} as accepted by test_carla.py) for one session"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    sim_session = session_manager.get(session_id)
+    if sim_session is None:
+        return jsonify({'success': False, 'error': f'Session {session_id} not found'}), 404
+    command = request.json or {}
+    if not command.get('action'):
+        return jsonify({'success': False, 'error': 'Missing action'}), 400
+    
+    seq = run_blocking(sim_session.journal.send, dict(command, timestamp=time.time()))
+    return jsonify({'success': True, 'seq': seq})
+
+@app.route('/api/sessions/<session_id>/commands/<int:seq>')
+def get_session_command_status(session_id, seq):
+    sim_session = session_manager.get(session_id)
+    if sim_session is None:
+        return jsonify({'success': False, 'error': f'Session {session_id} not found'}), 404
+    if seq >= sim_session.journal.next_seq:
+        return jsonify({'success': False, 'error': 'Unknown command'}), 404
+    
+    ack = sim_session.acks.get(seq)
+    return jsonify({
+        'success': True,
+        'seq': seq,
+        'status': ack['status'] if ack else 'pending',
+        'ack': ack
+    })
 
 # ============================================================================
 # METRICS API ENDPOINTS
@@ -612,18 +1394,14 @@ def toggle_traffic_lights():
 def get_current_metrics():
     """Get current simulation metrics"""
     try:
-        # Try to read from simulation_results.json
-        if os.path.exists('simulation_results.json'):
-            with open('simulation_results.json', 'r') as f:
-                history = json.load(f)
-                if history:
-                    latest = history[-1]
-                    return jsonify({
-                        'success': True,
-                        'metrics': latest.get('metrics', {}),
-                        'timestamp': latest.get('timestamp'),
-                        'session_id': latest.get('session_id')
-                    })
+        latest = run_blocking(results_store.latest)
+        if latest:
+            return jsonify({
+                'success': True,
+                'metrics': latest.get('metrics', {}),
+                'timestamp': latest.get('timestamp'),
+                'session_id': latest.get('session_id')
+            })
         
         # No data available - return error
         return jsonify({
@@ -633,19 +1411,115 @@ def get_current_metrics():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def _project(record, fields):
+    """Keep only the dotted paths in fields ('metrics.trip_time_improvement_percent')"""
+    projected = {}
+    for path in fields:
+        keys = path.split('.')
+        value = record
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projected
+
+def _parse_time(value):
+    """ISO 8601 string or Unix seconds -> ISO 8601 string comparable with stored timestamps"""
+    try:
+        return datetime.fromtimestamp(float(value)).isoformat()
+    except ValueError:
+        return datetime.fromisoformat(value).isoformat()
+
+def _etag_response(etag_key, build_payload):
+    """
+    JSON response with a weak ETag, 304 on If-None-Match, and gzip/brotli
+    compression when the client accepts it. build_payload only runs on a miss.
+    """
+    etag = 'W/"' + hashlib.sha1(etag_key.encode('utf-8')).hexdigest()[:24] + '"'
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response = Response(status=304)
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    body = json.dumps(run_blocking(build_payload), separators=(',', ':')).encode('utf-8')
+    accept = request.headers.get('Accept-Encoding', '')
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        if BROTLI_AVAILABLE and 'br' in accept:
+            body, encoding = brotli.compress(body, quality=5), 'br'
+        elif 'gzip' in accept:
+            body, encoding = gzip.compress(body, compresslevel=6), 'gzip'
+    
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'  # Always revalidate, usually as a 304
+    return response
+
 @app.route('/api/metrics/history')
 def get_metrics_history():
-    """Get historical metrics data"""
+    """
+    Get historical metrics data, oldest first, newest page by default.
+    
+    Query:
+        limit: runs per page (default HISTORY_PAGE_SIZE, max HISTORY_MAX_PAGE_SIZE)
+        cursor: next_cursor from the previous response, to page further back
+        fields: comma-separated dotted paths to return (default: everything)
+        since / until: ISO 8601 or Unix time range on the run timestamp [since, until)
+    """
     try:
-        if os.path.exists('simulation_results.json'):
-            with open('simulation_results.json', 'r') as f:
-                history = json.load(f)
-                return jsonify({
-                    'success': True,
-                    'history': history,
-                    'count': len(history)
-                })
-        return jsonify({'success': True, 'history': [], 'count': 0})
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        since = _parse_time(request.args['since']) if request.args.get('since') else None
+        until = _parse_time(request.args['until']) if request.args.get('until') else None
+        cursor = request.args.get('cursor', type=int)
+        if cursor is None and request.args.get('cursor'):
+            raise ValueError(f"cursor must be an integer, got {request.args['cursor']!r}")
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Invalid query parameter: {e}'}), 400
+    
+    def build_payload():
+        total = len(results_store)
+        lo = results_store.position_at_time(since) if since else 0
+        hi = results_store.position_at_time(until) if until else total
+        if cursor is not None:
+            hi = min(hi, cursor)
+        start = max(lo, hi - limit)
+        
+        history = results_store.page(start, max(hi - start, 0))
+        if fields:
+            history = [_project(record, fields) for record in history]
+        return {
+            'success': True,
+            'history': history,
+            'count': total,
+            'limit': limit,
+            'next_cursor': str(start) if start > lo else None
+        }
+    
+    try:
+        etag_key = f"{run_blocking(results_store.version)}|{request.full_path}"
+        return _etag_response(etag_key, build_payload)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/metrics/session/<session_id>')
+def get_session_metrics(session_id):
+    """Get the metrics of one run by session_id"""
+    try:
+        record = run_blocking(results_store.find, session_id)
+        if record is None:
+            return jsonify({'success': False, 'error': f'Session {session_id} not found'}), 404
+        return jsonify({'success': True, 'result': record})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -653,26 +1527,25 @@ def get_metrics_history():
 def get_metrics_summary():
     """Get summary statistics across all simulation runs"""
     try:
-        if os.path.exists('simulation_results.json'):
-            with open('simulation_results.json', 'r') as f:
-                history = json.load(f)
-                if not history:
-                    return jsonify({'success': True, 'summary': {}})
-                
-                # Calculate averages
-                trip_improvements = [h['metrics']['trip_time_improvement_percent'] for h in history if 'metrics' in h]
-                fuel_improvements = [h['metrics']['fuel_improvement_percent'] for h in history if 'metrics' in h]
-                
-                summary = {
-                    'total_simulations': len(history),
-                    'avg_trip_time_improvement': round(sum(trip_improvements) / len(trip_improvements), 2) if trip_improvements else 0,
-                    'avg_fuel_improvement': round(sum(fuel_improvements) / len(fuel_improvements), 2) if fuel_improvements else 0,
-                    'latest_session': history[-1].get('session_id'),
-                    'latest_timestamp': history[-1].get('timestamp')
-                }
-                
-                return jsonify({'success': True, 'summary': summary})
-        return jsonify({'success': True, 'summary': {}})
+        if not run_blocking(len, results_store):
+            return jsonify({'success': True, 'summary': {}})
+        
+        # Running aggregates, maintained on append and cached until the store changes
+        stats = run_blocking(results_store.summary)
+        trip = stats['fields']['trip_time_improvement_percent']
+        fuel = stats['fields']['fuel_improvement_percent']
+        latest = run_blocking(results_store.latest)
+        
+        summary = {
+            'total_simulations': stats['count'],
+            'avg_trip_time_improvement': round(trip['mean'], 2) if trip['count'] else 0,
+            'avg_fuel_improvement': round(fuel['mean'], 2) if fuel['count'] else 0,
+            'latest_session': latest.get('session_id'),
+            'latest_timestamp': latest.get('timestamp'),
+            'statistics': stats['fields']
+        }
+        
+        return jsonify({'success': True, 'summary': summary})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -681,13 +1554,95 @@ def get_metrics_summary():
 # ============================================================================
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     print('Client connected')
-    emit('simulation_update', simulation_state)
+    if isinstance(auth, dict) and auth.get('view') == 'metrics':
+        # Metrics pages only want to hear about finished runs
+        join_room('metrics')
+        return
+    join_room('admin' if session.get('username') == 'admin' else 'observer')
+    state_broadcaster.publish(simulation_state)
+    emit('simulation_snapshot', state_broadcaster.add_client(request.sid))
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
+    state_broadcaster.remove_client(request.sid)
+    session_manager.remove_client(request.sid)
+
+@socketio.on('join_session')
+def handle_join_session(data):
+    """Follow one managed session: snapshot now, then 'session_delta' updates"""
+    sim_session = session_manager.get((data or {}).get('session'))
+    if sim_session is None:
+        emit('session_error', {'error': 'Session not found', 'session': (data or {}).get('session')})
+        return
+    join_room(sim_session.room)
+    sim_session.states.publish(sim_session.state)
+    emit('session_snapshot', dict(sim_session.states.add_client(request.sid), session=sim_session.id))
+
+@socketio.on('leave_session')
+def handle_leave_session(data):
+    sim_session = session_manager.get((data or {}).get('session'))
+    if sim_session is not None:
+        leave_room(sim_session.room)
+        sim_session.states.remove_client(request.sid)
+
+@socketio.on('resync')
+def handle_resync(data=None):
+    """Client missed a delta (seq gap) and wants the full state again"""
+    state_broadcaster.publish(simulation_state)
+    emit('simulation_snapshot', state_broadcaster.snapshot(request.sid))
+
+@socketio.on('set_update_rate')
+def handle_set_update_rate(data):
+    """Per-client update rate: {'interval': seconds} or {'hz': updates per second}"""
+    try:
+        if 'hz' in data:
+            interval = 1.0 / float(data['hz'])
+        else:
+            interval = float(data.get('interval', STATE_EMIT_INTERVAL))
+    except (TypeError, ValueError, ZeroDivisionError):
+        emit('update_rate', {'success': False, 'error': 'Invalid update rate'})
+        return
+    interval = state_broadcaster.set_interval(request.sid, interval)
+    session_manager.set_interval(request.sid, interval)
+    emit('update_rate', {'success': True, 'interval': interval})
+
+@socketio.on('connect', namespace=VEHICLE_NAMESPACE)
+def handle_vehicle_connect(auth=None):
+    """Opt-in per-vehicle stream; tells the client how to decode 'frame' payloads"""
+    frame_relay.add_client(request.sid)
+    emit('frame_format', {
+        'header': [['frame', 'uint32'], ['sim_time', 'float64'], ['count', 'uint32']],
+        'header_bytes': 16,
+        'record': [[name, VEHICLE_FRAME_DTYPE[name].str] for name in VEHICLE_FRAME_DTYPE.names],
+        'record_bytes': VEHICLE_FRAME_DTYPE.itemsize,
+        'scale': {'x': 0.01, 'y': 0.01, 'speed': 0.01},
+        'fps': VEHICLE_FRAME_FPS,
+        'max_fps': VEHICLE_FRAME_MAX_FPS
+    })
+
+@socketio.on('disconnect', namespace=VEHICLE_NAMESPACE)
+def handle_vehicle_disconnect():
+    frame_relay.remove_client(request.sid)
+
+@socketio.on('frame_ack', namespace=VEHICLE_NAMESPACE)
+def handle_frame_ack(data=None):
+    frame_relay.ack(request.sid)
+
+@socketio.on('set_frame_rate', namespace=VEHICLE_NAMESPACE)
+def handle_set_frame_rate(data):
+    try:
+        fps = frame_relay.set_fps(request.sid, data.get('fps', VEHICLE_FRAME_FPS))
+    except (AttributeError, TypeError, ValueError):
+        emit('frame_rate', {'success': False, 'error': 'Invalid frame rate'})
+        return
+    emit('frame_rate', {'success': True, 'fps': fps})
+
+@socketio.on('frame_stats', namespace=VEHICLE_NAMESPACE)
+def handle_frame_stats(data=None):
+    emit('frame_stats', frame_relay.stats(request.sid))
 
 if __name__ == '__main__':
     print("="*60)
@@ -699,7 +1654,10 @@ if __name__ == '__main__':
     print("   - admin / admin123")
     print("   - student / student123")
     print("   - observer / observer123")
-    print("\n Make sure CARLA is running on localhost:2000")
+    print(f"\n Server mode: {ASYNC_MODE}")
+    print(" Make sure CARLA is running on localhost:2000")
     print("="*60 + "\n")
     
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    carla_health.ensure_started()
+    # The code reloader forks, which does not mix with a monkey-patched process
+    socketio.run(app, host='0.0.0.0', port=5000, debug=True, use_reloader=ASYNC_MODE == 'threading')
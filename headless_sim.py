@@ -0,0 +1,916 @@
+"""
+Headless Traffic Engine
+CARLA-free microsimulation backend for the median controller
+
+Implements the subset of the CARLA Python API that test_carla.py uses
+(Client, World, Map, Waypoint, actors, Traffic Manager, batch commands and
+world snapshots) on top of a NumPy car-following model:
+
+- Straight 6-lane road (3 forward, 3 backward lanes of 3.5 m) along +x,
+  long enough for the 1.5 km section plus the 300 m lead-in
+- IDM car-following with gap-acceptance lane changes (MOBIL-style incentive)
+- Each direction is a loop: vehicles leaving the far end re-enter at the
+  start, through a metered bottleneck of BOTTLENECK_CAPACITY veh/h/lane,
+  so queues build up when demand exceeds the capacity of the open lanes
+- The median barrier props spawned by ConcreteMedian are tracked; when
+  they move past half a lane the engine opens a 4th lane on that side
+
+Run the full simulation without CARLA or a GPU with:
+    MEDIAN_SIM_BACKEND=headless python test_carla.py
+or
+    python test_carla.py --headless
+"""
+
+import math
+import random
+
+import numpy as np
+
+ROAD_Y = -255.0            # y of the road centre line (median at rest)
+ROAD_X_MIN = -400.0        # start of the modelled road (m)
+ROAD_X_MAX = 1700.0        # end of the modelled road (m)
+ROAD_LENGTH = ROAD_X_MAX - ROAD_X_MIN
+LANE_WIDTH = 3.5
+SPEED_LIMIT_KMH = 90.0
+
+VEHICLE_LENGTH = 4.5
+IDM_TIME_HEADWAY = 1.5     # s
+IDM_MAX_ACCEL = 1.0        # m/s^2
+IDM_COMFORT_DECEL = 2.0    # m/s^2
+IDM_MAX_DECEL = 9.0        # m/s^2
+DEFAULT_MIN_GAP = 2.5      # m, Traffic Manager distance_to_leading_vehicle
+LANE_CHANGE_INTERVAL = 1.0     # s between lane-change decisions
+LANE_CHANGE_THRESHOLD = 0.2    # m/s^2 acceleration gain needed to change lanes
+LANE_CHANGE_PROBABILITY = 0.3  # share of willing drivers that change per decision
+BOTTLENECK_CAPACITY = 1000     # veh/h/lane discharged at the end of the road
+
+MAX_LANES = 4
+_GROUP_STRIDE = 1e5  # Sort key spacing between (direction, lane) groups, > ROAD_LENGTH
+
+
+# ============================================================================
+# CARLA VALUE TYPES
+# ============================================================================
+
+class Vector3D:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def __add__(self, other):
+        return type(self)(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return type(self)(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(x={self.x:.2f}, y={self.y:.2f}, z={self.z:.2f})"
+
+
+class Location(Vector3D):
+    def distance(self, other):
+        return math.sqrt((self.x - other.x)**2 + (self.y - other.y)**2 + (self.z - other.z)**2)
+
+
+class Rotation:
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = pitch
+        self.yaw = yaw
+        self.roll = roll
+
+
+class Transform:
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def get_forward_vector(self):
+        yaw = math.radians(self.rotation.yaw)
+        return Vector3D(math.cos(yaw), math.sin(yaw), 0.0)
+
+    def get_right_vector(self):
+        yaw = math.radians(self.rotation.yaw)
+        return Vector3D(-math.sin(yaw), math.cos(yaw), 0.0)
+
+
+class Color:
+    def __init__(self, r=0, g=0, b=0, a=255):
+        self.r = r
+        self.g = g
+        self.b = b
+        self.a = a
+
+
+class WeatherParameters:
+    ClearNoon = 'ClearNoon'
+    HardRainNoon = 'HardRainNoon'
+    CloudyNoon = 'CloudyNoon'
+    ClearNight = 'ClearNight'
+
+
+class LaneType:
+    Driving = 'Driving'
+
+
+class TrafficLightState:
+    Red = 'Red'
+    Yellow = 'Yellow'
+    Green = 'Green'
+
+
+class CityObjectLabel:
+    Any = 'Any'
+    Roads = 'Roads'
+    Sidewalks = 'Sidewalks'
+    Ground = 'Ground'
+    RoadLines = 'RoadLines'
+    Buildings = 'Buildings'
+    Vegetation = 'Vegetation'
+    Terrain = 'Terrain'
+    Sky = 'Sky'
+    Water = 'Water'
+    Bridge = 'Bridge'
+    Poles = 'Poles'
+    GuardRail = 'GuardRail'
+    Fences = 'Fences'
+    Walls = 'Walls'
+    TrafficSigns = 'TrafficSigns'
+    TrafficLight = 'TrafficLight'
+    Other = 'Other'
+
+
+class command:
+    """Batch commands, applied by Client.apply_batch / apply_batch_sync"""
+    class SpawnActor:
+        def __init__(self, blueprint, transform):
+            self.blueprint = blueprint
+            self.transform = transform
+
+    class ApplyTransform:
+        def __init__(self, actor_id, transform):
+            self.actor_id = actor_id
+            self.transform = transform
+
+    class ApplyTargetVelocity:
+        def __init__(self, actor_id, velocity):
+            self.actor_id = actor_id
+            self.velocity = velocity
+
+    class DestroyActor:
+        def __init__(self, actor_id):
+            self.actor_id = actor_id
+
+
+class _CommandResponse:
+    def __init__(self, actor_id=0, error=''):
+        self.actor_id = actor_id
+        self.error = error
+
+    def has_error(self):
+        return bool(self.error)
+
+
+# ============================================================================
+# TRAFFIC ENGINE
+# ============================================================================
+
+class TrafficEngine:
+    """
+    Vectorized IDM traffic on both carriageways.
+
+    Vehicle state lives in parallel arrays indexed by slot; actor ids map to
+    slots. Position s is the distance travelled from the start of the road in
+    the vehicle's own direction, lane 0 is the lane next to the median.
+    """
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.time = 0.0
+        self.frame = 0
+        self.global_speed_pct = 0.0
+        self.global_min_gap = DEFAULT_MIN_GAP
+        self.median_offset = 0.0
+        self.next_exit_time = np.zeros((2, MAX_LANES))
+        self.last_lane_change = 0.0
+
+        self.slot_of = {}
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.forward = np.zeros(0, dtype=bool)
+        self.lane = np.zeros(0, dtype=np.int64)
+        self.s = np.zeros(0)
+        self.v = np.zeros(0)
+        self.z = np.zeros(0)
+        self.speed_pct = np.zeros(0)      # NaN = use the global setting
+        self.min_gap = np.zeros(0)        # NaN = use the global setting
+        self.time_headway = np.zeros(0)
+        self.autopilot = np.zeros(0, dtype=bool)
+        self.lane_change = np.zeros(0, dtype=bool)
+
+        self.barriers = {}          # actor id -> lateral offset at spawn
+        self.barrier_offsets = {}   # actor id -> lateral displacement since spawn
+
+    # --- Geometry ------------------------------------------------------------
+
+    def lane_counts(self):
+        """(forward lanes, backward lanes) for the current median position"""
+        if self.median_offset <= -LANE_WIDTH / 2:
+            return 4, 2
+        if self.median_offset >= LANE_WIDTH / 2:
+            return 2, 4
+        return 3, 3
+
+    def lateral(self, forward, lane):
+        side = np.where(forward, -1.0, 1.0)
+        return self.median_offset + side * (LANE_WIDTH / 2 + LANE_WIDTH * lane)
+
+    def world_xy(self, slots):
+        forward = self.forward[slots]
+        x = np.where(forward, ROAD_X_MIN + self.s[slots], ROAD_X_MAX - self.s[slots])
+        y = ROAD_Y + self.lateral(forward, self.lane[slots])
+        return x, y
+
+    def locate(self, transform):
+        """Map a world transform to (forward, lane, s) on the road"""
+        forward = math.cos(math.radians(transform.rotation.yaw)) >= 0
+        lat = transform.location.y - ROAD_Y
+        n_forward, n_backward = self.lane_counts()
+        if forward:
+            lane = int(math.floor((self.median_offset - lat) / LANE_WIDTH))
+            lane = min(max(lane, 0), n_forward - 1)
+            s = transform.location.x - ROAD_X_MIN
+        else:
+            lane = int(math.floor((lat - self.median_offset) / LANE_WIDTH))
+            lane = min(max(lane, 0), n_backward - 1)
+            s = ROAD_X_MAX - transform.location.x
+        return forward, lane, min(max(s, 0.0), ROAD_LENGTH - 0.01)
+
+    # --- Vehicles ------------------------------------------------------------
+
+    def _grow(self):
+        n = max(64, 2 * len(self.ids))
+        def grow(a, fill):
+            out = np.full(n, fill, dtype=a.dtype)
+            out[:len(a)] = a
+            return out
+        self.ids = grow(self.ids, -1)
+        self.alive = grow(self.alive, False)
+        self.forward = grow(self.forward, True)
+        self.lane = grow(self.lane, 0)
+        self.s = grow(self.s, 0.0)
+        self.v = grow(self.v, 0.0)
+        self.z = grow(self.z, 0.0)
+        self.speed_pct = grow(self.speed_pct, np.nan)
+        self.min_gap = grow(self.min_gap, np.nan)
+        self.time_headway = grow(self.time_headway, IDM_TIME_HEADWAY)
+        self.autopilot = grow(self.autopilot, False)
+        self.lane_change = grow(self.lane_change, False)
+
+    def is_occupied(self, forward, lane, s, clearance=VEHICLE_LENGTH + 1.0):
+        same = self.alive & (self.forward == forward) & (self.lane == lane)
+        return bool(np.any(same & (np.abs(self.s - s) < clearance)))
+
+    def add_vehicle(self, actor_id, transform):
+        forward, lane, s = self.locate(transform)
+        free = np.nonzero(~self.alive & (self.ids == -1))[0]
+        if len(free) == 0:
+            self._grow()
+            free = np.nonzero(~self.alive & (self.ids == -1))[0]
+        slot = int(free[0])
+
+        self.slot_of[actor_id] = slot
+        self.ids[slot] = actor_id
+        self.alive[slot] = True
+        self.forward[slot] = forward
+        self.lane[slot] = lane
+        self.s[slot] = s
+        self.v[slot] = 0.0
+        self.z[slot] = transform.location.z
+        self.speed_pct[slot] = np.nan
+        self.min_gap[slot] = np.nan
+        self.time_headway[slot] = IDM_TIME_HEADWAY * self.rng.uniform(0.8, 1.2)
+        self.autopilot[slot] = False
+        self.lane_change[slot] = False
+
+    def remove_vehicle(self, actor_id):
+        slot = self.slot_of.pop(actor_id, None)
+        if slot is not None:
+            self.alive[slot] = False
+            self.ids[slot] = -1
+
+    def teleport(self, actor_id, transform):
+        slot = self.slot_of[actor_id]
+        forward, lane, s = self.locate(transform)
+        self.forward[slot] = forward
+        self.lane[slot] = lane
+        self.s[slot] = s
+        self.z[slot] = transform.location.z
+
+    def set_velocity(self, actor_id, velocity):
+        # Autopilot vehicles are driven kinematically, as with the Traffic
+        # Manager's hybrid physics mode that test_carla.py enables
+        slot = self.slot_of[actor_id]
+        if not self.autopilot[slot]:
+            self.v[slot] = math.hypot(velocity.x, velocity.y)
+
+    # --- Median barrier ------------------------------------------------------
+
+    def add_barrier(self, actor_id, transform):
+        self.barriers[actor_id] = transform.location.y - ROAD_Y
+
+    def move_barrier(self, actor_id, transform):
+        # Store the displacement; the median offset is the mean over all blocks
+        origin = self.barriers.get(actor_id)
+        if origin is not None:
+            self.barrier_offsets[actor_id] = (transform.location.y - ROAD_Y) - origin
+
+    def remove_barrier(self, actor_id):
+        self.barriers.pop(actor_id, None)
+        self.barrier_offsets.pop(actor_id, None)
+
+    def _update_median(self):
+        if self.barrier_offsets:
+            # Barrier props move along their right vector, which is +y here
+            self.median_offset = float(np.mean(list(self.barrier_offsets.values())))
+        n_forward, n_backward = self.lane_counts()
+        np.minimum(self.lane, np.where(self.forward, n_forward - 1, n_backward - 1), out=self.lane)
+
+    # --- Dynamics ------------------------------------------------------------
+
+    def _desired_speed(self, slots):
+        pct = np.where(np.isnan(self.speed_pct[slots]), self.global_speed_pct, self.speed_pct[slots])
+        return np.maximum(SPEED_LIMIT_KMH / 3.6 * (1.0 - pct / 100.0), 1.0)
+
+    def _idm(self, slots, gap, lead_v):
+        v = self.v[slots]
+        v0 = self._desired_speed(slots)
+        s0 = np.where(np.isnan(self.min_gap[slots]), self.global_min_gap, self.min_gap[slots])
+        dv = v - lead_v
+        s_star = s0 + np.maximum(0.0, v * self.time_headway[slots]
+                                 + v * dv / (2 * math.sqrt(IDM_MAX_ACCEL * IDM_COMFORT_DECEL)))
+        acc = IDM_MAX_ACCEL * (1 - (v / v0)**4 - (s_star / np.maximum(gap, 0.1))**2)
+        return np.clip(acc, -IDM_MAX_DECEL, IDM_MAX_ACCEL)
+
+    def _sorted_groups(self, slots):
+        group = np.where(self.forward[slots], 0, MAX_LANES) + self.lane[slots]
+        keys = group * _GROUP_STRIDE + self.s[slots]
+        order = np.argsort(keys, kind='stable')
+        return slots[order], group[order], keys[order]
+
+    def _leaders(self, sorted_slots, sorted_group):
+        """Gap and speed of each vehicle's leader (the stop line when the exit is metered)"""
+        n = len(sorted_slots)
+        gap = np.full(n, np.inf)
+        lead_v = self.v[sorted_slots].copy()
+        if n == 0:
+            return gap, lead_v
+
+        has_leader = np.zeros(n, dtype=bool)
+        has_leader[:-1] = sorted_group[1:] == sorted_group[:-1]
+        idx = np.nonzero(has_leader)[0]
+        gap[idx] = self.s[sorted_slots[idx + 1]] - self.s[sorted_slots[idx]] - VEHICLE_LENGTH
+        lead_v[idx] = self.v[sorted_slots[idx + 1]]
+
+        # Group leaders see the stop line while their exit lane is metered
+        heads = np.nonzero(~has_leader)[0]
+        direction = (sorted_group[heads] >= MAX_LANES).astype(np.int64)
+        lane = sorted_group[heads] % MAX_LANES
+        metered = self.time < self.next_exit_time[direction, lane]
+        gap[heads[metered]] = ROAD_LENGTH - self.s[sorted_slots[heads[metered]]]
+        lead_v[heads[metered]] = 0.0
+        return gap, lead_v
+
+    def _discharge(self):
+        """Let vehicles that reached the end of the road re-enter at the start"""
+        exiting = np.nonzero(self.alive & (self.s >= ROAD_LENGTH))[0]
+        if len(exiting) == 0:
+            return
+        headway = 3600.0 / BOTTLENECK_CAPACITY
+        n_forward, n_backward = self.lane_counts()
+
+        for slot in exiting[np.argsort(-self.s[exiting])]:
+            direction = 0 if self.forward[slot] else 1
+            lane = self.lane[slot]
+            n_lanes = n_forward if self.forward[slot] else n_backward
+
+            entry_lane = None
+            if self.time >= self.next_exit_time[direction, lane]:
+                # Enter on the lane with the most room at the start of the road
+                same_dir = self.alive & (self.forward == self.forward[slot]) & (np.arange(len(self.s)) != slot)
+                best_room = VEHICLE_LENGTH + DEFAULT_MIN_GAP
+                for candidate in range(n_lanes):
+                    in_lane = same_dir & (self.lane == candidate)
+                    room = self.s[in_lane].min() if np.any(in_lane) else ROAD_LENGTH
+                    if room > best_room:
+                        best_room = room
+                        entry_lane = candidate
+
+            if entry_lane is None:
+                self.s[slot] = ROAD_LENGTH - 0.01
+                self.v[slot] = 0.0
+            else:
+                self.s[slot] = 0.0
+                self.lane[slot] = entry_lane
+                self.next_exit_time[direction, lane] = self.time + headway
+
+    def _change_lanes(self, slots):
+        sorted_slots, sorted_group, sorted_keys = self._sorted_groups(slots)
+        gap, lead_v = self._leaders(sorted_slots, sorted_group)
+        current_acc = self._idm(sorted_slots, gap, lead_v)
+        n_forward, n_backward = self.lane_counts()
+
+        movers = self.autopilot[sorted_slots] & self.lane_change[sorted_slots]
+        best_gain = np.full(len(sorted_slots), LANE_CHANGE_THRESHOLD)
+        best_lane = self.lane[sorted_slots].copy()
+
+        for delta in (-1, 1):
+            target = self.lane[sorted_slots] + delta
+            n_lanes = np.where(self.forward[sorted_slots], n_forward, n_backward)
+            valid = movers & (target >= 0) & (target < n_lanes)
+
+            target_group = np.where(self.forward[sorted_slots], 0, MAX_LANES) + target
+            target_keys = target_group * _GROUP_STRIDE + self.s[sorted_slots]
+            idx = np.searchsorted(sorted_keys, target_keys)
+
+            lead_idx = np.minimum(idx, len(sorted_slots) - 1)
+            has_lead = (idx < len(sorted_slots)) & (sorted_group[lead_idx] == target_group)
+            follow_idx = np.maximum(idx - 1, 0)
+            has_follow = (idx > 0) & (sorted_group[follow_idx] == target_group)
+
+            new_gap = np.where(has_lead, self.s[sorted_slots[lead_idx]] - self.s[sorted_slots] - VEHICLE_LENGTH, np.inf)
+            new_lead_v = np.where(has_lead, self.v[sorted_slots[lead_idx]], self.v[sorted_slots])
+            follow_gap = np.where(has_follow, self.s[sorted_slots] - self.s[sorted_slots[follow_idx]] - VEHICLE_LENGTH, np.inf)
+            follow_v = np.where(has_follow, self.v[sorted_slots[follow_idx]], 0.0)
+
+            safe = (new_gap > DEFAULT_MIN_GAP) & (follow_gap > DEFAULT_MIN_GAP + follow_v * 0.5)
+            gain = self._idm(sorted_slots, new_gap, new_lead_v) - current_acc
+            better = valid & safe & (gain > best_gain)
+            best_gain = np.where(better, gain, best_gain)
+            best_lane = np.where(better, target, best_lane)
+
+        changing = (best_lane != self.lane[sorted_slots]) & (self.rng.random(len(sorted_slots)) < LANE_CHANGE_PROBABILITY)
+        self.lane[sorted_slots[changing]] = best_lane[changing]
+
+    def step(self, dt):
+        self._update_median()
+        slots = np.nonzero(self.alive)[0]
+
+        if len(slots):
+            sorted_slots, sorted_group, _ = self._sorted_groups(slots)
+            gap, lead_v = self._leaders(sorted_slots, sorted_group)
+            acc = self._idm(sorted_slots, gap, lead_v)
+
+            driven = self.autopilot[sorted_slots]
+            moving = sorted_slots[driven]
+            new_v = np.maximum(self.v[moving] + acc[driven] * dt, 0.0)
+            # Never drive through the leader (or the stop line)
+            advance = np.minimum(new_v * dt, np.maximum(gap[driven], 0.0))
+            self.v[moving] = new_v
+            self.s[moving] += advance
+
+            self._discharge()
+
+            if self.time - self.last_lane_change >= LANE_CHANGE_INTERVAL:
+                self._change_lanes(np.nonzero(self.alive)[0])
+                self.last_lane_change = self.time
+
+        self.time += dt
+        self.frame += 1
+        return self.frame
+
+    def state(self, slots):
+        """Location, yaw and velocity arrays for the given slots"""
+        x, y = self.world_xy(slots)
+        forward = self.forward[slots]
+        yaw = np.where(forward, 0.0, 180.0)
+        vx = np.where(forward, self.v[slots], -self.v[slots])
+        return x, y, self.z[slots], yaw, vx, np.zeros(len(slots)), np.zeros(len(slots))
+
+
+# ============================================================================
+# ACTORS
+# ============================================================================
+
+class ActorBlueprint:
+    def __init__(self, bp_id, attributes=None):
+        self.id = bp_id
+        self.tags = bp_id.split('.')
+        self._attributes = attributes or {}
+
+    def get_attribute(self, name):
+        return self._attributes[name]
+
+    def has_attribute(self, name):
+        return name in self._attributes
+
+
+class BlueprintLibrary:
+    VEHICLES = ['vehicle.tesla.model3', 'vehicle.audi.a2', 'vehicle.toyota.prius',
+                'vehicle.nissan.micra', 'vehicle.mercedes.coupe', 'vehicle.ford.mustang']
+    PROPS = ['static.prop.jersey_barrier', 'static.prop.chainbarrier', 'static.prop.streetbarrier']
+
+    def __init__(self):
+        self._blueprints = [ActorBlueprint(name, {'number_of_wheels': '4'}) for name in self.VEHICLES]
+        self._blueprints += [ActorBlueprint(name) for name in self.PROPS]
+
+    def find(self, bp_id):
+        for bp in self._blueprints:
+            if bp.id == bp_id:
+                return bp
+        raise IndexError(f"Blueprint '{bp_id}' not found")
+
+    def filter(self, pattern):
+        prefix = pattern.rstrip('*')
+        return [bp for bp in self._blueprints if bp.id.startswith(prefix)]
+
+    def __iter__(self):
+        return iter(self._blueprints)
+
+
+class Actor:
+    def __init__(self, world, actor_id, type_id, transform):
+        self._world = world
+        self.id = actor_id
+        self.type_id = type_id
+        self._transform = transform
+        self.is_alive = True
+
+    def get_transform(self):
+        return self._transform
+
+    def get_location(self):
+        return self._transform.location
+
+    def get_velocity(self):
+        return Vector3D()
+
+    def set_transform(self, transform):
+        self._transform = transform
+        self._world.engine.move_barrier(self.id, transform)
+
+    def set_simulate_physics(self, enabled=True):
+        pass
+
+    def set_target_velocity(self, velocity):
+        pass
+
+    def destroy(self):
+        if not self.is_alive:
+            return False
+        self.is_alive = False
+        self._world.engine.remove_barrier(self.id)
+        self._world._actors.pop(self.id, None)
+        return True
+
+
+class Vehicle(Actor):
+    def _slot(self):
+        return self._world.engine.slot_of[self.id]
+
+    def get_transform(self):
+        slot = np.array([self._slot()])
+        x, y, z, yaw, _, _, _ = self._world.engine.state(slot)
+        return Transform(Location(float(x[0]), float(y[0]), float(z[0])), Rotation(yaw=float(yaw[0])))
+
+    def get_location(self):
+        return self.get_transform().location
+
+    def get_velocity(self):
+        slot = np.array([self._slot()])
+        _, _, _, _, vx, vy, vz = self._world.engine.state(slot)
+        return Vector3D(float(vx[0]), float(vy[0]), float(vz[0]))
+
+    def set_transform(self, transform):
+        self._world.engine.teleport(self.id, transform)
+
+    def set_target_velocity(self, velocity):
+        self._world.engine.set_velocity(self.id, velocity)
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        self._world.engine.autopilot[self._slot()] = enabled
+
+    def destroy(self):
+        if not self.is_alive:
+            return False
+        self.is_alive = False
+        self._world.engine.remove_vehicle(self.id)
+        self._world._actors.pop(self.id, None)
+        return True
+
+
+class ActorList(list):
+    def filter(self, pattern):
+        prefix = pattern.rstrip('*')
+        return ActorList(a for a in self if a.type_id.startswith(prefix))
+
+
+class ActorSnapshot:
+    def __init__(self, actor_id, transform, velocity):
+        self.id = actor_id
+        self._transform = transform
+        self._velocity = velocity
+
+    def get_transform(self):
+        return self._transform
+
+    def get_velocity(self):
+        return self._velocity
+
+
+class WorldSnapshot:
+    """
+    Frame snapshot. Besides the CARLA find() API it exposes vehicle_arrays(),
+    which hands the engine's arrays over without building per-actor objects.
+    """
+    def __init__(self, world):
+        self._world = world
+        self.frame = world.engine.frame
+        self.timestamp = world.engine.time
+
+    def find(self, actor_id):
+        actor = self._world._actors.get(actor_id)
+        if actor is None:
+            return None
+        return ActorSnapshot(actor_id, actor.get_transform(), actor.get_velocity())
+
+    def vehicle_arrays(self, ids):
+        """(found mask, x, y, z, yaw, vx, vy, vz) for vehicle actor ids"""
+        engine = self._world.engine
+        slots = np.array([engine.slot_of.get(int(i), -1) for i in ids], dtype=np.int64)
+        found = slots >= 0
+        return (found,) + engine.state(slots[found])
+
+
+# ============================================================================
+# MAP
+# ============================================================================
+
+class Waypoint:
+    """Lane-centre waypoint; lane_id 0 is the median line, negative ids forward lanes"""
+    def __init__(self, x, lane_id=0):
+        self.lane_id = lane_id
+        self.road_id = 1
+        self.section_id = 0
+        self.is_junction = False
+        self.lane_type = LaneType.Driving
+        self.lane_width = LANE_WIDTH
+        forward = lane_id <= 0
+        lateral = 0.0 if lane_id == 0 else math.copysign(LANE_WIDTH * (abs(lane_id) - 0.5), lane_id)
+        self.transform = Transform(Location(x, ROAD_Y + lateral, 0.0), Rotation(yaw=0.0 if forward else 180.0))
+        self._x = x
+
+    @property
+    def id(self):
+        return hash((self.road_id, self.lane_id, round(self._x, 2)))
+
+    def _step(self, distance):
+        sign = 1.0 if self.lane_id <= 0 else -1.0
+        x = self._x + sign * distance
+        if not (ROAD_X_MIN <= x <= ROAD_X_MAX):
+            return []
+        return [Waypoint(x, self.lane_id)]
+
+    def next(self, distance):
+        return self._step(distance)
+
+    def previous(self, distance):
+        return self._step(-distance)
+
+    def get_left_lane(self):
+        lane_id = self.lane_id - 1
+        return Waypoint(self._x, lane_id) if lane_id >= -3 else None
+
+    def get_right_lane(self):
+        lane_id = self.lane_id + 1
+        return Waypoint(self._x, lane_id) if lane_id <= 3 else None
+
+
+class Map:
+    name = 'Headless/Highway'
+
+    def get_waypoint(self, location, project_to_road=True, lane_type=LaneType.Driving):
+        x = min(max(location.x, ROAD_X_MIN), ROAD_X_MAX)
+        if not project_to_road and abs(location.y - ROAD_Y) > 3 * LANE_WIDTH:
+            return None
+        return Waypoint(x)
+
+    def get_spawn_points(self):
+        return [Waypoint(x, lane).transform for x in np.arange(ROAD_X_MIN, ROAD_X_MAX, 50.0)
+                for lane in (-3, -2, -1, 1, 2, 3)]
+
+
+# ============================================================================
+# WORLD, CLIENT AND TRAFFIC MANAGER
+# ============================================================================
+
+class WorldSettings:
+    def __init__(self):
+        self.synchronous_mode = False
+        self.fixed_delta_seconds = 0.05
+        self.no_rendering_mode = True
+
+
+class DebugHelper:
+    def draw_line(self, *args, **kwargs):
+        pass
+
+    def draw_point(self, *args, **kwargs):
+        pass
+
+    def draw_string(self, *args, **kwargs):
+        pass
+
+
+class World:
+    def __init__(self, engine):
+        self.engine = engine
+        self.debug = DebugHelper()
+        self._settings = WorldSettings()
+        self._map = Map()
+        self._blueprints = BlueprintLibrary()
+        self._actors = {}
+        self._next_id = 1
+        self._spectator = Actor(self, 0, 'spectator', Transform())
+
+    # --- CARLA API -----------------------------------------------------------
+
+    def get_map(self):
+        return self._map
+
+    def get_blueprint_library(self):
+        return self._blueprints
+
+    def get_spectator(self):
+        return self._spectator
+
+    def get_settings(self):
+        return self._settings
+
+    def apply_settings(self, settings):
+        self._settings = settings
+        return self.engine.frame
+
+    def set_weather(self, weather):
+        self.weather = weather
+
+    def get_environment_objects(self, object_type=CityObjectLabel.Any):
+        return []
+
+    def enable_environment_objects(self, ids, enable):
+        pass
+
+    def get_actor(self, actor_id):
+        return self._actors.get(actor_id)
+
+    def get_actors(self, actor_ids=None):
+        if actor_ids is None:
+            return ActorList(self._actors.values())
+        return ActorList(self._actors[i] for i in actor_ids if i in self._actors)
+
+    def get_snapshot(self):
+        return WorldSnapshot(self)
+
+    def tick(self, seconds=10.0):
+        return self.engine.step(self._settings.fixed_delta_seconds or 0.05)
+
+    def wait_for_tick(self, seconds=10.0):
+        self.tick()
+        return self.get_snapshot()
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        actor = self.try_spawn_actor(blueprint, transform)
+        if actor is None:
+            raise RuntimeError('Spawn failed because of collision at spawn position')
+        return actor
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        actor_id = self._next_id
+        if blueprint.id.startswith('vehicle.'):
+            forward, lane, s = self.engine.locate(transform)
+            if self.engine.is_occupied(forward, lane, s):
+                return None
+            self._next_id += 1
+            self.engine.add_vehicle(actor_id, transform)
+            actor = Vehicle(self, actor_id, blueprint.id, transform)
+        else:
+            self._next_id += 1
+            if 'barrier' in blueprint.id:
+                self.engine.add_barrier(actor_id, transform)
+            actor = Actor(self, actor_id, blueprint.id, transform)
+        self._actors[actor_id] = actor
+        return actor
+
+    # --- Batch commands ------------------------------------------------------
+
+    def _apply(self, cmd):
+        if isinstance(cmd, command.SpawnActor):
+            actor = self.try_spawn_actor(cmd.blueprint, cmd.transform)
+            if actor is None:
+                return _CommandResponse(error='Spawn failed because of collision at spawn position')
+            return _CommandResponse(actor.id)
+
+        actor = self._actors.get(cmd.actor_id)
+        if actor is None:
+            return _CommandResponse(cmd.actor_id, f'Actor {cmd.actor_id} not found')
+        if isinstance(cmd, command.ApplyTransform):
+            actor.set_transform(cmd.transform)
+        elif isinstance(cmd, command.ApplyTargetVelocity):
+            actor.set_target_velocity(cmd.velocity)
+        elif isinstance(cmd, command.DestroyActor):
+            actor.destroy()
+        return _CommandResponse(cmd.actor_id)
+
+
+class TrafficManager:
+    def __init__(self, engine, port):
+        self.engine = engine
+        self.port = port
+
+    def _slot(self, actor):
+        return self.engine.slot_of[actor.id]
+
+    def get_port(self):
+        return self.port
+
+    def set_synchronous_mode(self, mode=True):
+        pass
+
+    def set_hybrid_physics_mode(self, enabled=False):
+        pass
+
+    def set_hybrid_physics_radius(self, radius=50.0):
+        pass
+
+    def set_respawn_dormant_vehicles(self, enabled=False):
+        pass
+
+    def set_random_device_seed(self, seed):
+        self.engine.rng = np.random.default_rng(seed)
+
+    def global_percentage_speed_difference(self, percentage):
+        self.engine.global_speed_pct = percentage
+
+    def set_global_distance_to_leading_vehicle(self, distance):
+        self.engine.global_min_gap = distance
+
+    def vehicle_percentage_speed_difference(self, actor, percentage):
+        self.engine.speed_pct[self._slot(actor)] = percentage
+
+    def distance_to_leading_vehicle(self, actor, distance):
+        self.engine.min_gap[self._slot(actor)] = distance
+
+    def auto_lane_change(self, actor, enable):
+        self.engine.lane_change[self._slot(actor)] = enable
+
+    def ignore_lights_percentage(self, actor, percentage):
+        pass
+
+    def ignore_signs_percentage(self, actor, percentage):
+        pass
+
+    def keep_right_rule_percentage(self, actor, percentage):
+        pass
+
+
+class Client:
+    """Drop-in for carla.Client; every client in a process shares one engine"""
+    _world = None
+
+    def __init__(self, host='localhost', port=2000, worker_threads=0):
+        self.host = host
+        self.port = port
+
+    def set_timeout(self, seconds):
+        pass
+
+    def get_server_version(self):
+        return 'headless'
+
+    def get_client_version(self):
+        return 'headless'
+
+    def load_world(self, map_name='Town05', reset_settings=True):
+        Client._world = World(TrafficEngine(seed=random.randrange(2**32)))
+        return Client._world
+
+    def get_world(self):
+        if Client._world is None:
+            return self.load_world()
+        return Client._world
+
+    def get_trafficmanager(self, port=8000):
+        return TrafficManager(self.get_world().engine, port)
+
+    def apply_batch(self, commands, do_tick=False):
+        world = self.get_world()
+        for cmd in commands:
+            world._apply(cmd)
+        if do_tick:
+            world.tick()
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        world = self.get_world()
+        responses = [world._apply(cmd) for cmd in commands]
+        if do_tick:
+            world.tick()
+        return responses
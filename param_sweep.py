@@ -0,0 +1,268 @@
+"""
+Parameter Sweep Runner
+Grid or random search over the median shift policy constants
+
+Each run is one headless session of test_carla.main() with the policy
+constants (CONGESTION_THRESHOLD, SPEED_THRESHOLD, MONITOR_DISTANCE,
+MIN_TIME_BETWEEN_SHIFTS) overridden in the worker process. Runs are spread
+over a process pool; every run gets its own seed derived from the sweep
+seed, so results do not depend on which worker picked the run up.
+
+The metrics_data dicts returned by main() are flattened into one columnar
+table (one array per column) and saved as sweep_results.npz and
+sweep_results.csv in the output directory.
+
+Usage:
+    python param_sweep.py --grid --replications 3
+    python param_sweep.py --random 200 --workers 16 --duration 300
+"""
+
+import argparse
+import contextlib
+import csv
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+
+# Values tried by --grid
+GRID_SPACE = {
+    'CONGESTION_THRESHOLD': [10, 15, 20, 25],
+    'SPEED_THRESHOLD': [3.0, 5.0, 8.0],
+    'MONITOR_DISTANCE': [200.0, 300.0, 400.0],
+    'MIN_TIME_BETWEEN_SHIFTS': [10.0, 20.0, 40.0],
+}
+
+# (low, high) ranges sampled by --random; int bounds sample integers
+RANDOM_SPACE = {
+    'CONGESTION_THRESHOLD': (5, 30),
+    'SPEED_THRESHOLD': (2.0, 10.0),
+    'MONITOR_DISTANCE': (100.0, 600.0),
+    'MIN_TIME_BETWEEN_SHIFTS': (5.0, 60.0),
+}
+
+SUMMARY_COLUMNS = [
+    'simulation_stats.mode_changes',
+    'simulation_stats.congestion_events',
+    'simulation_stats.avg_speed_3_3_kmh',
+    'simulation_stats.avg_speed_4_2_kmh',
+    'simulation_stats.time_in_4_2_mode',
+]
+
+
+def grid_configs(space=GRID_SPACE):
+    """Every combination of the values in space"""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def random_configs(n, space=RANDOM_SPACE, seed=None):
+    """n configurations sampled uniformly from the ranges in space"""
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(n):
+        config = {}
+        for name, (low, high) in space.items():
+            if isinstance(low, int) and isinstance(high, int):
+                config[name] = rng.randint(low, high)
+            else:
+                config[name] = round(rng.uniform(low, high), 2)
+        configs.append(config)
+    return configs
+
+
+def build_runs(configs, replications=1, seed=0):
+    """
+    Expand configurations into runs with independent per-run seeds.
+
+    Returns:
+        list: dicts with run_id, config_id, replication, seed and params
+    """
+    seeds = np.random.SeedSequence(seed).generate_state(len(configs) * replications)
+    runs = []
+    for config_id, params in enumerate(configs):
+        for replication in range(replications):
+            run_id = len(runs)
+            runs.append({
+                'run_id': run_id,
+                'config_id': config_id,
+                'replication': replication,
+                'seed': int(seeds[run_id]),
+                'params': params,
+            })
+    return runs
+
+
+def _init_worker():
+    # Must happen before the worker first imports test_carla
+    os.environ['MEDIAN_SIM_BACKEND'] = 'headless'
+
+
+def _flatten(data, prefix=''):
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float, str, bool)) or value is None:
+            flat[name] = value
+    return flat
+
+
+def run_one(run, duration, trace_dir=None):
+    """Run one session in this (worker) process and return a flat result row"""
+    import test_carla
+
+    for name, value in run['params'].items():
+        setattr(test_carla, name, value)
+
+    data_file = os.path.join(trace_dir, f"run_{run['run_id']:05d}.csv") if trace_dir else os.devnull
+    row = {
+        'run_id': run['run_id'],
+        'config_id': run['config_id'],
+        'replication': run['replication'],
+        'seed': run['seed'],
+    }
+    row.update({f"param.{name}": value for name, value in run['params'].items()})
+
+    start = time.time()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            metrics = test_carla.main(duration=duration, seed=run['seed'], results_file=None,
+                                      data_file=data_file, dashboard=False)
+        row.update(_flatten(metrics))
+        row['error'] = ''
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+    row['wall_time_seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def to_columns(rows):
+    """Turn result rows into {column: numpy array}; missing cells become NaN / ''"""
+    names = []
+    for row in rows:
+        for name in row:
+            if name not in names:
+                names.append(name)
+
+    columns = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        present = [v for v in values if v is not None]
+        if present and all(isinstance(v, (int, float, bool)) for v in present):
+            columns[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        else:
+            columns[name] = np.array(['' if v is None else str(v) for v in values])
+    return columns
+
+
+def save_columns(columns, out_dir):
+    """Write the table as sweep_results.npz (columnar) and sweep_results.csv"""
+    npz_path = os.path.join(out_dir, 'sweep_results.npz')
+    np.savez(npz_path, **columns)
+
+    csv_path = os.path.join(out_dir, 'sweep_results.csv')
+    names = list(columns)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*(columns[name].tolist() for name in names)))
+    return npz_path, csv_path
+
+
+def summarize(columns, objective='simulation_stats.congestion_events', top=10):
+    """Print the best configurations by mean objective over replications (lower is better)"""
+    if objective not in columns or len(columns[objective]) == 0:
+        print(f"No '{objective}' column to rank by")
+        return
+
+    config_ids = columns['config_id'].astype(np.int64)
+    ok = columns['error'] == ''
+    ids = np.unique(config_ids[ok])
+    if len(ids) == 0:
+        print("All runs failed")
+        return
+
+    means = np.array([np.nanmean(columns[objective][ok & (config_ids == i)]) for i in ids])
+    param_names = [name for name in columns if name.startswith('param.')]
+
+    print(f"\nTop {min(top, len(ids))} configurations by mean {objective}:")
+    for rank, k in enumerate(np.argsort(means)[:top], 1):
+        first = np.nonzero(config_ids == ids[k])[0][0]
+        params = ', '.join(f"{name[6:]}={columns[name][first]:g}" for name in param_names)
+        extras = ' | '.join(f"{name.split('.')[-1]}={np.nanmean(columns[name][ok & (config_ids == ids[k])]):.2f}"
+                            for name in SUMMARY_COLUMNS if name in columns and name != objective)
+        print(f"  {rank:2d}. {objective.split('.')[-1]}={means[k]:.2f} | {params}")
+        print(f"      {extras}")
+
+
+def run_sweep(configs, replications=1, duration=300.0, workers=None, seed=0, out_dir=None, keep_traces=False):
+    """
+    Run every configuration `replications` times across a process pool.
+
+    Returns:
+        dict: Columnar results table {column: numpy array}
+    """
+    out_dir = out_dir or f"sweep_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    os.makedirs(out_dir, exist_ok=True)
+    trace_dir = None
+    if keep_traces:
+        trace_dir = os.path.join(out_dir, 'traces')
+        os.makedirs(trace_dir, exist_ok=True)
+
+    runs = build_runs(configs, replications, seed)
+    workers = workers or os.cpu_count() or 1
+    print(f"Sweep: {len(configs)} configurations x {replications} replications = {len(runs)} runs "
+          f"on {workers} workers ({duration:.0f}s each)")
+
+    rows = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(run_one, run, duration, trace_dir) for run in runs]
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            rows.append(row)
+            status = row['error'] or 'ok'
+            print(f"[{done}/{len(runs)}] run {row['run_id']} (config {row['config_id']}) "
+                  f"{row['wall_time_seconds']:.1f}s {status}")
+
+    rows.sort(key=lambda r: r['run_id'])
+    columns = to_columns(rows)
+    npz_path, csv_path = save_columns(columns, out_dir)
+    print(f"\nCompleted {len(runs)} runs in {time.time() - start:.1f}s")
+    print(f"Results saved to {npz_path} and {csv_path}")
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep the median shift policy parameters (headless)")
+    search = parser.add_mutually_exclusive_group()
+    search.add_argument('--grid', action='store_true', help="Full grid over GRID_SPACE (default)")
+    search.add_argument('--random', type=int, metavar='N', help="N random configurations from RANDOM_SPACE")
+    parser.add_argument('--replications', type=int, default=1, help="Runs per configuration")
+    parser.add_argument('--duration', type=float, default=300.0, help="Simulated seconds per run")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--seed', type=int, default=0, help="Sweep seed (sampling and per-run seeds)")
+    parser.add_argument('--out', default=None, help="Output directory")
+    parser.add_argument('--keep-traces', action='store_true', help="Keep the per-second CSV of every run")
+    parser.add_argument('--objective', default='simulation_stats.congestion_events',
+                        help="Column to rank configurations by (lower is better)")
+    args = parser.parse_args()
+
+    if args.random:
+        configs = random_configs(args.random, seed=args.seed)
+    else:
+        configs = grid_configs()
+
+    columns = run_sweep(configs, args.replications, args.duration, args.workers, args.seed,
+                        args.out, args.keep_traces)
+    summarize(columns, args.objective)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+"""
+Simulation Results Store
+Append-only JSON Lines file with a fixed-size offset index
+
+Replaces the rewrite-everything simulation_results.json:
+    simulation_results.jsonl     one metrics dict per line, appended
+    simulation_results.idx       one (offset, length, session_id) record per line
+    simulation_results.agg.json  running aggregates of SUMMARY_FIELDS
+
+Appending writes the line first and its index record second, so readers
+(the dashboard, in another process) only ever see complete records. Readers
+keep the index in memory and pick up new records by reading just the tail
+of the .idx file, so fetching the latest run, a page of history or a run by
+session_id costs the same with ten runs or ten thousand.
+
+The aggregates (count, sum, sum of squares, min/max and P-square
+streaming quantiles) are folded forward on every append, so summary()
+answers in constant time however many runs are stored.
+
+An existing simulation_results.json is imported on first use. Appends
+and index repairs hold an exclusive lock on simulation_results.lock, so
+several simulator processes can share one store.
+"""
+
+import contextlib
+import json
+import math
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    import msvcrt
+    fcntl = None
+
+_INDEX_RECORD = struct.Struct('<QI32s')  # byte offset, byte length, session_id (utf-8, NUL padded)
+
+# metrics.<field> values summarized by ResultsStore.summary()
+SUMMARY_FIELDS = [
+    'trip_time_improvement_percent',
+    'fuel_improvement_percent',
+    'trip_time_saved_minutes',
+    'time_response_seconds',
+]
+SUMMARY_QUANTILES = (0.1, 0.5, 0.9)
+
+# Two-sided 95% Student t critical values by degrees of freedom (1.96 beyond 30)
+_T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+class P2Quantile:
+    """
+    P-square streaming quantile estimate (Jain & Chlamtac, 1985).
+
+    The first EXACT_LIMIT values are kept and answered exactly; after that
+    the five markers are seeded from their order statistics and updated in
+    O(1) per value, with no stored observations.
+    """
+    EXACT_LIMIT = 64
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.values = []      # Exact phase only
+        self.heights = []
+        self.positions = []
+        self.desired = []
+
+    def _fractions(self):
+        return [0.0, self.p / 2, self.p, (1 + self.p) / 2, 1.0]
+
+    def _seed_markers(self):
+        ordered = sorted(self.values)
+        n = len(ordered)
+        self.desired = [1 + (n - 1) * f for f in self._fractions()]
+        self.positions = [int(round(d)) for d in self.desired]
+        self.heights = [ordered[i - 1] for i in self.positions]
+        self.values = []
+
+    def add(self, x):
+        self.count += 1
+        if self.count <= self.EXACT_LIMIT:
+            self.values.append(x)
+            if self.count == self.EXACT_LIMIT:
+                self._seed_markers()
+            return
+
+        q, n = self.heights, self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i, f in enumerate(self._fractions()):
+            self.desired[i] += f
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.values:
+            ordered = sorted(self.values)
+            rank = self.p * (len(ordered) - 1)
+            lo = int(math.floor(rank))
+            hi = min(lo + 1, len(ordered) - 1)
+            return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+        return self.heights[2]
+
+    def to_dict(self):
+        return {'p': self.p, 'count': self.count, 'values': self.values, 'heights': self.heights,
+                'positions': self.positions, 'desired': self.desired}
+
+    @classmethod
+    def from_dict(cls, data):
+        quantile = cls(data['p'])
+        quantile.count = data['count']
+        quantile.values = data['values']
+        quantile.heights = data['heights']
+        quantile.positions = data['positions']
+        quantile.desired = data['desired']
+        return quantile
+
+
+class RunningStats:
+    """Count, sum, sum of squares, min/max and streaming quantiles of one field"""
+    def __init__(self, quantiles=SUMMARY_QUANTILES):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = None
+        self.max = None
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x):
+        x = float(x)
+        self.count += 1
+        self.total += x
+        self.total_sq += x * x
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        mean = self.total / self.count
+        std = 0.0
+        ci95 = [mean, mean]
+        if self.count > 1:
+            variance = max(self.total_sq - self.total * mean, 0.0) / (self.count - 1)
+            std = math.sqrt(variance)
+            t = _T95[self.count - 2] if self.count - 1 <= len(_T95) else 1.96
+            half_width = t * std / math.sqrt(self.count)
+            ci95 = [mean - half_width, mean + half_width]
+        result = {
+            'count': self.count,
+            'sum': round(self.total, 4),
+            'sum_sq': round(self.total_sq, 4),
+            'mean': round(mean, 4),
+            'std': round(std, 4),
+            'ci95': [round(ci95[0], 4), round(ci95[1], 4)],
+            'min': self.min,
+            'max': self.max,
+        }
+        for quantile in self.quantiles:
+            result[f"p{int(round(quantile.p * 100))}"] = round(quantile.value(), 4)
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.total, 'sum_sq': self.total_sq,
+                'min': self.min, 'max': self.max, 'quantiles': [q.to_dict() for q in self.quantiles]}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(quantiles=())
+        stats.count = data['count']
+        stats.total = data['sum']
+        stats.total_sq = data['sum_sq']
+        stats.min = data['min']
+        stats.max = data['max']
+        stats.quantiles = [P2Quantile.from_dict(q) for q in data['quantiles']]
+        return stats
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Exclusive lock across processes, held for the with block"""
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ResultsStore:
+    """
+    Args:
+        base_path (str): Path without extension ('simulation_results');
+            '.jsonl' and '.idx' are appended, '.json' is the legacy file
+    """
+    def __init__(self, base_path='simulation_results'):
+        base_path = os.path.splitext(base_path)[0]
+        self.data_file = base_path + '.jsonl'
+        self.index_file = base_path + '.idx'
+        self.legacy_file = base_path + '.json'
+        self.aggregate_file = base_path + '.agg.json'
+        self.lock_file = base_path + '.lock'
+        self.lock = threading.RLock()  # Re-entered by append() -> refresh()
+
+        self.offsets = []
+        self.lengths = []
+        self.by_session = {}  # session_id -> position of its latest record
+        self._index_size = 0
+
+        self._aggregates = None       # (records folded, {field: RunningStats})
+        self._aggregate_mtime = None
+        self._summary_cache = None    # (cache key, summary dict)
+
+        if not os.path.exists(self.data_file):
+            self._import_legacy()
+        self._repair_index()
+
+    # --- Index maintenance ---------------------------------------------------
+
+    def _import_legacy(self):
+        if not os.path.exists(self.legacy_file):
+            return
+        try:
+            with open(self.legacy_file, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(history, list):
+            return
+        print(f"Importing {len(history)} runs from {self.legacy_file} into {self.data_file}")
+        for record in history:
+            self.append(record)
+
+    def _repair_index(self):
+        """Re-index lines written after the last complete index record (crash between the two writes)"""
+        if not os.path.exists(self.data_file):
+            self.refresh()
+            return
+        with self.lock, _file_lock(self.lock_file):
+            self.refresh()
+            indexed_end = self.offsets[-1] + self.lengths[-1] if self.offsets else 0
+            if os.path.getsize(self.data_file) <= indexed_end:
+                return
+
+            with open(self.data_file, 'rb') as f:
+                f.seek(indexed_end)
+                offset = indexed_end
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Torn final line; the next append starts on a fresh line
+                    try:
+                        session_id = json.loads(line).get('session_id')
+                    except ValueError:
+                        session_id = None
+                    self._write_index(offset, len(line), session_id)
+                    offset += len(line)
+            self.refresh()
+
+    def _write_index(self, offset, length, session_id):
+        key = (session_id or '').encode('utf-8')[:32]
+        with open(self.index_file, 'ab') as f:
+            f.write(_INDEX_RECORD.pack(offset, length, key))
+
+    def refresh(self):
+        """Load index records appended (by any process) since the last call"""
+        if not os.path.exists(self.index_file):
+            return
+        with self.lock:  # Two threads reading the same tail would index it twice
+            size = os.path.getsize(self.index_file)
+            size -= size % _INDEX_RECORD.size
+            if size <= self._index_size:
+                return
+            with open(self.index_file, 'rb') as f:
+                f.seek(self._index_size)
+                data = f.read(size - self._index_size)
+            for offset, length, key in _INDEX_RECORD.iter_unpack(data):
+                if key.rstrip(b'\0'):
+                    self.by_session[key.rstrip(b'\0').decode('utf-8', 'replace')] = len(self.offsets)
+                self.offsets.append(offset)
+                self.lengths.append(length)
+            self._index_size = size
+
+    # --- Public API ----------------------------------------------------------
+
+    def append(self, record):
+        """Append one metrics dict; returns its position"""
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock, _file_lock(self.lock_file):
+            with open(self.data_file, 'a+b') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                if offset:
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':  # Finish a torn line left by a crash
+                        f.write(b'\n')
+                        offset += 1
+                f.write(line)
+            self._write_index(offset, len(line), record.get('session_id'))
+            self.refresh()
+            self._save_aggregates()
+            return len(self.offsets) - 1
+
+    def __len__(self):
+        self.refresh()
+        return len(self.offsets)
+
+    def get(self, position):
+        """Record at a position (negative counts from the newest)"""
+        self.refresh()
+        offset, length = self.offsets[position], self.lengths[position]
+        with open(self.data_file, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def latest(self):
+        """Most recent record, or None"""
+        return self.get(-1) if len(self) else None
+
+    def find(self, session_id):
+        """Latest record with this session_id, or None"""
+        self.refresh()
+        position = self.by_session.get(session_id)
+        return self.get(position) if position is not None else None
+
+    def page(self, offset=0, limit=50):
+        """Records [offset, offset + limit) in chronological order, read in one pass"""
+        self.refresh()
+        positions = range(max(offset, 0), min(offset + limit, len(self.offsets)))
+        if not positions:
+            return []
+        start = self.offsets[positions[0]]
+        end = self.offsets[positions[-1]] + self.lengths[positions[-1]]
+        with open(self.data_file, 'rb') as f:
+            f.seek(start)
+            block = f.read(end - start)
+        return [json.loads(block[self.offsets[p] - start:self.offsets[p] - start + self.lengths[p]])
+                for p in positions]
+
+    def position_at_time(self, timestamp):
+        """
+        First position whose 'timestamp' is >= timestamp (ISO 8601 string).
+
+        Runs are appended in time order, so this is a binary search that
+        parses about log2(n) records.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (self.get(mid).get('timestamp') or '') < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def version(self):
+        """Changes whenever a run is appended or the store is replaced"""
+        try:
+            mtime = os.stat(self.index_file).st_mtime_ns
+        except OSError:
+            mtime = 0
+        return len(self), mtime
+
+    def iter_records(self, batch=500):
+        """Every record, oldest first"""
+        total = len(self)
+        for offset in range(0, total, batch):
+            yield from self.page(offset, batch)
+
+    # --- Aggregates ----------------------------------------------------------
+
+    def _load_aggregates(self):
+        """Aggregates from disk when the file changed, else the in-memory copy"""
+        try:
+            mtime = os.path.getmtime(self.aggregate_file)
+        except OSError:
+            mtime = None
+
+        if self._aggregates is None or mtime != self._aggregate_mtime:
+            folded, fields = 0, {name: RunningStats() for name in SUMMARY_FIELDS}
+            if mtime is not None:
+                try:
+                    with open(self.aggregate_file, 'r') as f:
+                        data = json.load(f)
+                    loaded = {name: RunningStats.from_dict(stats) for name, stats in data['fields'].items()}
+                    if set(loaded) == set(SUMMARY_FIELDS):
+                        folded, fields = data['records'], loaded
+                except (OSError, ValueError, KeyError, TypeError):
+                    pass
+            self._aggregates = (folded, fields)
+            self._aggregate_mtime = mtime
+        return self._aggregates
+
+    def _fold_new_records(self):
+        """Bring the aggregates up to the current index; returns True if anything changed"""
+        self.refresh()
+        folded, fields = self._load_aggregates()
+        if folded > len(self.offsets):  # Store was reset underneath us
+            folded, fields = 0, {name: RunningStats() for name in SUMMARY_FIELDS}
+        if folded == len(self.offsets):
+            self._aggregates = (folded, fields)
+            return False
+
+        for offset in range(folded, len(self.offsets), 500):
+            for record in self.page(offset, 500):
+                metrics = record.get('metrics', {})
+                for name, stats in fields.items():
+                    value = metrics.get(name)
+                    if isinstance(value, (int, float)):
+                        stats.add(value)
+        self._aggregates = (len(self.offsets), fields)
+        return True
+
+    def _save_aggregates(self):
+        if not self._fold_new_records():
+            return
+        folded, fields = self._aggregates
+        data = {'records': folded, 'fields': {name: stats.to_dict() for name, stats in fields.items()}}
+        tmp_path = self.aggregate_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.aggregate_file)
+        self._aggregate_mtime = os.path.getmtime(self.aggregate_file)
+
+    def summary(self):
+        """
+        Per-field statistics over every stored run.
+
+        Returns:
+            dict: {'count': runs, 'fields': {field: {count, sum, sum_sq, mean,
+                std, ci95, min, max, p10, p50, p90}}}
+        """
+        with self.lock:  # Concurrent folds would add the same records twice
+            self.refresh()
+            try:
+                mtime = os.path.getmtime(self.aggregate_file)
+            except OSError:
+                mtime = None
+            key = (len(self.offsets), mtime)
+            if self._summary_cache is not None and self._summary_cache[0] == key:
+                return self._summary_cache[1]
+
+            self._fold_new_records()
+            folded, fields = self._aggregates
+            summary = {'count': folded, 'fields': {name: stats.summary() for name, stats in fields.items()}}
+            self._summary_cache = (key, summary)
+            return summary
@@ -0,0 +1,567 @@
+"""
+Simulator <-> Dashboard Channels
+State: fixed-layout shared-memory ring buffer with a JSON file fallback
+Commands: append-only, sequence-numbered journal with acknowledgements
+
+test_carla.py publishes one state dict per tick and dashboard_server.py
+polls for the newest one. Each ring slot is guarded by a sequence number
+written before and after the payload, so a reader never sees a torn state.
+When shared memory is unavailable the channel falls back to the old
+simulation_state.json file.
+
+A second ring carries packed per-vehicle frames (id, position, speed and
+lane slot, quantized to centimetres) for the dashboard's live view.
+
+Dashboard commands are appended as JSON lines to dashboard_commands.jsonl;
+the simulator drains every complete line it has not seen yet once per tick
+and appends one acknowledgement per command to dashboard_acks.jsonl.
+
+Simulators started by the dashboard's session manager get their own set of
+channels, named by channel_names(session).
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY_AVAILABLE = True
+except ImportError:  # Python < 3.8
+    shared_memory = None
+    SHARED_MEMORY_AVAILABLE = False
+
+STATE_CHANNEL_NAME = 'median_sim_state'
+STATE_SLOT_SIZE = 16384   # bytes of JSON payload per slot
+STATE_SLOT_COUNT = 8      # states kept in the ring
+STATE_FILE_STALE_AFTER = 5.0  # seconds without a new state (ring or file) before the simulator counts as gone
+ATTACH_RETRY_MIN = 0.05   # seconds between attach attempts while no segment exists, doubling...
+ATTACH_RETRY_MAX = 1.0    # ...up to this
+
+FRAME_CHANNEL_NAME = 'median_sim_frames'
+FRAME_SLOT_SIZE = 65536   # bytes per packed vehicle frame (4095 vehicles)
+FRAME_SLOT_COUNT = 4
+
+_MAGIC = b'MSIM'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIIIQI4x')   # magic, version, slot_size, slot_count, head_seq, closed
+_HEAD_SEQ_OFFSET = 16
+_CLOSED_OFFSET = 24
+_SLOT_HEADER = struct.Struct('<QI4x')   # seq, payload length
+_SLOT_TRAILER = struct.Struct('<Q')     # seq again, written after the payload
+
+# Packed vehicle frame: header, then one VEHICLE_FRAME_DTYPE record per vehicle
+_FRAME_HEADER = struct.Struct('<IdI')   # frame number, simulation time (s), vehicle count
+VEHICLE_FRAME_DTYPE = np.dtype([
+    ('id', '<u4'),
+    ('x', '<i4'),       # cm
+    ('y', '<i4'),       # cm
+    ('speed', '<u2'),   # cm/s
+    ('lane', 'u1'),     # lane slot from classify_lanes: 0-3 forward, 4-7 backward, 8 unclassified
+    ('pad', 'u1'),
+])
+
+
+def channel_names(session=None, base_dir='.'):
+    """
+    File and shared-memory names of one simulator's channels.
+
+    Args:
+        session (str): Session id of a managed simulator; None keeps the
+            single-simulator names, so a plain test_carla.py run and the
+            dashboard still find each other
+        base_dir (str): Directory for the state, command and ack files
+
+    Returns:
+        dict: state_file, command_file, ack_file, state_channel, frame_channel
+    """
+    suffix = f"_{session}" if session else ''
+    return {
+        'state_file': os.path.join(base_dir, f'simulation_state{suffix}.json'),
+        'command_file': os.path.join(base_dir, f'dashboard_commands{suffix}.jsonl'),
+        'ack_file': os.path.join(base_dir, f'dashboard_acks{suffix}.jsonl'),
+        'state_channel': STATE_CHANNEL_NAME + suffix,
+        'frame_channel': FRAME_CHANNEL_NAME + suffix,
+    }
+
+
+def _segment_size(slot_size, slot_count):
+    return _HEADER.size + slot_count * (_SLOT_HEADER.size + slot_size + _SLOT_TRAILER.size)
+
+
+def _attach_without_tracking(name):
+    """Attach to an existing segment without letting this process unlink it on exit"""
+    shm = shared_memory.SharedMemory(name=name, create=False)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def _write_json_file(path, data):
+    """Write JSON atomically so readers never see a half-written file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class _RingWriter:
+    """
+    Writer side of a shared-memory ring of byte payloads.
+
+    Args:
+        name (str): Shared-memory segment name
+        slot_size (int): Maximum payload bytes per slot
+        slot_count (int): Payloads kept in the ring
+    """
+    def __init__(self, name, slot_size, slot_count):
+        self.name = name
+        self.slot_size = slot_size
+        self.slot_count = slot_count
+        self.seq = 0
+        self.shm = None
+
+        if SHARED_MEMORY_AVAILABLE:
+            try:
+                self.shm = self._open_segment()
+            except Exception as e:
+                print(f"Warning: Shared-memory channel '{name}' unavailable ({e})")
+                self.shm = None
+
+    def _open_segment(self):
+        size = _segment_size(self.slot_size, self.slot_count)
+        try:
+            shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a previous run (or still held by the dashboard): reuse if it fits
+            shm = shared_memory.SharedMemory(name=self.name, create=False)
+            if shm.size < size:
+                shm.close()
+                shm.unlink()
+                shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+
+        shm.buf[:size] = bytes(size)
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, _VERSION, self.slot_size, self.slot_count, 0, 0)
+        return shm
+
+    @property
+    def using_shared_memory(self):
+        return self.shm is not None
+
+    def write(self, payload):
+        """Publish one payload; returns False if there is no segment or it does not fit a slot"""
+        if self.shm is None or len(payload) > self.slot_size:
+            return False
+
+        self.seq += 1
+        stride = _SLOT_HEADER.size + self.slot_size + _SLOT_TRAILER.size
+        offset = _HEADER.size + (self.seq % self.slot_count) * stride
+        payload_offset = offset + _SLOT_HEADER.size
+        trailer_offset = payload_offset + self.slot_size
+
+        buf = self.shm.buf
+        _SLOT_TRAILER.pack_into(buf, trailer_offset, 0)  # Invalidate the slot first
+        _SLOT_HEADER.pack_into(buf, offset, self.seq, len(payload))
+        buf[payload_offset:payload_offset + len(payload)] = payload
+        _SLOT_TRAILER.pack_into(buf, trailer_offset, self.seq)
+        struct.pack_into('<Q', buf, _HEAD_SEQ_OFFSET, self.seq)
+        return True
+
+    def close(self):
+        """Tell readers the writer is gone and release the segment"""
+        if self.shm is not None:
+            try:
+                struct.pack_into('<I', self.shm.buf, _CLOSED_OFFSET, 1)
+                self.shm.close()
+                self.shm.unlink()
+            except Exception:
+                pass
+            self.shm = None
+
+
+class _RingReader:
+    """
+    Reader side of a shared-memory ring. read() returns the newest payload
+    when one has been written since the last call, otherwise None.
+
+    Attach attempts back off from ATTACH_RETRY_MIN to ATTACH_RETRY_MAX while
+    no segment exists. With stale_after set, a ring whose head has not moved
+    for that many seconds (a writer that died without close()) is detached
+    and `connected` drops to False.
+    """
+    def __init__(self, name, stale_after=None):
+        self.name = name
+        self.stale_after = stale_after
+        self.shm = None
+        self.last_seq = 0
+        self.last_advance = 0.0
+        self.connected = False
+        self.retry_interval = ATTACH_RETRY_MIN
+        self.next_attach = 0.0
+
+    def _attach(self):
+        if not SHARED_MEMORY_AVAILABLE:
+            return False
+        now = time.monotonic()
+        if now < self.next_attach:
+            return False
+        try:
+            shm = _attach_without_tracking(self.name)
+        except (FileNotFoundError, OSError, ValueError):
+            shm = None
+
+        if shm is not None:
+            magic, version, slot_size, slot_count, _, closed = _HEADER.unpack_from(shm.buf, 0)
+            if magic != _MAGIC or version != _VERSION or closed:
+                shm.close()
+                shm = None
+        if shm is None:
+            self.next_attach = now + self.retry_interval
+            self.retry_interval = min(self.retry_interval * 2, ATTACH_RETRY_MAX)
+            return False
+
+        self.shm = shm
+        self.slot_size = slot_size
+        self.slot_count = slot_count
+        self.last_seq = 0
+        self.last_advance = now
+        self.retry_interval = ATTACH_RETRY_MIN
+        return True
+
+    def _detach(self):
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except Exception:
+                pass
+            self.shm = None
+
+    def read(self):
+        """Return the newest unseen payload as bytes, or None"""
+        if self.shm is None and not self._attach():
+            return None
+
+        if struct.unpack_from('<I', self.shm.buf, _CLOSED_OFFSET)[0]:
+            self._detach()
+            self.connected = False
+            return None
+
+        buf = self.shm.buf
+
+        for _ in range(3):  # Retry if the writer lapped us mid-read
+            head_seq = struct.unpack_from('<Q', buf, _HEAD_SEQ_OFFSET)[0]
+            if head_seq == 0 or head_seq == self.last_seq:
+                if self.stale_after is not None and time.monotonic() - self.last_advance > self.stale_after:
+                    # The writer stopped without closing the ring; look for a new one
+                    self._detach()
+                    self.connected = False
+                    self.next_attach = time.monotonic() + self.retry_interval
+                return None
+
+            stride = _SLOT_HEADER.size + self.slot_size + _SLOT_TRAILER.size
+            offset = _HEADER.size + (head_seq % self.slot_count) * stride
+            payload_offset = offset + _SLOT_HEADER.size
+
+            seq_before, length = _SLOT_HEADER.unpack_from(buf, offset)
+            payload = bytes(buf[payload_offset:payload_offset + length])
+            seq_after = _SLOT_TRAILER.unpack_from(buf, payload_offset + self.slot_size)[0]
+
+            if seq_before == seq_after == head_seq:
+                self.last_seq = head_seq
+                self.last_advance = time.monotonic()
+                self.connected = True
+                return payload
+        return None
+
+    def close(self):
+        self._detach()
+
+
+class StatePublisher(_RingWriter):
+    """
+    Writer side, owned by the simulator.
+
+    Args:
+        state_file (str): JSON fallback path (simulation_state.json)
+        name (str): Shared-memory segment name
+        mirror_file (bool): Also write every state to state_file
+    """
+    def __init__(self, state_file, name=STATE_CHANNEL_NAME, mirror_file=False,
+                 slot_size=STATE_SLOT_SIZE, slot_count=STATE_SLOT_COUNT):
+        super().__init__(name, slot_size, slot_count)
+        self.state_file = state_file
+        self.mirror_file = mirror_file
+
+        if self.shm is None:
+            self.mirror_file = True
+
+    def publish(self, state):
+        """Publish one state dict (must be JSON serializable)"""
+        if self.shm is not None:
+            payload = json.dumps(state, separators=(',', ':')).encode('utf-8')
+            if not self.write(payload):
+                print(f"Warning: State of {len(payload)} bytes exceeds the {self.slot_size} byte slot, writing file")
+                _write_json_file(self.state_file, state)
+                return
+
+        if self.mirror_file:
+            _write_json_file(self.state_file, state)
+
+
+class StateSubscriber(_RingReader):
+    """
+    Reader side, owned by the dashboard.
+
+    poll() returns the newest state dict when a new one has been published
+    since the last call, otherwise None. `connected` tracks whether a
+    simulator is currently publishing: no new state for
+    STATE_FILE_STALE_AFTER seconds, or a state whose 'last_update' is older
+    than that, counts as a simulator that has gone away.
+    """
+    def __init__(self, state_file, name=STATE_CHANNEL_NAME):
+        super().__init__(name, stale_after=STATE_FILE_STALE_AFTER)
+        self.state_file = state_file
+        self.last_modified = 0
+
+    def _read_file(self):
+        if not os.path.exists(self.state_file):
+            self.connected = False
+            return None
+
+        current_modified = os.path.getmtime(self.state_file)
+        if time.time() - current_modified > STATE_FILE_STALE_AFTER:
+            self.connected = False
+            return None
+        if current_modified == self.last_modified:
+            return None
+
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+        self.last_modified = current_modified
+        self.connected = True
+        return state
+
+    def poll(self):
+        """Return the newest unseen state, or None"""
+        if self.shm is None:
+            self._attach()
+        if self.shm is not None:
+            payload = self.read()
+            if payload is None:
+                return None
+            state = json.loads(payload)
+            if time.time() - state.get('last_update', time.time()) > STATE_FILE_STALE_AFTER:
+                # Left behind by a simulator that crashed; a live one keeps it fresh
+                self.connected = False
+                return None
+            return state
+        try:
+            return self._read_file()
+        except (OSError, ValueError):
+            return None
+
+
+class FramePublisher(_RingWriter):
+    """
+    Simulator side of the per-vehicle frame channel. Frames are optional:
+    without shared memory they are simply not published.
+    """
+    def __init__(self, name=FRAME_CHANNEL_NAME, slot_size=FRAME_SLOT_SIZE, slot_count=FRAME_SLOT_COUNT):
+        super().__init__(name, slot_size, slot_count)
+        self.frame = 0
+
+    def publish(self, sim_time, ids, x, y, speed, lane):
+        """
+        Pack and publish one frame (see pack_vehicle_frame). Vehicles beyond
+        what fits a slot are left out.
+
+        Returns:
+            bool: True if the frame was published
+        """
+        if self.shm is None:
+            return False
+        self.frame += 1
+        limit = (self.slot_size - _FRAME_HEADER.size) // VEHICLE_FRAME_DTYPE.itemsize
+        return self.write(pack_vehicle_frame(self.frame, sim_time, ids[:limit], x[:limit], y[:limit],
+                                             speed[:limit], lane[:limit]))
+
+
+class FrameSubscriber(_RingReader):
+    """
+    Dashboard side of the per-vehicle frame channel. poll() returns the
+    newest packed frame (bytes) or None; intermediate frames the dashboard
+    was too slow for are skipped.
+    """
+    def __init__(self, name=FRAME_CHANNEL_NAME):
+        super().__init__(name)
+
+    def poll(self):
+        return self.read()
+
+
+def pack_vehicle_frame(frame, sim_time, ids, x, y, speed, lane):
+    """
+    Pack per-vehicle arrays into one frame, quantized to centimetres.
+
+    Args:
+        frame (int): Frame number
+        sim_time (float): Simulation time in seconds
+        ids, x, y, speed, lane (np.ndarray): Actor ids, position (m), speed (m/s), lane slot
+
+    Returns:
+        bytes: 16-byte header followed by 16 bytes per vehicle
+    """
+    records = np.zeros(len(ids), dtype=VEHICLE_FRAME_DTYPE)
+    records['id'] = ids
+    records['x'] = np.round(np.asarray(x) * 100.0)
+    records['y'] = np.round(np.asarray(y) * 100.0)
+    records['speed'] = np.clip(np.round(np.asarray(speed) * 100.0), 0, 65535)
+    records['lane'] = lane
+    return _FRAME_HEADER.pack(frame, sim_time, len(records)) + records.tobytes()
+
+
+def unpack_vehicle_frame(payload):
+    """
+    Inverse of pack_vehicle_frame.
+
+    Returns:
+        tuple: (frame, sim_time, records) with records a VEHICLE_FRAME_DTYPE array
+    """
+    frame, sim_time, count = _FRAME_HEADER.unpack_from(payload, 0)
+    records = np.frombuffer(payload, dtype=VEHICLE_FRAME_DTYPE, count=count, offset=_FRAME_HEADER.size)
+    return frame, sim_time, records
+
+
+def _read_new_lines(f, partial):
+    """Read complete JSON lines appended since the last call"""
+    chunk = f.read()
+    if not chunk:
+        return [], partial
+    data = partial + chunk
+    lines = data.split('\n')
+    partial = lines.pop()  # Incomplete last line, finished by a later write
+    records = []
+    for line in lines:
+        if line.strip():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records, partial
+
+
+class CommandJournal:
+    """
+    Dashboard side of the command queue.
+
+    send() appends a sequence-numbered command and never overwrites an
+    earlier one, so bursts of clicks are all delivered. poll_acks() returns
+    acknowledgements the simulator wrote since the last call.
+    """
+    def __init__(self, command_file, ack_file):
+        self.command_file = command_file
+        self.ack_file = ack_file
+        self.lock = threading.Lock()
+        self.next_seq = self._last_seq() + 1
+        self._ack_handle = None
+        self._ack_partial = ''
+
+    def _last_seq(self):
+        last = 0
+        if os.path.exists(self.command_file):
+            with open(self.command_file, 'r') as f:
+                for line in f:
+                    try:
+                        last = max(last, json.loads(line).get('seq', 0))
+                    except ValueError:
+                        continue
+        return last
+
+    def send(self, command):
+        """Append a command dict and return its sequence number"""
+        with self.lock:
+            command = dict(command, seq=self.next_seq)
+            command.setdefault('timestamp', time.time())
+            with open(self.command_file, 'a') as f:
+                f.write(json.dumps(command, separators=(',', ':')) + '\n')
+            self.next_seq += 1
+            return command['seq']
+
+    def reset(self):
+        """Start a fresh journal (before launching a new simulator)"""
+        with self.lock:
+            for path in (self.command_file, self.ack_file):
+                open(path, 'w').close()
+            if self._ack_handle is not None:
+                self._ack_handle.close()
+                self._ack_handle = None
+            self._ack_partial = ''
+
+    def poll_acks(self):
+        """Return acknowledgements appended since the last call"""
+        if self._ack_handle is None:
+            if not os.path.exists(self.ack_file):
+                return []
+            self._ack_handle = open(self.ack_file, 'r')
+        acks, self._ack_partial = _read_new_lines(self._ack_handle, self._ack_partial)
+        return acks
+
+
+class CommandInbox:
+    """
+    Simulator side of the command queue.
+
+    drain() returns every command appended since the last call, in order,
+    with one read on an open file handle. Commands queued before the
+    simulator started are delivered too; commands an earlier run already
+    acknowledged (a manual launch against a journal the dashboard has not
+    reset) are skipped.
+    """
+    def __init__(self, command_file, ack_file):
+        self.command_file = command_file
+        self.ack_file = ack_file
+        self._handle = None
+        self._partial = ''
+        self._acked = None  # seqs in the ack file, loaded on first drain
+
+    def _load_acked(self):
+        acked = set()
+        if os.path.exists(self.ack_file):
+            with open(self.ack_file, 'r') as f:
+                for line in f:
+                    try:
+                        acked.add(json.loads(line).get('seq'))
+                    except ValueError:
+                        continue
+        return acked
+
+    def drain(self):
+        if self._handle is None:
+            if not os.path.exists(self.command_file):
+                return []
+            self._acked = self._load_acked()
+            self._handle = open(self.command_file, 'r')
+        commands, self._partial = _read_new_lines(self._handle, self._partial)
+        return [cmd for cmd in commands if cmd.get('seq') not in self._acked]
+
+    def ack(self, seq, status, detail=None):
+        """Acknowledge a command ('applied', 'ignored' or 'error')"""
+        ack = {'seq': seq, 'status': status, 'timestamp': time.time()}
+        if self._acked is not None:
+            self._acked.add(seq)
+        if detail:
+            ack['detail'] = detail
+        with open(self.ack_file, 'a') as f:
+            f.write(json.dumps(ack, separators=(',', ':')) + '\n')
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
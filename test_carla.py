@@ -1,3 +1,4 @@
+import abc
 import sys
 import glob
 import os
@@ -5,34 +6,74 @@ import time
 import random
 import math
 import csv
-import json
+import threading
+import argparse
 from collections import defaultdict
 from datetime import datetime
 
-try:
-    import carla
-except ImportError:
-    sys.exit("Error: CARLA library not found. Please install with: pip install carla==0.9.15")
+# Headless mode swaps CARLA for the NumPy traffic engine in headless_sim.py
+HEADLESS = os.environ.get('MEDIAN_SIM_BACKEND', '').lower() == 'headless' or '--headless' in sys.argv
+
+if HEADLESS:
+    import headless_sim as carla
+else:
+    try:
+        import carla
+    except ImportError:
+        sys.exit("Error: CARLA library not found. Please install with: pip install carla==0.9.15")
 
 import io
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
+if not HEADLESS:
+    try:
+        import pygame
+        from pygame.locals import K_RETURN
+    except ImportError:
+        sys.exit("Error: Pygame not installed.")
+
 try:
-    import pygame
-    from pygame.locals import K_RETURN
+    import numpy as np
 except ImportError:
-    sys.exit("Error: Pygame not installed.")
+    sys.exit("Error: NumPy not installed. Please install with: pip install numpy")
+
+from sim_channel import StatePublisher, FramePublisher, CommandInbox, channel_names
+from traffic_trace import TraceWriter
+from results_store import ResultsStore
 
 BARRIER_LENGTH = 2.0
 SECTION_LENGTH = 1500  # Extended to follow the entire highway loop
 ANIMATION_SPEED = 2.0
+MEDIAN_UPDATE_INTERVAL = 3  # Ticks between barrier transform updates while the median moves
+LANE4_OVERLAY_REDRAW_INTERVAL = 0.5  # seconds between redraws of the lane 4 boundary lines
 WAYPOINT_SPACING = 2.0  # Distance between waypoints for smooth curves
+ROAD_GRID_CELL = 4.0    # Cell size of the RoadFrame projection grid (meters)
+ROAD_GRID_MARGIN = 25.0  # Points further than this from the road do not project
 
 CONGESTION_THRESHOLD = 15  # Number of slow vehicles to trigger lane shift
 SPEED_THRESHOLD = 5.0      # km/h - below this is considered congested
-MONITOR_DISTANCE = 300.0   # meters to monitor ahead (increased for longer road)
+MONITOR_DISTANCE = 300.0   # meters to monitor ahead (increased for longer road); sizes the detector zones
 MIN_TIME_BETWEEN_SHIFTS = 20.0  # seconds before allowing another shift 
+SIMULATION_DURATION = 300.0     # seconds per session (5 minutes)
+MIN_SHIFTED_TIME = 30.0         # seconds in 4-2 mode before returning to 3-3
+
+DETECTOR_METHOD = 'cusum'       # 'cusum', 'ewma' or 'window': which statistic drives the congestion state
+DETECTOR_WINDOW = 10.0          # seconds of slow count / density / speed kept in the sliding window
+DETECTOR_EWMA_TAU = 5.0         # seconds, time constant of the smoothed slow count
+DETECTOR_CUSUM_LIMIT = 20.0     # vehicle-seconds past the threshold (or release level) that flip the state
+DETECTOR_RELEASE_RATIO = 0.6    # congestion clears below this fraction of CONGESTION_THRESHOLD
+
+SHIFT_CONTROLLER = 'reactive'   # 'reactive' (detector state) or 'forecast' (predicted congestion)
+FORECAST_LEVEL_TAU = 5.0        # seconds, smoothing of the forecast level
+FORECAST_TREND_TAU = 20.0       # seconds, smoothing of the forecast trend
+FORECAST_HOLD = 2.0             # seconds the forecast must stay past the threshold before shifting
+FORECAST_MIN_LEVEL_RATIO = 0.4  # the current level must be at least this fraction of the threshold too
+
+DETECTOR_ZONES = None           # [(name, start, end), ...] arc-length ranges in meters; None = default_zones()
+ZONE_VEHICLE_LENGTH = 4.5       # meters of lane one vehicle occupies, for zone occupancy
+MODE_LANES = {0: (3, 3), 1: (4, 2), 2: (2, 4)}  # (forward, backward) lanes open in each median mode
+UPSTREAM_QUEUE_RATIO = 0.5      # slow vehicles queued upstream, as a fraction of the threshold, that count as forecast congestion
 
 YOLO_PROCESS_TIME = 0.03        # seconds (YOLOv8 at 30 FPS)
 DETECTION_TIME = 1.0            # seconds (count vehicles)
@@ -55,6 +96,22 @@ YOLO_ACCURACY = 0.94            # 94%
 COUNT_ACCURACY = 0.98           # 98%
 THRESHOLD_ACCURACY = 0.99       # 99%
 
+CARLA_HOST = 'localhost'
+CARLA_PORT = 2000
+TM_PORT = 8000
+
+MIRROR_STATE_FILE = False       # Also write simulation_state.json every tick (shared memory is primary)
+TRAFFIC_LOG_FLUSH_INTERVAL = 5.0  # seconds between traffic log writes
+TRAFFIC_LOG_BATCH_SIZE = 256      # rows buffered before an early write
+TRAFFIC_TRACE = True              # Also write a columnar binary trace (.trace) next to the CSV
+VEHICLE_FRAMES = True             # Publish packed per-vehicle frames for the dashboard's live view
+VEHICLE_FRAME_INTERVAL = 0.05     # seconds of simulation time between frames (20 Hz)
+
+TRIP_STOP_SPEED = 2.0             # km/h - below this a vehicle on a trip counts as stopped
+TRIP_MAX_LATERAL = 20.0           # meters from the road centre line still counted as on the section
+TRIP_MAX_JUMP = 30.0              # meters per tick; larger arc-length jumps (respawns) cancel the trip
+TRIP_MIN_FREE_FLOW_SAMPLES = 20   # completed forward trips needed to use the measured free-flow time
+
 def calculate_time_response():
     """
     Calculate total system response time from detection to median shift completion.
@@ -78,6 +135,30 @@ def calculate_yolo_accuracy():
     system_accuracy = YOLO_ACCURACY * COUNT_ACCURACY * THRESHOLD_ACCURACY
     return round(system_accuracy * 100, 2)  # 91.2%
 
+def calculate_bpr_trip_times(volume, capacity, free_flow_time=None):
+    """
+    BPR trip times for whole arrays of samples (e.g. one per second of a trace).
+    
+    Args:
+        volume (np.ndarray): Traffic volume per sample (vehicles/hour)
+        capacity (np.ndarray): Road capacity per sample (vehicles/hour); 0 means V/C = 0
+        free_flow_time (float or np.ndarray, optional): Free-flow time in minutes.
+            Defaults to calculated value.
+    
+    Returns:
+        np.ndarray: Trip time in seconds per sample (unrounded)
+    """
+    if free_flow_time is None:
+        free_flow_time = (DISTANCE_KM / FREE_FLOW_SPEED) * 60  # Convert to minutes
+    
+    volume = np.asarray(volume, dtype=np.float64)
+    capacity = np.asarray(capacity, dtype=np.float64)
+    v_c_ratio = np.divide(volume, capacity, out=np.zeros(np.broadcast(volume, capacity).shape),
+                          where=capacity > 0)
+    
+    # BPR Function: T = T0 * [1 + α * (V/C)^β]
+    return free_flow_time * (1 + ALPHA * v_c_ratio ** BETA) * 60
+
 def calculate_bpr_trip_time(volume, capacity, free_flow_time=None):
     """
     Calculate trip time using Bureau of Public Roads (BPR) function.
@@ -90,15 +171,50 @@ def calculate_bpr_trip_time(volume, capacity, free_flow_time=None):
     Returns:
         float: Trip time in seconds
     """
-    if free_flow_time is None:
-        free_flow_time = (DISTANCE_KM / FREE_FLOW_SPEED) * 60  # Convert to minutes
+    return round(float(calculate_bpr_trip_times(volume, capacity, free_flow_time)), 2)
+
+# Cruise fuel rate (L/100km) by speed band: <=10, <=20, <=30, <=40, <=50, <=80, above (km/h)
+FUEL_RATE_SPEED_EDGES = np.array([10.0, 20.0, 30.0, 40.0, 50.0, 80.0])
+FUEL_RATE_TABLE = np.array([12.0, 9.0, 7.5, 6.5, 6.0, 6.5, 7.0])
+
+def calculate_fuel_consumption_series(avg_speed_kmh, num_stops, idle_time_seconds, distance_km=DISTANCE_KM):
+    """
+    4-component fuel model over whole arrays of samples in one pass.
     
-    v_c_ratio = volume / capacity if capacity > 0 else 0
+    Args:
+        avg_speed_kmh (np.ndarray): Average speed per sample in km/h
+        num_stops (np.ndarray): Stop-and-go cycles per sample
+        idle_time_seconds (np.ndarray): Idle time per sample in seconds
+        distance_km (float or np.ndarray): Distance traveled per sample in km
     
-    # BPR Function: T = T0 * [1 + α * (V/C)^β]
-    trip_time_minutes = free_flow_time * (1 + ALPHA * (v_c_ratio ** BETA))
+    Returns:
+        dict: The calculate_fuel_consumption keys, each an unrounded array per sample
+    """
+    avg_speed_kmh = np.asarray(avg_speed_kmh, dtype=np.float64)
+    distance_km = np.asarray(distance_km, dtype=np.float64)
+    
+    F_idle = IDLE_RATE * (np.asarray(idle_time_seconds, dtype=np.float64) / 3600)
+    
+    # side='left' puts a speed equal to an edge in the lower band (<=)
+    fuel_rate = FUEL_RATE_TABLE[np.searchsorted(FUEL_RATE_SPEED_EDGES, avg_speed_kmh, side='left')]
+    F_cruise = (fuel_rate * distance_km) / 100
+    
+    v_ms = 13.89  # m/s
+    E_accel_MJ = 0.5 * VEHICLE_MASS * (v_ms ** 2) / 1_000_000
+    F_per_accel = E_accel_MJ / (ENGINE_EFFICIENCY * FUEL_ENERGY)
+    F_acceleration = np.asarray(num_stops, dtype=np.float64) * F_per_accel
     
-    return round(trip_time_minutes * 60, 2)  # Convert to seconds
+    F_total = F_idle + F_cruise + F_acceleration
+    
+    return {
+        'idle_fuel_L': F_idle,
+        'cruise_fuel_L': F_cruise,
+        'acceleration_fuel_L': F_acceleration,
+        'total_fuel_L': F_total,
+        'fuel_rate_L_per_100km': np.divide(F_total * 100, distance_km, out=np.zeros_like(F_total),
+                                           where=distance_km > 0),
+        'co2_emissions_kg': F_total * CO2_FACTOR
+    }
 
 def calculate_fuel_consumption(avg_speed_kmh, num_stops, idle_time_seconds, distance_km=DISTANCE_KM):
     """
@@ -113,107 +229,156 @@ def calculate_fuel_consumption(avg_speed_kmh, num_stops, idle_time_seconds, dist
     Returns:
         dict: Fuel consumption breakdown and totals
     """
-    idle_time_hours = idle_time_seconds / 3600
-    
-    F_idle = IDLE_RATE * idle_time_hours
-    
-    if avg_speed_kmh <= 10:
-        fuel_rate = 12.0
-    elif avg_speed_kmh <= 20:
-        fuel_rate = 9.0
-    elif avg_speed_kmh <= 30:
-        fuel_rate = 7.5
-    elif avg_speed_kmh <= 40:
-        fuel_rate = 6.5
-    elif avg_speed_kmh <= 50:
-        fuel_rate = 6.0
-    elif avg_speed_kmh <= 80:
-        fuel_rate = 6.5
-    else:
-        fuel_rate = 7.0
-    
-    F_cruise = (fuel_rate * distance_km) / 100
-    
-    v_ms = 13.89  # m/s
-    E_accel = 0.5 * VEHICLE_MASS * (v_ms ** 2)  # Joules
-    E_accel_MJ = E_accel / 1_000_000  # Convert to MJ
-    F_per_accel = E_accel_MJ / (ENGINE_EFFICIENCY * FUEL_ENERGY)
-    F_acceleration = num_stops * F_per_accel
+    fuel = calculate_fuel_consumption_series(avg_speed_kmh, num_stops, idle_time_seconds, distance_km)
+    return {key: round(float(value), 2 if key == 'fuel_rate_L_per_100km' else 4) for key, value in fuel.items()}
+
+def calculate_trace_metrics(trace, distance_km=DISTANCE_KM, lane_capacity=LANE_CAPACITY):
+    """
+    Per-sample forward-direction BPR trip time and fuel for a whole traffic trace.
     
-    F_total = F_idle + F_cruise + F_acceleration
+    Volume per sample is the section's flow (vehicles / length * speed),
+    capacity follows the forward lanes open in that sample's mode
+    (MODE_LANES), a stop is counted when the average speed drops below
+    SPEED_THRESHOLD and idle time is the sample interval while below it.
     
-    CO2_total = F_total * CO2_FACTOR
+    Args:
+        trace: TrafficTrace or dict with 'time', 'mode', 'lane_counts' and 'fwd_speed' arrays
     
-    return {
-        'idle_fuel_L': round(F_idle, 4),
-        'cruise_fuel_L': round(F_cruise, 4),
-        'acceleration_fuel_L': round(F_acceleration, 4),
-        'total_fuel_L': round(F_total, 4),
-        'fuel_rate_L_per_100km': round((F_total / distance_km) * 100, 2),
-        'co2_emissions_kg': round(CO2_total, 4)
+    Returns:
+        dict: 'time', 'volume', 'capacity', 'trip_time_seconds' and the
+            calculate_fuel_consumption_series arrays, one value per sample
+    """
+    t = np.asarray(trace['time'], dtype=np.float64)
+    speed = np.asarray(trace['fwd_speed'], dtype=np.float64)
+    vehicles = np.asarray(trace['lane_counts'])[:, :4].sum(axis=1)
+    mode = np.asarray(trace['mode'])
+    lanes = np.select([mode == m for m in MODE_LANES], [fwd for fwd, _ in MODE_LANES.values()],
+                      default=MODE_LANES[0][0])
+    
+    dt = np.diff(t, prepend=t[0] - 1.0) if len(t) else t
+    volume = vehicles / distance_km * speed
+    capacity = lanes * lane_capacity
+    slow = speed < SPEED_THRESHOLD
+    stops = slow & ~np.concatenate(([False], slow[:-1]))
+    
+    metrics = {
+        'time': t,
+        'volume': volume,
+        'capacity': capacity,
+        'trip_time_seconds': calculate_bpr_trip_times(volume, capacity),
     }
+    metrics.update(calculate_fuel_consumption_series(speed, stops, np.where(slow, dt, 0.0),
+                                                     speed * dt / 3600))
+    return metrics
 
 def save_metrics_to_json(metrics_dict, filename='simulation_results.json'):
     """
-    Save metrics to JSON file with timestamp.
+    Append metrics (with timestamp) to the results store.
     
     Args:
         metrics_dict (dict): Dictionary containing all metrics
-        filename (str): Output filename
+        filename (str): Results base name; the run is appended to the
+            .jsonl next to it (see results_store.py)
     """
     metrics_dict['timestamp'] = datetime.now().isoformat()
     
-    history = []
-    if os.path.exists(filename):
-        try:
-            with open(filename, 'r') as f:
-                history = json.load(f)
-        except:
-            history = []
-    
-    history.append(metrics_dict)
+    store = ResultsStore(filename)
+    store.append(metrics_dict)
     
-    with open(filename, 'w') as f:
-        json.dump(history, f, indent=2)
+    print(f"Metrics saved to {store.data_file}")
+
+class ObstacleIndex:
+    """
+    Uniform grid over the removable environment objects of the map.
     
-    print(f"Metrics saved to {filename}")
+    Built from a single get_environment_objects() call so that clearing
+    hundreds of zones along the highway is a handful of cell lookups per
+    zone instead of a full-map RPC and linear scan each time.
+    """
+    def __init__(self, world, cell_size=50.0):
+        self.cell_size = cell_size
+        
+        removable = [carla.CityObjectLabel.Poles, carla.CityObjectLabel.GuardRail, 
+                     carla.CityObjectLabel.Fences, carla.CityObjectLabel.Walls,
+                     carla.CityObjectLabel.TrafficSigns, carla.CityObjectLabel.TrafficLight,
+                     carla.CityObjectLabel.Other]  # Catches existing barriers
+        
+        ids, xs, ys = [], [], []
+        for obj in world.get_environment_objects(carla.CityObjectLabel.Any):
+            if obj.type in removable:
+                ids.append(obj.id)
+                xs.append(obj.transform.location.x)
+                ys.append(obj.transform.location.y)
+        
+        self.ids = np.array(ids, dtype=np.uint64)
+        self.x = np.array(xs, dtype=np.float64)
+        self.y = np.array(ys, dtype=np.float64)
+        
+        self.cells = defaultdict(list)
+        cell_x = np.floor(self.x / cell_size).astype(np.int64)
+        cell_y = np.floor(self.y / cell_size).astype(np.int64)
+        for i, key in enumerate(zip(cell_x.tolist(), cell_y.tolist())):
+            self.cells[key].append(i)
+        self.cells = {key: np.array(members) for key, members in self.cells.items()}
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def query_zone(self, center_loc, fwd_vec, length, margin=50.0, half_width=20.0):
+        """
+        IDs of objects inside the box from -margin to length + margin along fwd_vec
+        and within half_width either side of it.
+        """
+        right = (-fwd_vec.y, fwd_vec.x)
+        corners_x, corners_y = [], []
+        for along in (-margin, length + margin):
+            for side in (-half_width, half_width):
+                corners_x.append(center_loc.x + fwd_vec.x * along + right[0] * side)
+                corners_y.append(center_loc.y + fwd_vec.y * along + right[1] * side)
+        
+        # Candidates from every grid cell touched by the box's bounding rectangle
+        x0, x1 = (int(math.floor(v / self.cell_size)) for v in (min(corners_x), max(corners_x)))
+        y0, y1 = (int(math.floor(v / self.cell_size)) for v in (min(corners_y), max(corners_y)))
+        candidates = [self.cells[(cx, cy)] for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)
+                      if (cx, cy) in self.cells]
+        if not candidates:
+            return self.ids[:0]
+        candidates = np.concatenate(candidates)
+        
+        dx = self.x[candidates] - center_loc.x
+        dy = self.y[candidates] - center_loc.y
+        dist_along = dx * fwd_vec.x + dy * fwd_vec.y
+        dist_side = np.abs(dx * right[0] + dy * right[1])
+        inside = (-margin < dist_along) & (dist_along < length + margin) & (dist_side < half_width)
+        return self.ids[candidates[inside]]
 
-def nuke_obstacles_in_zone(world, center_loc, fwd_vec, length):
+def nuke_obstacles_in_zones(world, zones, index=None):
     """
-    Scans the specific area where we are building and removes EVERYTHING
+    Scans the specific areas where we are building and removes EVERYTHING
     that is not the floor (Road/Sidewalk). Removes barriers, poles, and guardrails.
+    
+    Args:
+        world: CARLA world
+        zones (list): (center_loc, fwd_vec, length) tuples
+        index (ObstacleIndex, optional): Prebuilt index. Built from the world if omitted.
     """
-    all_objs = world.get_environment_objects(carla.CityObjectLabel.Any)
+    if index is None:
+        index = ObstacleIndex(world)
     
-    ids_to_remove = []
+    ids_to_remove = set()
+    for center_loc, fwd_vec, length in zones:
+        ids_to_remove.update(index.query_zone(center_loc, fwd_vec, length).tolist())
     
-    for obj in all_objs:
-        if obj.type in [carla.CityObjectLabel.Roads, carla.CityObjectLabel.Sidewalks, carla.CityObjectLabel.Ground, carla.CityObjectLabel.RoadLines]:
-            continue
-        
-        if obj.type in [carla.CityObjectLabel.Poles, carla.CityObjectLabel.GuardRail, 
-                       carla.CityObjectLabel.Fences, carla.CityObjectLabel.Walls,
-                       carla.CityObjectLabel.TrafficSigns, carla.CityObjectLabel.TrafficLight,
-                       carla.CityObjectLabel.Other]:  # Catches existing barriers
-            
-            obj_loc = obj.transform.location
-            
-            vec_to_obj = carla.Vector3D(obj_loc.x - center_loc.x, obj_loc.y - center_loc.y, 0)
-            
-            dist_along = (vec_to_obj.x * fwd_vec.x) + (vec_to_obj.y * fwd_vec.y)
-            
-            right_vec = carla.Vector3D(-fwd_vec.y, fwd_vec.x, 0)
-            dist_side = abs((vec_to_obj.x * right_vec.x) + (vec_to_obj.y * right_vec.y))
-            
-            if -50 < dist_along < length + 50 and dist_side < 20.0:
-                ids_to_remove.append(obj.id)
-
     if ids_to_remove:
-        world.enable_environment_objects(ids_to_remove, False)
+        world.enable_environment_objects(sorted(ids_to_remove), False)
         print(f"Cleared {len(ids_to_remove)} objects from the road")
     else:
         print("Path is clear.")
 
+def nuke_obstacles_in_zone(world, center_loc, fwd_vec, length):
+    """Clear a single zone, see nuke_obstacles_in_zones"""
+    nuke_obstacles_in_zones(world, [(center_loc, fwd_vec, length)])
+
 def clear_all_highway_obstacles(world):
     """
     Remove ALL light poles and barriers from the ENTIRE highway in one go.
@@ -251,28 +416,77 @@ def clear_all_highway_obstacles(world):
     
     print("="*60 + "\n")
 
+TRAFFIC_ROW_DTYPE = np.dtype([
+    ('time', np.float64),
+    ('mode', np.int8),
+    ('total_vehicles', np.int32),
+    ('fwd_speed', np.float64),
+    ('bwd_speed', np.float64),
+    ('fwd_trip_time', np.float64),
+    ('bwd_trip_time', np.float64),
+    ('fwd_throughput', np.float64),
+    ('congestion_pct', np.float64),
+    ('time_saved', np.float64),
+    ('efficiency', np.float64),
+    ('lane_counts', np.int32, (8,)),  # Forward lanes 1-4, then backward lanes 1-4
+    ('fwd_congested', np.uint8),
+    ('bwd_congested', np.uint8),
+    ('median_offset', np.float64),
+])
+
 class TrafficDataCollector:
-    def __init__(self, filename="traffic_data.csv", distance_km=1.0):
+    """
+    Per-second traffic log written to CSV by a background thread.
+    
+    record() stores rows in a fixed-size typed buffer; the writer thread
+    swaps it out and appends it to the open CSV every flush_interval
+    seconds, or as soon as batch_size rows are waiting. Memory stays
+    constant however long the run, and a crash loses at most one flush
+    window. Per-mode averages for the summary are kept as running sums.
+    
+    With trace_path set, every flush is also appended as one time chunk to
+    a columnar binary trace (see traffic_trace.py) holding the raw values.
+    """
+    def __init__(self, filename="traffic_data.csv", distance_km=1.0,
+                 flush_interval=TRAFFIC_LOG_FLUSH_INTERVAL, batch_size=TRAFFIC_LOG_BATCH_SIZE,
+                 trace_path=None):
         self.filename = filename
         self.summary_filename = filename.replace('.csv', '_SUMMARY.txt')
-        self.data_points = []
         self.start_time = time.time()
         self.distance_km = distance_km  # Highway section distance for trip time calculation
-        
-        self.mode_3_3_data = {'speeds': [], 'times': [], 'throughput': []}
-        self.mode_4_2_data = {'speeds': [], 'times': [], 'throughput': []}
-        
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                'Time(s)', 'Mode', 'Forward_Lanes', 'Backward_Lanes',
-                'Total_Vehicles', 'Forward_Avg_Speed_kmh', 'Backward_Avg_Speed_kmh',
-                'Forward_Trip_Time_min', 'Backward_Trip_Time_min',
-                'Forward_Throughput_veh_per_min', 'Forward_Congestion_Level_%',
-                'Time_Saved_vs_Baseline_sec', 'Efficiency_Improvement_%'
-            ])
-    
-    def record(self, elapsed_time, mode, lane_counts, avg_speeds, congestion_status, congestion_pct):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.rows_recorded = 0
+        
+        # [samples, speed sum, trip time sum, throughput sum] per configuration
+        self.mode_3_3_totals = np.zeros(4)
+        self.mode_4_2_totals = np.zeros(4)
+        self.baseline_times = []  # First 20 trip times in 3-3 mode
+        
+        self._buffer = np.zeros(batch_size, dtype=TRAFFIC_ROW_DTYPE)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        
+        self._file = open(filename, 'w', newline='')
+        csv.writer(self._file).writerow([
+            'Time(s)', 'Mode', 'Forward_Lanes', 'Backward_Lanes',
+            'Total_Vehicles', 'Forward_Avg_Speed_kmh', 'Backward_Avg_Speed_kmh',
+            'Forward_Trip_Time_min', 'Backward_Trip_Time_min',
+            'Forward_Throughput_veh_per_min', 'Forward_Congestion_Level_%',
+            'Time_Saved_vs_Baseline_sec', 'Efficiency_Improvement_%'
+        ])
+        self._file.flush()
+        
+        self.trace_path = trace_path
+        self._trace = TraceWriter(trace_path) if trace_path else None
+        
+        self._writer = threading.Thread(target=self._write_loop, name='traffic-log-writer', daemon=True)
+        self._writer.start()
+    
+    def record(self, elapsed_time, mode, lane_counts, avg_speeds, congestion_status, congestion_pct,
+               median_offset=0.0):
         total_vehicles = sum(lane_counts['forward']) + sum(lane_counts['backward'])
         
         fwd_speed = max(avg_speeds['forward'], 0.1)
@@ -283,13 +497,13 @@ class TrafficDataCollector:
         
         forward_throughput = sum(lane_counts['forward']) * (fwd_speed / 60)
         
-        mode_data = self.mode_4_2_data if mode == 1 else self.mode_3_3_data
-        mode_data['speeds'].append(fwd_speed)
-        mode_data['times'].append(forward_trip_time_min)
-        mode_data['throughput'].append(forward_throughput)
+        totals = self.mode_4_2_totals if mode == 1 else self.mode_3_3_totals
+        totals += (1, fwd_speed, forward_trip_time_min, forward_throughput)
+        if mode != 1 and len(self.baseline_times) < 20:
+            self.baseline_times.append(forward_trip_time_min)
         
-        if len(self.mode_3_3_data['times']) > 20:
-            baseline_avg_time = sum(self.mode_3_3_data['times'][:20]) / 20
+        if self.mode_3_3_totals[0] > 20:
+            baseline_avg_time = sum(self.baseline_times) / 20
         else:
             baseline_avg_time = forward_trip_time_min
         
@@ -300,27 +514,84 @@ class TrafficDataCollector:
         else:
             efficiency_improvement_pct = 0
         
-        data = [
-            f"{elapsed_time:.2f}",
-            "3-3 Lanes" if mode == 0 else "4-2 Lanes (DYNAMIC)",
-            3 if mode == 0 else 4,
-            3 if mode == 0 else 2,
-            total_vehicles,
-            f"{fwd_speed:.2f}",
-            f"{bwd_speed:.2f}",
-            f"{forward_trip_time_min:.2f}",
-            f"{backward_trip_time_min:.2f}",
-            f"{forward_throughput:.2f}",
-            f"{congestion_pct:.1f}",
-            f"{time_saved_sec:.2f}" if time_saved_sec > 0 else "0.00",
-            f"{efficiency_improvement_pct:.1f}" if efficiency_improvement_pct > 0 else "0.0"
-        ]
-        
-        with open(self.filename, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(data)
-        
-        self.data_points.append(data)
+        row = (elapsed_time, mode, total_vehicles, fwd_speed, bwd_speed,
+               forward_trip_time_min, backward_trip_time_min, forward_throughput,
+               congestion_pct, time_saved_sec, efficiency_improvement_pct,
+               list(lane_counts['forward']) + list(lane_counts['backward']),
+               congestion_status.get('forward', False), congestion_status.get('backward', False),
+               median_offset)
+        
+        with self._lock:
+            if self._count == len(self._buffer):
+                # Writer fell behind: grow rather than drop (only happens if the disk stalls)
+                self._buffer = np.concatenate([self._buffer, np.zeros(self.batch_size, dtype=TRAFFIC_ROW_DTYPE)])
+            self._buffer[self._count] = row
+            self._count += 1
+            if self._count >= self.batch_size:
+                self._wake.set()
+        self.rows_recorded += 1
+    
+    def _take_rows(self):
+        with self._lock:
+            rows = self._buffer[:self._count].copy()
+            self._count = 0
+            if len(self._buffer) > self.batch_size:
+                self._buffer = np.zeros(self.batch_size, dtype=TRAFFIC_ROW_DTYPE)
+        return rows
+    
+    @staticmethod
+    def _format_rows(rows):
+        fields = ['time', 'mode', 'total_vehicles', 'fwd_speed', 'bwd_speed', 'fwd_trip_time',
+                  'bwd_trip_time', 'fwd_throughput', 'congestion_pct', 'time_saved', 'efficiency']
+        lines = []
+        for t, mode, total, fwd, bwd, fwd_trip, bwd_trip, throughput, congestion, saved, efficiency in \
+                zip(*(rows[name].tolist() for name in fields)):
+            lines.append(','.join([
+                f"{t:.2f}",
+                "3-3 Lanes" if mode == 0 else "4-2 Lanes (DYNAMIC)",
+                '3' if mode == 0 else '4',
+                '3' if mode == 0 else '2',
+                str(total),
+                f"{fwd:.2f}",
+                f"{bwd:.2f}",
+                f"{fwd_trip:.2f}",
+                f"{bwd_trip:.2f}",
+                f"{throughput:.2f}",
+                f"{congestion:.1f}",
+                f"{saved:.2f}" if saved > 0 else "0.00",
+                f"{efficiency:.1f}" if efficiency > 0 else "0.0"
+            ]))
+        return '\r\n'.join(lines) + '\r\n' if lines else ''
+    
+    def flush(self):
+        """Append every buffered row to the CSV"""
+        rows = self._take_rows()
+        if len(rows):
+            self._file.write(self._format_rows(rows))
+            self._file.flush()
+            if self._trace is not None:
+                self._trace.append(rows)
+    
+    def _write_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: Could not write traffic log: {e}")
+    
+    def close(self):
+        """Stop the writer thread and write the remaining rows"""
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        self._file.close()
+        if self._trace is not None:
+            self._trace.close()
     
     def generate_summary_report(self):
         """Generate a comprehensive summary report"""
@@ -328,15 +599,16 @@ class TrafficDataCollector:
         print(" Generating project summary...")
         print("="*70)
         
-        # Calculate averages for each mode
-        avg_speed_3_3 = sum(self.mode_3_3_data['speeds']) / len(self.mode_3_3_data['speeds']) if self.mode_3_3_data['speeds'] else 0
-        avg_speed_4_2 = sum(self.mode_4_2_data['speeds']) / len(self.mode_4_2_data['speeds']) if self.mode_4_2_data['speeds'] else 0
+        self.close()
         
-        avg_time_3_3 = sum(self.mode_3_3_data['times']) / len(self.mode_3_3_data['times']) if self.mode_3_3_data['times'] else 0
-        avg_time_4_2 = sum(self.mode_4_2_data['times']) / len(self.mode_4_2_data['times']) if self.mode_4_2_data['times'] else 0
+        # Calculate averages for each mode from the running sums
+        def mode_averages(totals):
+            if totals[0] == 0:
+                return 0, 0, 0
+            return tuple(float(x) for x in totals[1:] / totals[0])
         
-        avg_throughput_3_3 = sum(self.mode_3_3_data['throughput']) / len(self.mode_3_3_data['throughput']) if self.mode_3_3_data['throughput'] else 0
-        avg_throughput_4_2 = sum(self.mode_4_2_data['throughput']) / len(self.mode_4_2_data['throughput']) if self.mode_4_2_data['throughput'] else 0
+        avg_speed_3_3, avg_time_3_3, avg_throughput_3_3 = mode_averages(self.mode_3_3_totals)
+        avg_speed_4_2, avg_time_4_2, avg_throughput_4_2 = mode_averages(self.mode_4_2_totals)
         
         time_reduction_pct = ((avg_time_3_3 - avg_time_4_2) / avg_time_3_3 * 100) if avg_time_3_3 > 0 else 0
         speed_increase_pct = ((avg_speed_4_2 - avg_speed_3_3) / avg_speed_3_3 * 100) if avg_speed_3_3 > 0 else 0
@@ -352,7 +624,7 @@ class TrafficDataCollector:
             
             f.write(f"Simulation Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
             f.write(f"Test Distance: {self.distance_km} km\n")
-            f.write(f"Total Data Points: {len(self.data_points)}\n\n")
+            f.write(f"Total Data Points: {self.rows_recorded}\n\n")
             
             f.write("="*70 + "\n")
             f.write(" BASELINE SCENARIO (3-3 Lane Configuration)\n")
@@ -404,16 +676,496 @@ class TrafficDataCollector:
         
         print(f"\nSummary report saved to: {self.summary_filename}")
         print(f"Detailed data saved to: {self.filename}")
+        if self.trace_path:
+            print(f"Binary trace saved to: {self.trace_path}")
         print(f"\nKEY RESULTS:")
         print(f"   • Trip Time Reduction: {abs(time_reduction_pct):.1f}%")
         print(f"   • Time Saved per Trip: {abs(time_saved_minutes):.2f} minutes")
         print(f"   • Speed Improvement: {abs(speed_increase_pct):.1f}%")
         print(f"   • Throughput Increase: {abs(throughput_increase_pct):.1f}%")
 
+class RoadFrame:
+    """
+    Arc-length index of the highway section, built once at startup.
+    
+    Walks the road from center_wp a single time and keeps arc length,
+    position, heading, right vector and junction flag for every sample, so
+    median construction, traffic spawning and lane 4 drawing can all read
+    positions at their own spacing without walking waypoints again.
+    Arc length is 0 at center_wp and negative behind it.
+    """
+    def __init__(self, center_wp, waypoints, s, x, y, z, pitch, yaw, roll, is_junction):
+        self.center_wp = center_wp
+        self.waypoints = waypoints
+        self.s = s
+        self.x = x
+        self.y = y
+        self.z = z
+        self.pitch = pitch
+        self.yaw = yaw  # Unwrapped, in degrees
+        self.roll = roll
+        self.is_junction = is_junction
+        self.right_x = -np.sin(np.radians(yaw))
+        self.right_y = np.cos(np.radians(yaw))
+        self._grid = None  # Built on the first project() call
+    
+    @classmethod
+    def build(cls, center_wp, length=SECTION_LENGTH, behind=0.0, spacing=WAYPOINT_SPACING):
+        """
+        Walk the road once, `length` meters ahead of center_wp and `behind` meters back.
+        
+        Stops early at a dead end, so the frame may be shorter than requested.
+        """
+        ahead = [center_wp]
+        distance_traveled = 0.0
+        while distance_traveled < length:
+            next_wps = ahead[-1].next(spacing)
+            if not next_wps:
+                break
+            ahead.append(next_wps[0])
+            distance_traveled += spacing
+        
+        back = []
+        distance_traveled = 0.0
+        current_wp = center_wp
+        while distance_traveled < behind:
+            prev_wps = current_wp.previous(spacing)
+            if not prev_wps:
+                break
+            current_wp = prev_wps[0]
+            back.append(current_wp)
+            distance_traveled += spacing
+        
+        waypoints = back[::-1] + ahead
+        s = np.arange(len(waypoints), dtype=np.float64) * spacing - len(back) * spacing
+        
+        rows = np.array([
+            (wp.transform.location.x, wp.transform.location.y, wp.transform.location.z,
+             wp.transform.rotation.pitch, wp.transform.rotation.yaw, wp.transform.rotation.roll)
+            for wp in waypoints
+        ])
+        is_junction = np.array([wp.is_junction for wp in waypoints], dtype=bool)
+        
+        print(f"Indexed {len(waypoints)} road samples from {s[0]:.0f}m to {s[-1]:.0f}m")
+        return cls(center_wp, waypoints, s, rows[:, 0], rows[:, 1], rows[:, 2],
+                   rows[:, 3], np.unwrap(rows[:, 4], period=360), rows[:, 5], is_junction)
+    
+    def _nearest_index(self, s_query):
+        idx = np.clip(np.searchsorted(self.s, s_query), 1, len(self.s) - 1)
+        closer_to_prev = (s_query - self.s[idx - 1]) < (self.s[idx] - s_query)
+        return np.where(closer_to_prev, idx - 1, idx)
+    
+    def sample(self, spacing, start=0.0, end=None):
+        """
+        Interpolate the road at a fixed spacing over [start, end).
+        
+        Args:
+            spacing (float): Distance between samples in meters
+            start (float): First arc length, meters from center_wp
+            end (float, optional): Arc length to stop before. Defaults to the end of the frame.
+        
+        Returns:
+            dict: Arrays 's', 'x', 'y', 'z', 'pitch', 'yaw', 'roll', 'right_x', 'right_y',
+                'is_junction' and 'index' (nearest stored waypoint)
+        """
+        if end is None:
+            end = self.s[-1] + spacing
+        s_query = np.arange(start, end, spacing, dtype=np.float64)
+        s_query = s_query[(s_query >= self.s[0]) & (s_query <= self.s[-1])]
+        
+        yaw = np.interp(s_query, self.s, self.yaw)
+        index = self._nearest_index(s_query) if len(s_query) else np.zeros(0, dtype=np.int64)
+        return {
+            's': s_query,
+            'x': np.interp(s_query, self.s, self.x),
+            'y': np.interp(s_query, self.s, self.y),
+            'z': np.interp(s_query, self.s, self.z),
+            'pitch': np.interp(s_query, self.s, self.pitch),
+            'yaw': yaw,
+            'roll': np.interp(s_query, self.s, self.roll),
+            'right_x': -np.sin(np.radians(yaw)),
+            'right_y': np.cos(np.radians(yaw)),
+            'is_junction': self.is_junction[index],
+            'index': index
+        }
+    
+    def offset_locations(self, samples, lateral_offset, dz=0.0):
+        """carla.Locations shifted lateral_offset meters along each sample's own right vector"""
+        xs = samples['x'] + samples['right_x'] * lateral_offset
+        ys = samples['y'] + samples['right_y'] * lateral_offset
+        zs = samples['z'] + dz
+        return [carla.Location(x=x, y=y, z=z) for x, y, z in zip(xs.tolist(), ys.tolist(), zs.tolist())]
+    
+    def waypoint_at(self, index):
+        """Stored CARLA waypoint for a sample index (for lane queries)"""
+        return self.waypoints[int(index)]
+
+    def _build_grid(self):
+        # Only cells within ROAD_GRID_MARGIN of some sample are resolved; the rest stay -1
+        cell = ROAD_GRID_CELL
+        reach = int(np.ceil(ROAD_GRID_MARGIN / cell)) + 1
+        origin_x = self.x.min() - (reach + 1) * cell
+        origin_y = self.y.min() - (reach + 1) * cell
+        nx = int(np.ceil((self.x.max() - origin_x) / cell)) + reach + 2
+        ny = int(np.ceil((self.y.max() - origin_y) / cell)) + reach + 2
+        
+        sx = np.floor((self.x - origin_x) / cell).astype(np.int64)
+        sy = np.floor((self.y - origin_y) / cell).astype(np.int64)
+        steps = np.arange(-reach, reach + 1)
+        cells = np.unique(((sx[:, None, None] + steps[None, :, None]) * ny
+                           + (sy[:, None, None] + steps[None, None, :])).ravel())
+        
+        centre_x = origin_x + (cells // ny + 0.5) * cell
+        centre_y = origin_y + (cells % ny + 0.5) * cell
+        nearest = np.empty(len(cells), dtype=np.int32)
+        distance = np.empty(len(cells))
+        for start in range(0, len(cells), 2048):
+            chunk = slice(start, start + 2048)
+            d2 = (centre_x[chunk, None] - self.x[None, :]) ** 2 + (centre_y[chunk, None] - self.y[None, :]) ** 2
+            nearest[chunk] = np.argmin(d2, axis=1)
+            distance[chunk] = np.sqrt(d2[np.arange(len(d2)), nearest[chunk]])
+        
+        table = np.full(nx * ny, -1, dtype=np.int32)
+        near_road = distance <= ROAD_GRID_MARGIN + cell
+        table[cells[near_road]] = nearest[near_road]
+        self._grid = (origin_x, origin_y, nx, ny, table,
+                      np.cos(np.radians(self.yaw)), np.sin(np.radians(self.yaw)))
+    
+    def project(self, x, y):
+        """
+        Arc length and lateral offset of world points, O(1) per point.
+        
+        A grid over the road maps every cell to its nearest sample once, so
+        each point costs one table lookup plus a projection onto that
+        sample's tangent, however long the road is.
+        
+        Args:
+            x (np.ndarray): World x of each point
+            y (np.ndarray): World y of each point
+        
+        Returns:
+            tuple: (s, lateral) arrays in meters; NaN for points more than
+                ROAD_GRID_MARGIN from the road
+        """
+        if self._grid is None:
+            self._build_grid()
+        origin_x, origin_y, nx, ny, table, fwd_x, fwd_y = self._grid
+        
+        cx = np.floor((x - origin_x) / ROAD_GRID_CELL).astype(np.int64)
+        cy = np.floor((y - origin_y) / ROAD_GRID_CELL).astype(np.int64)
+        inside = (cx >= 0) & (cx < nx) & (cy >= 0) & (cy < ny)
+        index = np.full(len(x), -1, dtype=np.int64)
+        index[inside] = table[cx[inside] * ny + cy[inside]]
+        
+        found = index >= 0
+        index = np.where(found, index, 0)
+        dx = x - self.x[index]
+        dy = y - self.y[index]
+        s = np.where(found, self.s[index] + dx * fwd_x[index] + dy * fwd_y[index], np.nan)
+        lateral = np.where(found, dx * self.right_x[index] + dy * self.right_y[index], np.nan)
+        return s, lateral
+
+class VehicleSnapshot:
+    """
+    Struct-of-arrays view of every tracked vehicle at a single simulation frame.
+
+    Built once per tick from world.get_snapshot() so traffic analysis reads
+    plain arrays instead of querying each actor over RPC. Row i of every
+    array (and of `actors`) describes the same vehicle.
+    """
+    def __init__(self, actors, ids, x, y, z, yaw, vx, vy, vz, frame=None):
+        self.actors = actors
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self.z = z
+        self.yaw = yaw
+        self.vx = vx
+        self.vy = vy
+        self.vz = vz
+        self.frame = frame
+        self._projection = None
+    
+    @classmethod
+    def capture(cls, world, vehicles):
+        """
+        Read the state of all vehicles from one world snapshot.
+        
+        Vehicles missing from the snapshot (destroyed since the last tick)
+        are dropped, so `actors` doubles as the list of live vehicles.
+        """
+        world_snapshot = world.get_snapshot()
+        
+        vehicle_arrays = getattr(world_snapshot, 'vehicle_arrays', None)
+        if vehicle_arrays is not None:
+            # Array-native backends (headless_sim) hand their state over directly
+            ids = np.array([v.id for v in vehicles], dtype=np.int64)
+            found, x, y, z, yaw, vx, vy, vz = vehicle_arrays(ids)
+            actors = [v for v, ok in zip(vehicles, found.tolist()) if ok]
+            return cls(actors, ids[found], x, y, z, yaw, vx, vy, vz, frame=world_snapshot.frame)
+        
+        actors = []
+        rows = []
+        for v in vehicles:
+            actor_snapshot = world_snapshot.find(v.id)
+            if actor_snapshot is None:
+                continue
+            transform = actor_snapshot.get_transform()
+            vel = actor_snapshot.get_velocity()
+            actors.append(v)
+            rows.append((v.id, transform.location.x, transform.location.y, transform.location.z,
+                         transform.rotation.yaw, vel.x, vel.y, vel.z))
+        
+        data = np.array(rows, dtype=np.float64).reshape(-1, 8)
+        return cls(
+            actors,
+            data[:, 0].astype(np.int64),
+            data[:, 1], data[:, 2], data[:, 3],
+            data[:, 4],
+            data[:, 5], data[:, 6], data[:, 7],
+            frame=world_snapshot.frame
+        )
+    
+    def __len__(self):
+        return len(self.actors)
+    
+    @property
+    def speed_kmh(self):
+        return 3.6 * np.sqrt(self.vx**2 + self.vy**2 + self.vz**2)
+    
+    def is_forward(self, ref_yaw):
+        """Boolean mask of vehicles heading within 90 degrees of ref_yaw"""
+        yaw_diff = np.abs(self.yaw - ref_yaw) % 360
+        yaw_diff = np.where(yaw_diff > 180, 360 - yaw_diff, yaw_diff)
+        return yaw_diff < 90
+    
+    def lateral_offsets(self, origin, right_vec):
+        """Signed lateral distance of each vehicle from origin along right_vec"""
+        return (self.x - origin.x) * right_vec.x + (self.y - origin.y) * right_vec.y
+    
+    def longitudinal_offsets(self, origin, fwd_vec):
+        """Signed distance of each vehicle from origin along fwd_vec"""
+        return (self.x - origin.x) * fwd_vec.x + (self.y - origin.y) * fwd_vec.y
+    
+    def arc_lengths(self, road_frame):
+        """(s, lateral) of each vehicle on road_frame, projected once per snapshot and shared by its readers"""
+        if self._projection is None or self._projection[0] is not road_frame:
+            self._projection = (road_frame, road_frame.project(self.x, self.y))
+        return self._projection[1]
+
+TRIP_RECORD_DTYPE = np.dtype([
+    ('vehicle_id', '<i8'),
+    ('direction', 'i1'),       # 1 = forward (increasing arc length), -1 = backward
+    ('entry_time', '<f8'),
+    ('exit_time', '<f8'),
+    ('travel_time', '<f4'),
+    ('stops', '<u2'),
+    ('idle_time', '<f4'),
+])
+
+class TripTracker:
+    """
+    Measured trips through the section, timed at its boundaries.
+    
+    Every tick projects each vehicle onto the road frame's arc length and
+    compares it with the previous tick: crossing s_start heading forward (or
+    s_end heading backward) opens a trip, crossing the far boundary closes
+    it, with crossing times interpolated inside the tick. Per-vehicle state
+    lives in flat arrays reached through an id -> slot table, so an update
+    is a fixed number of vectorized passes whatever the vehicle count.
+    Completed trips are appended to a TRIP_RECORD_DTYPE array.
+    """
+    # Per-vehicle state arrays and the value a fresh slot starts with
+    _STATE = (('last_s', np.float64, np.nan), ('last_t', np.float64, 0.0),
+              ('entry_time', np.float64, np.nan), ('direction', np.int8, 0),
+              ('stops', np.uint16, 0), ('idle', np.float32, 0.0), ('stopped', bool, False))
+    
+    def __init__(self, road_frame, s_start=0.0, s_end=SECTION_LENGTH, capacity=1024):
+        self.road_frame = road_frame
+        self.s_start = float(s_start)
+        self.s_end = float(s_end)
+        self.slot_of = np.full(capacity, -1, dtype=np.int64)
+        self.size = 0
+        for name, dtype, fill in self._STATE:
+            setattr(self, name, np.full(capacity, fill, dtype=dtype))
+        self.trips = np.zeros(capacity, dtype=TRIP_RECORD_DTYPE)
+        self.trip_count = 0
+        self.exits = np.zeros(2, dtype=np.int64)  # Vehicles leaving over the far boundary, forward / backward
+        self.start_time = None
+        self.last_time = None
+    
+    def _slots(self, ids):
+        if ids.max() >= len(self.slot_of):
+            table = np.full(max(int(ids.max()) + 1, 2 * len(self.slot_of)), -1, dtype=np.int64)
+            table[:len(self.slot_of)] = self.slot_of
+            self.slot_of = table
+        
+        slots = self.slot_of[ids]
+        new = slots < 0
+        count = int(np.count_nonzero(new))
+        if count:
+            if self.size + count > len(self.last_s):
+                capacity = max(self.size + count, 2 * len(self.last_s))
+                for name, dtype, fill in self._STATE:
+                    grown = np.full(capacity, fill, dtype=dtype)
+                    grown[:self.size] = getattr(self, name)[:self.size]
+                    setattr(self, name, grown)
+            slots[new] = np.arange(self.size, self.size + count)
+            self.slot_of[ids[new]] = slots[new]
+            self.size += count
+        return slots
+    
+    def _record(self, slots, ids, exit_time):
+        n = len(slots)
+        if self.trip_count + n > len(self.trips):
+            grown = np.zeros(max(self.trip_count + n, 2 * len(self.trips)), dtype=TRIP_RECORD_DTYPE)
+            grown[:self.trip_count] = self.trips[:self.trip_count]
+            self.trips = grown
+        
+        records = self.trips[self.trip_count:self.trip_count + n]
+        records['vehicle_id'] = ids
+        records['direction'] = self.direction[slots]
+        records['entry_time'] = self.entry_time[slots]
+        records['exit_time'] = exit_time
+        records['travel_time'] = exit_time - self.entry_time[slots]
+        records['stops'] = self.stops[slots]
+        records['idle_time'] = self.idle[slots]
+        self.trip_count += n
+    
+    def update(self, snapshot, t):
+        """
+        Advance every vehicle in the snapshot to simulation time t.
+        
+        Args:
+            snapshot (VehicleSnapshot): Vehicle state for this tick
+            t (float): Simulation time in seconds
+        """
+        if self.start_time is None:
+            self.start_time = t
+        self.last_time = t
+        if len(snapshot.ids) == 0:
+            return
+        
+        ids = snapshot.ids
+        slots = self._slots(ids)
+        s, lateral = snapshot.arc_lengths(self.road_frame)
+        on_road = np.abs(lateral) <= TRIP_MAX_LATERAL  # False for NaN as well
+        
+        prev_s = self.last_s[slots]
+        prev_t = self.last_t[slots]
+        tracked = on_road & ~np.isnan(prev_s)
+        jumped = tracked & (np.abs(s - prev_s) > TRIP_MAX_JUMP)
+        moved = tracked & ~jumped
+        
+        a, b = self.s_start, self.s_end
+        fwd_in = moved & (prev_s < a) & (s >= a)
+        fwd_out = moved & (prev_s < b) & (s >= b)
+        bwd_in = moved & (prev_s > b) & (s <= b)
+        bwd_out = moved & (prev_s > a) & (s <= a)
+        self.exits[0] += int(np.count_nonzero(fwd_out))
+        self.exits[1] += int(np.count_nonzero(bwd_out))
+        
+        direction = self.direction[slots]
+        active = ~np.isnan(self.entry_time[slots])
+        
+        # Stops and idle time of trips already under way
+        slow = snapshot.speed_kmh < TRIP_STOP_SPEED
+        counting = active & moved
+        self.idle[slots] += np.where(counting & slow, t - prev_t, 0.0).astype(np.float32)
+        self.stops[slots] += (counting & slow & ~self.stopped[slots]).astype(np.uint16)
+        
+        closing = active & (((direction > 0) & fwd_out) | ((direction < 0) & bwd_out))
+        if closing.any():
+            boundary = np.where(direction[closing] > 0, b, a)
+            ds = s[closing] - prev_s[closing]
+            exit_time = prev_t[closing] + (t - prev_t[closing]) * (boundary - prev_s[closing]) / ds
+            self._record(slots[closing], ids[closing], exit_time)
+        
+        # Respawned vehicles and vehicles backing out over the entry boundary lose their trip
+        abandoned = active & (jumped | ((direction > 0) & (s < a)) | ((direction < 0) & (s > b)))
+        self.entry_time[slots[closing | abandoned]] = np.nan
+        
+        opening = fwd_in | bwd_in
+        if opening.any():
+            opened = slots[opening]
+            boundary = np.where(fwd_in[opening], a, b)
+            ds = s[opening] - prev_s[opening]
+            self.entry_time[opened] = prev_t[opening] + (t - prev_t[opening]) * (boundary - prev_s[opening]) / ds
+            self.direction[opened] = np.where(fwd_in[opening], 1, -1)
+            self.stops[opened] = 0
+            self.idle[opened] = 0.0
+        
+        # Vehicles off the road keep their last position until they come back
+        seen = slots[on_road]
+        self.last_s[seen] = s[on_road]
+        self.last_t[seen] = t
+        self.stopped[seen] = slow[on_road]
+    
+    def completed(self, direction=None):
+        """Completed trip records, optionally only one direction (1 or -1)"""
+        trips = self.trips[:self.trip_count]
+        return trips if direction is None else trips[trips['direction'] == direction]
+    
+    def free_flow_time(self):
+        """
+        Free-flow travel time of the section from measured forward trips.
+        
+        Returns:
+            float or None: 10th percentile forward travel time in seconds, or None
+                until TRIP_MIN_FREE_FLOW_SAMPLES trips have completed
+        """
+        travel_times = self.completed(1)['travel_time']
+        if len(travel_times) < TRIP_MIN_FREE_FLOW_SAMPLES:
+            return None
+        return float(np.percentile(travel_times, 10))
+    
+    def summary(self):
+        """
+        Throughput and travel-time distribution per direction.
+        
+        Returns:
+            dict: Observed seconds, trips in progress and, for 'forward' and
+                'backward', exit throughput plus travel-time percentiles, stops
+                and idle time of completed trips (percentiles only once a trip
+                has completed)
+        """
+        observed = (self.last_time - self.start_time) if self.start_time is not None else 0.0
+        summary = {
+            'section_length_m': self.s_end - self.s_start,
+            'observed_seconds': round(observed, 1),
+            'trips_in_progress': int(np.count_nonzero(~np.isnan(self.entry_time[:self.size])))
+        }
+        for name, direction, k in (('forward', 1, 0), ('backward', -1, 1)):
+            trips = self.completed(direction)
+            stats = {
+                'completed_trips': len(trips),
+                'exits': int(self.exits[k]),
+                'throughput_veh_per_hour': round(float(self.exits[k]) * 3600.0 / observed, 1) if observed > 0 else 0.0
+            }
+            if len(trips):
+                travel_times = trips['travel_time'].astype(np.float64)
+                p10, p50, p85, p95 = np.percentile(travel_times, [10, 50, 85, 95])
+                stats.update({
+                    'travel_time_mean_seconds': round(float(travel_times.mean()), 2),
+                    'travel_time_min_seconds': round(float(travel_times.min()), 2),
+                    'travel_time_p10_seconds': round(float(p10), 2),
+                    'travel_time_p50_seconds': round(float(p50), 2),
+                    'travel_time_p85_seconds': round(float(p85), 2),
+                    'travel_time_p95_seconds': round(float(p95), 2),
+                    'travel_time_max_seconds': round(float(travel_times.max()), 2),
+                    'space_mean_speed_kmh': round(3.6 * (self.s_end - self.s_start) / float(travel_times.mean()), 2),
+                    'avg_stops': round(float(trips['stops'].mean()), 2),
+                    'avg_idle_seconds': round(float(trips['idle_time'].mean()), 2),
+                    'stopped_trip_percent': round(100.0 * int(np.count_nonzero(trips['stops'])) / len(trips), 1)
+                })
+            summary[name] = stats
+        return summary
+
 class ConcreteMedian:
-    def __init__(self, client, world, center_wp):
+    def __init__(self, client, world, road_frame, update_interval=MEDIAN_UPDATE_INTERVAL):
         self.client = client
         self.world = world
+        self.update_interval = max(1, int(update_interval))
         self.blocks = [] 
         self.target_offset = 0.0
         self.current_offset = 0.0
@@ -436,83 +1188,73 @@ class ConcreteMedian:
                 self.bp = bp_lib.find('static.prop.streetbarrier')
                 print(f"Using street barrier")
         
-        rotation = center_wp.transform.rotation
-        start_loc = center_wp.transform.location
+        path = road_frame.sample(WAYPOINT_SPACING, 0.0, SECTION_LENGTH)
+        print(f"Generated {len(path['s'])} waypoints along {path['s'][-1] if len(path['s']) else 0:.1f}m")
         
-        waypoints_path = []
-        current_wp = center_wp
-        distance_traveled = 0
-        
-        while distance_traveled < SECTION_LENGTH:
-            waypoints_path.append(current_wp)
-            next_wps = current_wp.next(WAYPOINT_SPACING)
-            if next_wps:
-                current_wp = next_wps[0]
-                distance_traveled += WAYPOINT_SPACING
-            else:
-                break
+        # Skip junctions - don't place barrier at intersections
+        valid = ~path['is_junction']
+        path = {key: values[valid] for key, values in path.items()}
         
-        print(f"Generated {len(waypoints_path)} waypoints along {distance_traveled:.1f}m")
+        # Shift to center of road (between 3 forward and 3 backward lanes)
+        center_offset = -10.5  # 3 lanes × 3.5m = 10.5m left
+        center_locs = road_frame.offset_locations(path, center_offset, dz=0.3)
         
         center_positions = []
-        for wp in waypoints_path:
-            if wp.is_junction:
-                print(f"Skipping junction at waypoint (intersection detected)")
-                continue  # Skip this waypoint - don't place barrier at intersections
-            
-            yaw_rad = math.radians(wp.transform.rotation.yaw)
-            right_vec = carla.Vector3D(-math.sin(yaw_rad), math.cos(yaw_rad), 0)
-            
-            # Shift to center of road (between 3 forward and 3 backward lanes)
-            center_offset = -10.5  # 3 lanes × 3.5m = 10.5m left
-            
-            center_loc = carla.Location(
-                x = wp.transform.location.x + (right_vec.x * center_offset),
-                y = wp.transform.location.y + (right_vec.y * center_offset),
-                z = wp.transform.location.z + 0.3
-            )
-            center_positions.append((center_loc, wp.transform.rotation))
+        for loc, pitch, yaw, roll in zip(center_locs, path['pitch'].tolist(), path['yaw'].tolist(), path['roll'].tolist()):
+            center_positions.append((loc, carla.Rotation(pitch=pitch, yaw=yaw, roll=roll)))
         
         print(f"Filtered to {len(center_positions)} valid positions (junctions excluded)")
         
         print("Clearing obstacles along entire highway...")
-        for i, (pos, _) in enumerate(center_positions):
-                yaw_rad = math.radians(waypoints_path[i].transform.rotation.yaw)
+        zones = []
+        for (pos, rot) in center_positions:
+                yaw_rad = math.radians(rot.yaw)
                 fwd_vec = carla.Vector3D(math.cos(yaw_rad), math.sin(yaw_rad), 0)
-                nuke_obstacles_in_zone(world, pos, fwd_vec, 100)
+                zones.append((pos, fwd_vec, 100))
+        nuke_obstacles_in_zones(world, zones)
         
         print("Building movable median along the highway...")
         batch = []
+        transforms = []
         for pos, rot in center_positions:
             trans = carla.Transform(pos, rot)
             batch.append(carla.command.SpawnActor(self.bp, trans))
-            self.block_origins.append(trans)
+            transforms.append(trans)
             
         results = client.apply_batch_sync(batch)
-        for i, r in enumerate(results):
+        for trans, r in zip(transforms, results):
             if not r.error:
                 actor = world.get_actor(r.actor_id)
                 actor.set_simulate_physics(False)
                 self.blocks.append(actor)
+                self.block_origins.append(trans)  # Kept index-aligned with self.blocks
+        
+        # Cache block geometry so movement is one array operation per update
+        self._origin_xyz = np.array([(t.location.x, t.location.y, t.location.z)
+                                     for t in self.block_origins]).reshape(-1, 3)
+        self._right_xy = np.array([(r.x, r.y) for r in
+                                   (t.get_right_vector() for t in self.block_origins)]).reshape(-1, 2)
+        self._applied_offset = 0.0
+        self._ticks_since_update = 0
         
         print(f"Built median with {len(self.blocks)} barrier segments")
 
-    def set_lane_configuration(self, mode, center_wp=None, right_vec=None):
+    def set_lane_configuration(self, mode, road_frame=None):
         """Mode 0: 3-3 lanes, Mode 1: 4-2 lanes (left), Mode 2: 2-4 lanes (right)"""
         if mode == 1:
             self.target_offset = -3.5  # Shift left to create 4th forward lane
             self.is_moving = True
             print("Shifting median left: creating 4-2 configuration (4 forward lanes)")
             self.destroy_lane4_markers()
-            if center_wp and right_vec:
-                self.lane4_markers = create_virtual_lane4(self.world, center_wp, mode, right_vec)
+            if road_frame is not None:
+                self.lane4_markers = create_virtual_lane4(self.world, road_frame, mode)
         elif mode == 2:
             self.target_offset = 3.5   # Shift right to create 4th backward lane
             self.is_moving = True
             print("Shifting median right: creating 2-4 configuration (4 backward lanes)")
             self.destroy_lane4_markers()
-            if center_wp and right_vec:
-                self.lane4_markers = create_virtual_lane4(self.world, center_wp, mode, right_vec)
+            if road_frame is not None:
+                self.lane4_markers = create_virtual_lane4(self.world, road_frame, mode)
         else:
             self.target_offset = 0.0   # Return to center for 3-3
             self.is_moving = True
@@ -529,34 +1271,18 @@ class ConcreteMedian:
                 pass
         self.lane4_markers = []
 
-    def check_lane3_clear(self, vehicles, center_wp, right_vec, median_position):
+    def check_lane3_clear(self, snapshot, center_wp, right_vec, median_position):
         """Check if lane 3 (closest to median) is mostly clear"""
-        lane3_vehicles = 0
+        if len(snapshot) == 0:
+            return True
         
-        for v in vehicles:
-            try:
-                if not v.is_alive:
-                    continue
-                    
-                loc = v.get_location()
-                v_rotation = v.get_transform().rotation
-                
-                yaw_diff = abs(v_rotation.yaw - center_wp.transform.rotation.yaw)
-                if yaw_diff > 180:
-                    yaw_diff = 360 - yaw_diff
-                is_forward = yaw_diff < 90
-                
-                dx = loc.x - center_wp.transform.location.x
-                dy = loc.y - center_wp.transform.location.y
-                lateral_offset = (dx * right_vec.x) + (dy * right_vec.y)
-                relative_offset = lateral_offset - median_position
-                
-                if is_forward and -3.5 <= relative_offset < 0:
-                    lane3_vehicles += 1
-                elif not is_forward and 0 <= relative_offset < 3.5:
-                    lane3_vehicles += 1
-            except:
-                continue
+        is_forward = snapshot.is_forward(center_wp.transform.rotation.yaw)
+        relative_offset = snapshot.lateral_offsets(center_wp.transform.location, right_vec) - median_position
+        
+        in_lane3 = np.where(is_forward,
+                            (-3.5 <= relative_offset) & (relative_offset < 0),
+                            (0 <= relative_offset) & (relative_offset < 3.5))
+        lane3_vehicles = int(np.count_nonzero(in_lane3))
         
         return lane3_vehicles < 5
 
@@ -573,16 +1299,30 @@ class ConcreteMedian:
         else:
             direction = 1 if error > 0 else -1
             self.current_offset += direction * ANIMATION_SPEED * 0.3 * dt  # Slower movement
-
-        for i, actor in enumerate(self.blocks):
-            orig = self.block_origins[i]
-            r_vec = orig.get_right_vector()
-            new_loc = carla.Location(
-                x = orig.location.x + (r_vec.x * self.current_offset),
-                y = orig.location.y + (r_vec.y * self.current_offset),
-                z = orig.location.z
-            )
-            actor.set_transform(carla.Transform(new_loc, orig.rotation))
+        
+        # Only push transforms every update_interval ticks, but always land on the target
+        self._ticks_since_update += 1
+        if self.is_moving and self._ticks_since_update < self.update_interval:
+            return
+        self._ticks_since_update = 0
+        self._apply_offset(self.current_offset)
+    
+    def _apply_offset(self, offset):
+        """Move every block to the given lateral offset in a single batch"""
+        if not self.blocks:
+            return
+        
+        new_xy = self._origin_xyz[:, :2] + self._right_xy * offset
+        batch = [
+            carla.command.ApplyTransform(actor.id, carla.Transform(carla.Location(x=x, y=y, z=z), orig.rotation))
+            for actor, orig, (x, y), z in zip(self.blocks, self.block_origins, new_xy.tolist(), self._origin_xyz[:, 2].tolist())
+        ]
+        self.client.apply_batch(batch)
+        self._applied_offset = offset
+    
+    def block_positions(self):
+        """XY position of every barrier block as last sent to the server, shape (N, 2)"""
+        return self._origin_xyz[:, :2] + self._right_xy * self._applied_offset
     
     def get_current_mode(self):
         """Return current mode based on offset"""
@@ -593,48 +1333,36 @@ class ConcreteMedian:
         else:
             return 0  # 3-3 mode
     
-    def enforce_separation(self, vehicles, tm):
+    def enforce_separation(self, snapshot, tm):
         """Force vehicles to stay on their side of the median"""
-        if not self.blocks:
+        if not self.blocks or len(snapshot) == 0:
             return
         
-        # Get median center positions
-        median_positions = [block.get_location() for block in self.blocks[:10]]  # Sample first 10
+        # Median center positions, sampled from the first 10 blocks
+        median_xy = self.block_positions()[:10]
+        
+        dist = np.hypot(snapshot.x[:, None] - median_xy[None, :, 0],
+                        snapshot.y[:, None] - median_xy[None, :, 1])
+        too_close = np.nonzero(dist.min(axis=1) < 2.0)[0]
         
-        for vehicle in vehicles:
+        for i in too_close:
+            vehicle = snapshot.actors[i]
             try:
-                if not vehicle.is_alive:
-                    continue
-                
-                v_loc = vehicle.get_location()
-                
-                min_dist = float('inf')
-                for m_loc in median_positions:
-                    dist = math.sqrt((v_loc.x - m_loc.x)**2 + (v_loc.y - m_loc.y)**2)
-                    min_dist = min(min_dist, dist)
-                
-                if min_dist < 2.0:
-                    vehicle.set_target_velocity(carla.Vector3D(0, 0, 0))
-                    current_vel = vehicle.get_velocity()
-                    if abs(current_vel.x) < 0.1 and abs(current_vel.y) < 0.1:
-                        transform = vehicle.get_transform()
-                        transform.location.z += 0.5
-                        vehicle.set_transform(transform)
+                vehicle.set_target_velocity(carla.Vector3D(0, 0, 0))
+                if abs(snapshot.vx[i]) < 0.1 and abs(snapshot.vy[i]) < 0.1:
+                    transform = carla.Transform(
+                        carla.Location(x=snapshot.x[i], y=snapshot.y[i], z=snapshot.z[i] + 0.5),
+                        carla.Rotation(yaw=snapshot.yaw[i])
+                    )
+                    vehicle.set_transform(transform)
             except:
                 continue
 
-def spawn_aligned_traffic(client, world, center_wp, tm):
+def spawn_aligned_traffic(client, world, road_frame, tm):
     print("Spawning initial 6-lane traffic...")
     bp_lib = world.get_blueprint_library()
     cars = []
     
-    rotation = center_wp.transform.rotation
-    start_loc = center_wp.transform.location
-    
-    yaw_rad = math.radians(rotation.yaw)
-    fwd_vec = carla.Vector3D(math.cos(yaw_rad), math.sin(yaw_rad), 0)
-    right_vec = carla.Vector3D(math.sin(yaw_rad), -math.cos(yaw_rad), 0)
-    
     print("Spawning vehicles in actual CARLA lanes...")
     
     batch = []
@@ -642,15 +1370,13 @@ def spawn_aligned_traffic(client, world, center_wp, tm):
     vehicle_bps = [x for x in vehicle_bps if int(x.get_attribute('number_of_wheels')) == 4]
     
     spawn_count = 0
-    current_wp = center_wp
+    samples = road_frame.sample(15.0, 0.0, SECTION_LENGTH)  # Every 15 meters
     
-    for i in range(int(SECTION_LENGTH / 15)):  # Every 15 meters
-        if current_wp.is_junction:
-            next_wps = current_wp.next(15.0)
-            if next_wps:
-                current_wp = next_wps[0]
+    for index, is_junction in zip(samples['index'], samples['is_junction']):
+        if is_junction:
             continue
         
+        current_wp = road_frame.waypoint_at(index)
         try:
             for lane_change in [-3, -2, -1, 1, 2, 3]:  # Lanes on each side
                 if random.random() < 0.3:  # 30% spawn rate per lane
@@ -673,12 +1399,6 @@ def spawn_aligned_traffic(client, world, center_wp, tm):
                         spawn_count += 1
         except:
             pass
-        
-        next_wps = current_wp.next(15.0)
-        if next_wps:
-            current_wp = next_wps[0]
-        else:
-            break
     
     print(f"Generated {spawn_count} spawn points in actual lanes")
 
@@ -702,7 +1422,7 @@ def spawn_aligned_traffic(client, world, center_wp, tm):
 
 
 
-def create_virtual_lane4(world, center_wp, mode, right_vec):
+def create_virtual_lane4(world, road_frame, mode):
     """
     Create a VIRTUAL LANE 4 by spawning invisible static vehicles as lane markers.
     This tricks CARLA's Traffic Manager into treating the space as driveable.
@@ -718,28 +1438,22 @@ def create_virtual_lane4(world, center_wp, mode, right_vec):
     try:
         marker_bp = bp_lib.find('static.prop.streetbarrier')
         
-        current_wp = center_wp
         marker_count = 0
         
-        for i in range(int(SECTION_LENGTH / 50)):
-            if current_wp.is_junction:
-                next_wps = current_wp.next(50.0)
-                if next_wps:
-                    current_wp = next_wps[0]
-                continue
-            
+        samples = road_frame.sample(50.0, 0.0, SECTION_LENGTH)
+        samples = {key: values[~samples['is_junction']] for key, values in samples.items()}
+        
+        if mode == 1:  # 4-2 mode: lane 4 is at -14m (4 lanes * 3.5m)
+            lane4_offset = -14.0
+        else:  # 2-4 mode: lane 4 is at +14m
+            lane4_offset = 14.0
+        
+        # Place underground so invisible but exists
+        marker_locs = road_frame.offset_locations(samples, lane4_offset, dz=-10.0)
+        
+        for marker_loc, yaw in zip(marker_locs, samples['yaw'].tolist()):
             try:
-                if mode == 1:  # 4-2 mode: lane 4 is at -14m (4 lanes * 3.5m)
-                    lane4_offset = -14.0
-                else:  # 2-4 mode: lane 4 is at +14m
-                    lane4_offset = 14.0
-                
-                marker_loc = current_wp.transform.location
-                marker_loc.x += right_vec.x * lane4_offset
-                marker_loc.y += right_vec.y * lane4_offset
-                marker_loc.z -= 10.0  # Place underground so invisible but exists
-                
-                marker_transform = carla.Transform(marker_loc, current_wp.transform.rotation)
+                marker_transform = carla.Transform(marker_loc, carla.Rotation(yaw=yaw))
                 marker = world.try_spawn_actor(marker_bp, marker_transform)
                 
                 if marker:
@@ -748,12 +1462,6 @@ def create_virtual_lane4(world, center_wp, mode, right_vec):
                     marker_count += 1
             except:
                 pass
-            
-            next_wps = current_wp.next(50.0)
-            if next_wps:
-                current_wp = next_wps[0]
-            else:
-                break
         
         print(f"Created {marker_count} virtual lane markers")
     except Exception as e:
@@ -761,39 +1469,32 @@ def create_virtual_lane4(world, center_wp, mode, right_vec):
     
     return lane_markers
 
-def force_vehicles_to_lane4(vehicles, center_wp, right_vec, fwd_vec):
+def force_vehicles_to_lane4(snapshot, center_wp, right_vec, fwd_vec):
     """Force vehicles from lanes 1, 2, 3 to move into the new lane 4 (between yellow lines)"""
     moved_count = 0
     
-    for vehicle in vehicles:
+    start_loc = center_wp.transform.location
+    
+    # Lateral position relative to center and forward/backward position (distance along the road)
+    lateral_offset = snapshot.lateral_offsets(start_loc, right_vec)
+    forward_offset = snapshot.longitudinal_offsets(start_loc, fwd_vec)
+    
+    # Check if vehicle is in RIGHT lanes 1, 2, or 3 (offset -1.75 to -10.5m)
+    # Lane -1: -1.75m, Lane -2: -5.25m, Lane -3: -8.75m
+    in_lanes_1_to_3 = np.nonzero((-11.0 < lateral_offset) & (lateral_offset < -0.5))[0]
+    
+    for i in in_lanes_1_to_3:
         try:
-            if not vehicle.is_alive:
-                continue
-                
-            v_loc = vehicle.get_location()
-            v_transform = vehicle.get_transform()
-            
-            # Calculate lateral position relative to center
-            dx = v_loc.x - center_wp.transform.location.x
-            dy = v_loc.y - center_wp.transform.location.y
-            lateral_offset = (dx * right_vec.x) + (dy * right_vec.y)
-            
-            # Calculate forward/backward position (distance along the road)
-            forward_offset = (dx * fwd_vec.x) + (dy * fwd_vec.y)
+            # Move vehicle to lane 4 laterally (0.0m offset) but keep forward position
+            new_loc = carla.Location(
+                x=start_loc.x + (fwd_vec.x * forward_offset[i]),
+                y=start_loc.y + (fwd_vec.y * forward_offset[i]),
+                z=snapshot.z[i]
+            )
             
-            # Check if vehicle is in RIGHT lanes 1, 2, or 3 (offset -1.75 to -10.5m)
-            # Lane -1: -1.75m, Lane -2: -5.25m, Lane -3: -8.75m
-            if -11.0 < lateral_offset < -0.5:  # In lanes 1, 2, or 3
-                # Move vehicle to lane 4 laterally (0.0m offset) but keep forward position
-                new_loc = carla.Location(
-                    x=center_wp.transform.location.x + (fwd_vec.x * forward_offset),
-                    y=center_wp.transform.location.y + (fwd_vec.y * forward_offset),
-                    z=v_loc.z
-                )
-                
-                # Keep same forward direction
-                vehicle.set_transform(carla.Transform(new_loc, v_transform.rotation))
-                moved_count += 1
+            # Keep same forward direction
+            snapshot.actors[i].set_transform(carla.Transform(new_loc, carla.Rotation(yaw=snapshot.yaw[i])))
+            moved_count += 1
                 
         except Exception as e:
             continue
@@ -803,7 +1504,7 @@ def force_vehicles_to_lane4(vehicles, center_wp, right_vec, fwd_vec):
     
     return moved_count
 
-def spawn_lane4_vehicles(client, world, center_wp, tm, vehicles, mode, right_vec):
+def spawn_lane4_vehicles(client, world, road_frame, tm, vehicles, mode):
     """Spawn additional vehicles in the new 4th lane after median shift - BEHIND camera view on RIGHT side"""
     if mode not in [1, 2]:
         return 0
@@ -817,47 +1518,26 @@ def spawn_lane4_vehicles(client, world, center_wp, tm, vehicles, mode, right_vec
     spawned = 0
     
     # Start FAR BEHIND the camera view so vehicles drive INTO view naturally
-    # Go back 300m before camera
-    start_wp = center_wp
-    for _ in range(60):  # Go back 300m (60 * 5m steps)
-        prev_wps = start_wp.previous(5.0)
-        if prev_wps:
-            start_wp = prev_wps[0]
-        else:
-            break
+    # Spawn vehicles from 300m before the camera up to the camera position (every 5m)
+    samples = road_frame.sample(5.0, -300.0, 0.0)
+    samples = {key: values[~samples['is_junction']] for key, values in samples.items()}
     
-    current_wp = start_wp
+    # The 4th lane is the NEW lane in the space between yellow median lines
+    # This is where the median used to be - offset 0.0m (center of road)
+    # In photo: labeled as "3" (yellow) between the two yellow median lines
+    lane4_offset = 0.0  # Center of road - the space between yellow median lines (4th forward lane)
+    lane4_left_offset = -12.25  # 2-4 mode: LEFT side, negative offset
     
-    # Spawn vehicles from far behind camera position
-    for i in range(60):  # 300m section (far behind camera)
-        if not current_wp or current_wp.is_junction:
-            next_wps = current_wp.next(5.0) if current_wp else None
-            if next_wps:
-                current_wp = next_wps[0]
-            continue
-        
+    spawn_locs = road_frame.offset_locations(samples, lane4_offset if mode == 1 else lane4_left_offset, dz=0.5)
+    
+    for spawn_loc, pitch, yaw, roll in zip(spawn_locs, samples['pitch'].tolist(), samples['yaw'].tolist(), samples['roll'].tolist()):
         try:
             if mode == 1:  # 4-2 mode: spawn in lane -4 (4th forward lane, rightmost)
                 # Lane -4 is the rightmost forward lane on RIGHT side
                 # RIGHT side lanes: -1 (inner), -2, -3, -4 (outer)
-                # Lane -4 center is at approximately -12.25m (negative = RIGHT side)
-                
-                yaw_rad = math.radians(current_wp.transform.rotation.yaw)
-                fwd = carla.Vector3D(math.cos(yaw_rad), math.sin(yaw_rad), 0)
-                right = carla.Vector3D(-fwd.y, fwd.x, 0)
-                
-                # The 4th lane is the NEW lane in the space between yellow median lines
-                # This is where the median used to be - offset 0.0m (center of road)
-                # In photo: labeled as "3" (yellow) between the two yellow median lines
-                lane4_offset = 0.0  # Center of road - the space between yellow median lines (4th forward lane)
-                
-                spawn_loc = current_wp.transform.location
-                spawn_loc.x += right.x * lane4_offset
-                spawn_loc.y += right.y * lane4_offset
-                spawn_loc.z += 0.5
                 
                 # FORWARD direction (RED arrow - same as waypoint direction)
-                spawn_transform = carla.Transform(spawn_loc, current_wp.transform.rotation)
+                spawn_transform = carla.Transform(spawn_loc, carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
                 
                 if random.random() < 0.6:  # 60% spawn rate
                     bp = random.choice(vehicle_bps)
@@ -876,20 +1556,8 @@ def spawn_lane4_vehicles(client, world, center_wp, tm, vehicles, mode, right_vec
                         spawned += 1
             
             else:  # 2-4 mode: spawn in backward lane 4 on left side
-                yaw_rad = math.radians(current_wp.transform.rotation.yaw)
-                fwd = carla.Vector3D(math.cos(yaw_rad), math.sin(yaw_rad), 0)
-                right = carla.Vector3D(-fwd.y, fwd.x, 0)
-                
-                lane4_left_offset = -12.25  # LEFT side, negative offset
-                
-                spawn_loc = current_wp.transform.location
-                spawn_loc.x += right.x * lane4_left_offset
-                spawn_loc.y += right.y * lane4_left_offset
-                spawn_loc.z += 0.5
-                
                 # Reverse the rotation for backward traffic
-                spawn_rot = current_wp.transform.rotation
-                spawn_rot.yaw = (spawn_rot.yaw + 180) % 360
+                spawn_rot = carla.Rotation(pitch=pitch, yaw=(yaw + 180) % 360, roll=roll)
                 spawn_transform = carla.Transform(spawn_loc, spawn_rot)
                 
                 if random.random() < 0.6:
@@ -907,25 +1575,60 @@ def spawn_lane4_vehicles(client, world, center_wp, tm, vehicles, mode, right_vec
                         spawned += 1
         except Exception as e:
             pass
-        
-        next_wps = current_wp.next(5.0)
-        if next_wps:
-            current_wp = next_wps[0]
-        else:
-            break
     
     print(f"Spawned {spawned} vehicles in lane -4 (4th forward lane, RED arrow direction)")
     return spawned
 
-def draw_virtual_lane4_boundaries(world, center_wp, mode, right_vec):
+class Lane4BoundaryOverlay:
     """
     Draw visual boundaries for the virtual lane 4 so it looks like a real lane.
     This helps for the project presentation/demo.
+    
+    The boundary polyline is computed once per mode change and cached; redraws
+    happen every redraw_interval seconds with lines that live until the next one.
     """
-    if mode not in [1, 2]:
-        return
+    def __init__(self, world, road_frame, redraw_interval=LANE4_OVERLAY_REDRAW_INTERVAL):
+        self.world = world
+        self.road_frame = road_frame
+        self.redraw_interval = redraw_interval
+        self.mode = None
+        self.segments = []
+        self.last_draw_time = None
+    
+    def draw(self, mode, elapsed_time):
+        if mode not in [1, 2]:
+            self.mode = None
+            self.segments = []
+            return
         
-    start_loc = center_wp.transform.location
+        if mode != self.mode:
+            self.segments = lane4_boundary_segments(self.road_frame, mode)
+            self.mode = mode
+            self.last_draw_time = None
+        
+        if self.last_draw_time is not None and elapsed_time - self.last_draw_time < self.redraw_interval:
+            return
+        
+        # Slight overlap with the next redraw so the lines never flicker
+        life_time = self.redraw_interval + 0.1
+        for p1_inner, p2_inner, p1_outer, p2_outer in self.segments:
+            self.world.debug.draw_line(p1_inner, p2_inner, thickness=0.1, color=carla.Color(255, 255, 255), life_time=life_time)
+            self.world.debug.draw_line(p1_outer, p2_outer, thickness=0.1, color=carla.Color(255, 0, 0), life_time=life_time)
+        self.last_draw_time = elapsed_time
+
+def lane4_boundary_segments(road_frame, mode):
+    """
+    Line segments of the virtual lane 4 boundaries for a lane configuration.
+    
+    Only computes geometry; Lane4BoundaryOverlay caches the result and does
+    the drawing.
+    
+    Returns:
+        list: (p1_inner, p2_inner, p1_outer, p2_outer) line segments every 5 meters,
+            empty in 3-3 mode
+    """
+    if mode not in [1, 2]:
+        return []
     
     if mode == 1:  # 4-2 mode (Lane 4 is on the left, approx -14m)
         # Inner boundary (shared with lane 3)
@@ -935,121 +1638,161 @@ def draw_virtual_lane4_boundaries(world, center_wp, mode, right_vec):
     else:  # 2-4 mode (Lane 4 is on the right, approx +14m)
         inner_offset = 10.5
         outer_offset = 14.0
-        
-    current_wp = center_wp
-    for i in range(int(SECTION_LENGTH / 5)):  # Every 5 meters
-        if current_wp.is_junction:
-            next_wps = current_wp.next(5.0)
-            if next_wps: current_wp = next_wps[0]
+    
+    # Every 5 meters, plus the end point of the last segment
+    samples = road_frame.sample(5.0, 0.0, SECTION_LENGTH + 5.0)
+    inner = road_frame.offset_locations(samples, inner_offset, dz=0.1)
+    outer = road_frame.offset_locations(samples, outer_offset, dz=0.1)
+    
+    segments = []
+    for i in range(len(inner) - 1):
+        if samples['is_junction'][i]:
             continue
-            
-        loc = current_wp.transform.location
-        
-        p1_inner = carla.Location(
-            x = loc.x + (right_vec.x * inner_offset),
-            y = loc.y + (right_vec.y * inner_offset),
-            z = loc.z + 0.1
-        )
-        
-        p1_outer = carla.Location(
-            x = loc.x + (right_vec.x * outer_offset),
-            y = loc.y + (right_vec.y * outer_offset),
-            z = loc.z + 0.1
-        )
-        
-        next_wps = current_wp.next(5.0)
-        if next_wps:
-            next_wp = next_wps[0]
-            loc_next = next_wp.transform.location
-            
-            p2_inner = carla.Location(
-                x = loc_next.x + (right_vec.x * inner_offset),
-                y = loc_next.y + (right_vec.y * inner_offset),
-                z = loc_next.z + 0.1
-            )
-            
-            p2_outer = carla.Location(
-                x = loc_next.x + (right_vec.x * outer_offset),
-                y = loc_next.y + (right_vec.y * outer_offset),
-                z = loc_next.z + 0.1
-            )
-            
-            world.debug.draw_line(p1_inner, p2_inner, thickness=0.1, color=carla.Color(255, 255, 255), life_time=0.1)
-            world.debug.draw_line(p1_outer, p2_outer, thickness=0.1, color=carla.Color(255, 0, 0), life_time=0.1)
-            
-            current_wp = next_wp
-        else:
-            break
+        segments.append((inner[i], inner[i + 1], outer[i], outer[i + 1]))
+    
+    return segments
+
+# Lane boundaries on the offset relative to the median (metres, negative = forward side).
+# Forward lanes 1-4 run from the road edge in to the median, backward lanes 1-4
+# from the median out to the edge. Slots 0-3 are forward lanes, 4-7 backward
+# lanes and slot 8 collects vehicles on the wrong side of the median.
+FORWARD_LANE_EDGES = np.array([-10.5, -7.0, -3.5, 0.0])
+BACKWARD_LANE_EDGES = np.array([0.0, 3.5, 7.0, 10.5])
+NUM_LANE_SLOTS = 8
+
+def classify_lanes(speeds_kmh, is_forward, relative_offset):
+    """
+    Bin vehicles into lane slots and accumulate per-lane statistics.
+    
+    Args:
+        speeds_kmh (np.ndarray): Vehicle speeds in km/h
+        is_forward (np.ndarray): Boolean direction mask
+        relative_offset (np.ndarray): Lateral offset from the median in metres
+    
+    Returns:
+        tuple: (lane_slot, counts, speed_sums, slow_counts) where lane_slot is the
+            per-vehicle slot (0-7, 8 = unclassified) and the others are length-8 arrays
+    """
+    forward_slot = np.digitize(relative_offset, FORWARD_LANE_EDGES)  # 4 = past the median
+    backward_slot = np.digitize(relative_offset, BACKWARD_LANE_EDGES) + 3  # 3 = past the median
+    
+    lane_slot = np.where(is_forward, forward_slot, backward_slot)
+    lane_slot[(lane_slot == 4) & is_forward] = NUM_LANE_SLOTS
+    lane_slot[(lane_slot == 3) & ~is_forward] = NUM_LANE_SLOTS
+    
+    counts = np.bincount(lane_slot, minlength=NUM_LANE_SLOTS + 1)[:NUM_LANE_SLOTS]
+    speed_sums = np.bincount(lane_slot, weights=speeds_kmh, minlength=NUM_LANE_SLOTS + 1)[:NUM_LANE_SLOTS]
+    slow_counts = np.bincount(lane_slot, weights=speeds_kmh < SPEED_THRESHOLD,
+                              minlength=NUM_LANE_SLOTS + 1)[:NUM_LANE_SLOTS].astype(np.int64)
+    
+    return lane_slot, counts, speed_sums, slow_counts
+
+def default_zones():
+    """
+    Detector zones from the current MONITOR_DISTANCE and SECTION_LENGTH.
+    
+    Arc lengths follow the forward direction: 'upstream' is the approach
+    before the median starts, 'median' its first MONITOR_DISTANCE meters
+    and 'downstream' the rest of the section.
+    """
+    return [
+        ('upstream', -MONITOR_DISTANCE, 0.0),
+        ('median', 0.0, MONITOR_DISTANCE),
+        ('downstream', MONITOR_DISTANCE, float(SECTION_LENGTH)),
+    ]
+
+def classify_zones(lane_slot, speeds_kmh, arc_length, zones, lanes_in_use=MODE_LANES[0], upstream_lane_slot=None):
+    """
+    Per-zone lane statistics from one bincount over (zone, lane slot).
+    
+    Args:
+        lane_slot (np.ndarray): Per-vehicle lane slot from classify_lanes
+        speeds_kmh (np.ndarray): Vehicle speeds in km/h
+        arc_length (np.ndarray): Vehicle arc length in meters (NaN = off the road frame)
+        zones (list): (name, start, end) arc-length ranges; later zones win where they overlap
+        lanes_in_use (tuple): Forward and backward lanes open to traffic past the
+            median start, for occupancy; zones ending at or before arc length 0
+            always have MODE_LANES[0]
+        upstream_lane_slot (np.ndarray): Lane slots classified without the median
+            offset, used for zones ending at or before arc length 0 (default: lane_slot)
+    
+    Returns:
+        dict: zone name -> {'start', 'end', 'forward', 'backward'}, each direction
+            with count, slow, avg_speed, occupancy_pct and lane_counts
+    """
+    n_zones = len(zones)
+    zone = np.full(len(lane_slot), n_zones, dtype=np.int64)
+    for k, (_, start, end) in enumerate(zones):
+        zone[(arc_length >= start) & (arc_length < end)] = k
+    if upstream_lane_slot is not None:
+        before_median = np.isin(zone, [k for k, (_, _, end) in enumerate(zones) if end <= 0])
+        lane_slot = np.where(before_median, upstream_lane_slot, lane_slot)
+    
+    key = zone * (NUM_LANE_SLOTS + 1) + lane_slot
+    shape = (n_zones + 1, NUM_LANE_SLOTS + 1)
+    counts = np.bincount(key, minlength=shape[0] * shape[1]).reshape(shape)
+    speed_sums = np.bincount(key, weights=speeds_kmh, minlength=shape[0] * shape[1]).reshape(shape)
+    slow_counts = np.bincount(key, weights=speeds_kmh < SPEED_THRESHOLD, minlength=shape[0] * shape[1]).reshape(shape)
+    
+    stats = {}
+    for k, (name, start, end) in enumerate(zones):
+        length = end - start
+        stats[name] = {'start': start, 'end': end}
+        zone_lanes = MODE_LANES[0] if end <= 0 else lanes_in_use  # No median before arc length 0
+        for direction, lanes, open_lanes in (('forward', slice(0, 4), zone_lanes[0]),
+                                             ('backward', slice(4, 8), zone_lanes[1])):
+            count = int(counts[k, lanes].sum())
+            stats[name][direction] = {
+                'count': count,
+                'slow': int(slow_counts[k, lanes].sum()),
+                'avg_speed': round(float(speed_sums[k, lanes].sum()) / count, 2) if count else 0.0,
+                'occupancy_pct': round(100.0 * count * ZONE_VEHICLE_LENGTH / (length * open_lanes), 2) if length > 0 else 0.0,
+                'lane_counts': counts[k, lanes].tolist()
+            }
+    return stats
 
-def analyze_traffic(world, vehicles, center_wp, fwd_vec, right_vec, median_position=0.0):
-    """Analyze traffic across the ENTIRE highway section, not just one point"""
+def analyze_traffic(snapshot, center_wp, fwd_vec, right_vec, median_position=0.0, road_frame=None, zones=None,
+                    lanes_in_use=MODE_LANES[0]):
+    """
+    Analyze traffic across the ENTIRE highway section, not just one point.
+    
+    The seventh returned value is the per-vehicle lane slot (row-aligned
+    with the snapshot), reused for the dashboard's vehicle frames. The last
+    one holds per-zone statistics (see classify_zones) when a road_frame is
+    given, and is empty otherwise; lanes_in_use is the current median
+    mode's lane configuration (MODE_LANES), the divisor for zone occupancy.
+    """
     start_loc = center_wp.transform.location
     
-    lane_vehicles = {
-        'forward': [[], [], [], []],  # 4 possible forward lanes
-        'backward': [[], [], [], []]  # 4 possible backward lanes (even if not all used)
-    }
+    is_forward = snapshot.is_forward(center_wp.transform.rotation.yaw)
+    lateral_offset = snapshot.lateral_offsets(start_loc, right_vec)
+    relative_offset = lateral_offset - median_position
     
-    for v in vehicles:
-        try:
-            vel = v.get_velocity()
-            speed_kmh = 3.6 * math.sqrt(vel.x**2 + vel.y**2 + vel.z**2)
-            loc = v.get_location()
-            
-            v_rotation = v.get_transform().rotation
-            
-            yaw_diff = abs(v_rotation.yaw - center_wp.transform.rotation.yaw)
-            if yaw_diff > 180:
-                yaw_diff = 360 - yaw_diff
-            
-            is_forward = yaw_diff < 90
-            
-            dx = loc.x - start_loc.x
-            dy = loc.y - start_loc.y
-            
-            lateral_offset = (dx * right_vec.x) + (dy * right_vec.y)
-            
-            if is_forward:
-                relative_offset = lateral_offset - median_position
-                if relative_offset < -10.5:
-                    lane_vehicles['forward'][0].append(speed_kmh)  # Rightmost (lane 1)
-                elif -10.5 <= relative_offset < -7:
-                    lane_vehicles['forward'][1].append(speed_kmh)  # Lane 2
-                elif -7 <= relative_offset < -3.5:
-                    lane_vehicles['forward'][2].append(speed_kmh)  # Lane 3
-                elif -3.5 <= relative_offset < 0:
-                    lane_vehicles['forward'][3].append(speed_kmh)  # Lane 4 (leftmost, nearest median)
-            else:
-                relative_offset = lateral_offset - median_position
-                if 0 <= relative_offset < 3.5:
-                    lane_vehicles['backward'][0].append(speed_kmh)  # Lane 1 (nearest median)
-                elif 3.5 <= relative_offset < 7:
-                    lane_vehicles['backward'][1].append(speed_kmh)  # Lane 2
-                elif 7 <= relative_offset < 10.5:
-                    lane_vehicles['backward'][2].append(speed_kmh)  # Lane 3
-                elif relative_offset >= 10.5:
-                    lane_vehicles['backward'][3].append(speed_kmh)  # Lane 4 (leftmost)
-        except:
-            continue
+    speeds_kmh = snapshot.speed_kmh
+    lane_slot, counts, speed_sums, slow_counts = classify_lanes(speeds_kmh, is_forward, relative_offset)
+    
+    zone_stats = {}
+    if road_frame is not None:
+        upstream_lane_slot = classify_lanes(speeds_kmh, is_forward, lateral_offset)[0] if median_position else None
+        zone_stats = classify_zones(lane_slot, speeds_kmh, snapshot.arc_lengths(road_frame)[0],
+                                    default_zones() if zones is None else zones, lanes_in_use, upstream_lane_slot)
     
     lane_counts = {
-        'forward': [len(lane_vehicles['forward'][i]) for i in range(4)],
-        'backward': [len(lane_vehicles['backward'][i]) for i in range(4)]
+        'forward': counts[:4].tolist(),
+        'backward': counts[4:].tolist()
     }
     
-    forward_congested = sum(1 for lane in lane_vehicles['forward'] for s in lane if s < SPEED_THRESHOLD)
-    backward_congested = sum(1 for lane in lane_vehicles['backward'] for s in lane if s < SPEED_THRESHOLD)
+    forward_congested = int(slow_counts[:4].sum())
+    backward_congested = int(slow_counts[4:].sum())
     
-    all_forward = [s for lane in lane_vehicles['forward'] for s in lane]
-    all_backward = [s for lane in lane_vehicles['backward'] for s in lane]
+    total_forward_vehicles = sum(lane_counts['forward'])
+    total_backward_vehicles = sum(lane_counts['backward'])
     
     avg_speeds = {
-        'forward': sum(all_forward) / len(all_forward) if all_forward else 0.1,
-        'backward': sum(all_backward) / len(all_backward) if all_backward else 0.1
+        'forward': float(speed_sums[:4].sum()) / total_forward_vehicles if total_forward_vehicles else 0.1,
+        'backward': float(speed_sums[4:].sum()) / total_backward_vehicles if total_backward_vehicles else 0.1
     }
     
-    total_forward_vehicles = sum(lane_counts['forward'])
-    
     congestion_pct = (forward_congested / total_forward_vehicles * 100) if total_forward_vehicles > 0 else 0
     
     congestion_status = {
@@ -1057,15 +1800,299 @@ def analyze_traffic(world, vehicles, center_wp, fwd_vec, right_vec, median_posit
         'backward': backward_congested >= CONGESTION_THRESHOLD
     }
     
-    return lane_counts, avg_speeds, congestion_status, forward_congested, backward_congested, congestion_pct
+    return lane_counts, avg_speeds, congestion_status, forward_congested, backward_congested, congestion_pct, lane_slot, zone_stats
 
+class CongestionDetector:
+    """
+    Streaming congestion state for one carriageway, fed once per tick.
+    
+    Keeps ring buffers of the slow-vehicle count, density and average speed
+    over the last DETECTOR_WINDOW seconds with running sums, so each update
+    is O(1). Alongside the window means it tracks an EWMA of the slow count
+    and two one-sided CUSUMs: one accumulates vehicle-seconds above
+    CONGESTION_THRESHOLD, the other vehicle-seconds below the release level.
+    The state only turns on through the chosen trigger (DETECTOR_METHOD) and
+    only turns off once the count has fallen to DETECTOR_RELEASE_RATIO of the
+    threshold, so a single noisy tick cannot start or cancel a median shift.
+    """
+    def __init__(self, threshold=None, window=None, dt=0.05, method=None):
+        self.threshold = float(CONGESTION_THRESHOLD if threshold is None else threshold)
+        self.release = self.threshold * DETECTOR_RELEASE_RATIO
+        self.method = method or DETECTOR_METHOD
+        if self.method not in ('cusum', 'ewma', 'window'):
+            raise ValueError(f"Unknown detector method: {self.method}")
+        self.dt = dt
+        self.alpha = 1.0 - math.exp(-dt / DETECTOR_EWMA_TAU)
+        
+        size = max(1, int(round((window or DETECTOR_WINDOW) / dt)))
+        self.buffer = np.zeros((3, size))  # slow count, density, speed
+        self.sums = np.zeros(3)
+        self.head = 0
+        self.filled = 0
+        
+        self.ewma = 0.0
+        self.cusum_on = 0.0
+        self.cusum_off = 0.0
+        self.congested = False
+        self.changed_at = 0.0
+        self.triggers = 0
+        self.congested_time = 0.0
+        self.time = 0.0
+    
+    def update(self, slow_count, density, speed):
+        """
+        Add one tick of measurements.
+        
+        Args:
+            slow_count (int): Vehicles below SPEED_THRESHOLD this tick
+            density (float): Vehicles per km of section
+            speed (float): Average speed in km/h
+        
+        Returns:
+            bool: Congestion state after this tick
+        """
+        self.time += self.dt
+        sample = (float(slow_count), float(density), float(speed))
+        
+        # Replace the oldest sample; rebuild the sums once per lap so rounding cannot drift
+        column = self.buffer[:, self.head]
+        self.sums += np.subtract(sample, column)
+        column[:] = sample
+        self.head = (self.head + 1) % self.buffer.shape[1]
+        self.filled = min(self.filled + 1, self.buffer.shape[1])
+        if self.head == 0:
+            self.sums = self.buffer.sum(axis=1)
+        
+        count = sample[0]
+        self.ewma += self.alpha * (count - self.ewma)
+        
+        if self.congested:
+            self.cusum_off = max(0.0, self.cusum_off + (self.release - count) * self.dt)
+        else:
+            self.cusum_on = max(0.0, self.cusum_on + (count - self.threshold) * self.dt)
+        
+        if self.method == 'cusum':
+            signal = self.cusum_off if self.congested else self.cusum_on
+            flip = signal >= DETECTOR_CUSUM_LIMIT
+        else:
+            level = self.ewma if self.method == 'ewma' else self.sums[0] / self.filled
+            flip = level <= self.release if self.congested else level >= self.threshold
+        
+        if flip:
+            self.congested = not self.congested
+            self.changed_at = self.time
+            self.cusum_on = 0.0
+            self.cusum_off = 0.0
+            if self.congested:
+                self.triggers += 1
+        if self.congested:
+            self.congested_time += self.dt
+        return self.congested
+    
+    def window_means(self):
+        """Mean slow count, density and speed over the filled part of the window"""
+        means = self.sums / self.filled if self.filled else self.sums
+        return {
+            'slow_count': float(means[0]),
+            'density_veh_per_km': float(means[1]),
+            'speed_kmh': float(means[2])
+        }
+    
+    def state(self):
+        """JSON-ready detector state for the dashboard"""
+        means = self.window_means()
+        return {
+            'method': self.method,
+            'congested': self.congested,
+            'since': round(self.changed_at, 2),
+            'ewma_slow_count': round(self.ewma, 2),
+            'cusum': round(self.cusum_off if self.congested else self.cusum_on, 2),
+            'window_slow_count': round(means['slow_count'], 2),
+            'window_density_veh_per_km': round(means['density_veh_per_km'], 2),
+            'window_speed_kmh': round(means['speed_kmh'], 2)
+        }
 
+class ShiftController(abc.ABC):
+    """
+    Decides the lane configuration; main() carries out the shift.
+    
+    observe() is called once per tick with the forward carriageway's
+    measurements and feeds the controller's CongestionDetector. decide() is
+    only asked when a shift is allowed at all (MIN_TIME_BETWEEN_SHIFTS has
+    passed and the median is at rest) and returns the wanted mode, leaving
+    a short reason in self.reason. Both must stay well under a millisecond.
+    """
+    name = 'base'
+    
+    def __init__(self, dt=0.05):
+        self.detector = CongestionDetector(dt=dt)
+        self.reason = ''
+        self.zones = {}
+    
+    def observe(self, slow_count, lane_counts, avg_speeds, zones=None):
+        """
+        Add one tick of measurements.
+        
+        Args:
+            slow_count (int): Forward vehicles below SPEED_THRESHOLD
+            lane_counts (dict): Per-lane vehicle counts from analyze_traffic
+            avg_speeds (dict): Average speeds from analyze_traffic
+            zones (dict, optional): Per-zone statistics from analyze_traffic
+        """
+        self.zones = zones or {}
+        density = sum(lane_counts['forward']) / (SECTION_LENGTH / 1000.0)
+        self.detector.update(slow_count, density, avg_speeds['forward'])
+    
+    @abc.abstractmethod
+    def decide(self, mode, time_since_shift):
+        """
+        Args:
+            mode (int): Current mode (0: 3-3, 1: 4-2)
+            time_since_shift (float): Seconds since the last shift
+        
+        Returns:
+            int: Wanted mode
+        """
+    
+    def state(self):
+        """JSON-ready controller state for the dashboard"""
+        return {'name': self.name}
 
+class ReactiveController(ShiftController):
+    """Shifts once the detector reports congestion, returns once it has cleared"""
+    name = 'reactive'
+    
+    def decide(self, mode, time_since_shift):
+        if mode == 0 and self.detector.congested:
+            self.reason = "Congestion detected!"
+            return 1
+        if mode == 1 and not self.detector.congested and time_since_shift > MIN_SHIFTED_TIME:
+            self.reason = "Congestion cleared!"
+            return 0
+        return mode
 
-def main():
-    client = carla.Client('localhost', 2000)
+class ForecastController(ShiftController):
+    """
+    Shifts when congestion is predicted one response time ahead.
+    
+    A median move takes calculate_time_response() seconds, so waiting for
+    the detector means queuing traffic for that long. This controller runs
+    Holt's linear exponential smoothing on the forward slow count (level plus
+    per-second trend, O(1) per tick) and starts the shift when level + trend
+    x response time has stayed past CONGESTION_THRESHOLD for FORECAST_HOLD
+    seconds, or as soon as UPSTREAM_QUEUE_RATIO x threshold slow vehicles sit
+    in the 'upstream' detector zone for that long. The detector still
+    triggers a shift if the forecast missed it.
+    Going back to 3-3 is another move of the same length, so it waits until
+    the forecast has stayed below the release level for a whole horizon.
+    """
+    name = 'forecast'
+    
+    def __init__(self, dt=0.05, horizon=None):
+        super().__init__(dt)
+        self.dt = dt
+        self.horizon = calculate_time_response() if horizon is None else horizon
+        self.alpha = 1.0 - math.exp(-dt / FORECAST_LEVEL_TAU)
+        self.beta = 1.0 - math.exp(-dt / FORECAST_TREND_TAU)
+        self.level = None
+        self.trend = 0.0  # slow vehicles per second
+        self.forecast = 0.0
+        self.above = 0.0  # seconds the forecast has been past the threshold
+        self.below = 0.0  # seconds the forecast has been under the release level
+        self.queued = False  # upstream zone holds a queue
+    
+    def observe(self, slow_count, lane_counts, avg_speeds, zones=None):
+        super().observe(slow_count, lane_counts, avg_speeds, zones)
+        if self.level is None:
+            self.level = float(slow_count)
+        previous = self.level
+        self.level += self.alpha * (slow_count - self.level)
+        self.trend += self.beta * ((self.level - previous) / self.dt - self.trend)
+        self.forecast = max(0.0, self.level + self.trend * self.horizon)
+        
+        threshold = self.detector.threshold
+        # A queue already forming upstream will reach the median within the horizon
+        upstream = self.zones.get('upstream', {}).get('forward', {})
+        self.queued = upstream.get('slow', 0) >= threshold * UPSTREAM_QUEUE_RATIO
+        if self.queued or (self.forecast >= threshold and self.level >= threshold * FORECAST_MIN_LEVEL_RATIO):
+            self.above += self.dt
+        else:
+            self.above = 0.0
+        self.below = self.below + self.dt if self.forecast <= self.detector.release else 0.0
+    
+    def decide(self, mode, time_since_shift):
+        if mode == 0:
+            if self.above >= FORECAST_HOLD:
+                self.reason = f"Congestion forecast in {self.horizon:.0f}s!"
+                return 1
+            if self.detector.congested:
+                self.reason = "Congestion detected!"
+                return 1
+        elif (not self.detector.congested and self.below >= self.horizon
+              and time_since_shift > MIN_SHIFTED_TIME):
+            self.reason = "Congestion cleared!"
+            return 0
+        return mode
+    
+    def state(self):
+        return {
+            'name': self.name,
+            'horizon_seconds': round(self.horizon, 2),
+            'level': round(self.level or 0.0, 2),
+            'trend_per_second': round(self.trend, 3),
+            'forecast_slow_count': round(self.forecast, 2),
+            'upstream_queue': self.queued
+        }
+
+SHIFT_CONTROLLERS = {
+    'reactive': ReactiveController,
+    'forecast': ForecastController,
+}
+
+def make_controller(name=None, dt=0.05):
+    """Instantiate a controller from SHIFT_CONTROLLERS (default SHIFT_CONTROLLER)"""
+    name = name or SHIFT_CONTROLLER
+    if name not in SHIFT_CONTROLLERS:
+        raise ValueError(f"Unknown shift controller: {name} (choose from {', '.join(SHIFT_CONTROLLERS)})")
+    return SHIFT_CONTROLLERS[name](dt=dt)
+
+
+
+
+def main(duration=SIMULATION_DURATION, seed=None, results_file='simulation_results.json',
+         data_file=None, dashboard=True, session=None, carla_port=CARLA_PORT, tm_port=TM_PORT,
+         controller=None):
+    """
+    Run one simulation session.
+    
+    Args:
+        duration (float): Simulated seconds before the session ends
+        seed (int): Seed for traffic generation (None = time based)
+        results_file (str): Results store to append to (None = don't save)
+        data_file (str): Per-second CSV log (None = timestamped name)
+        dashboard (bool): Publish state and accept commands from the dashboard
+        session (str): Session id given by the dashboard's session manager; selects
+            this simulator's own state/command channels (None = the default ones)
+        carla_port (int): CARLA server port
+        tm_port (int): Traffic Manager port
+        controller (str): Shift controller from SHIFT_CONTROLLERS (None = SHIFT_CONTROLLER)
+    
+    Returns:
+        dict: The metrics of this session (as appended to results_file)
+    """
+    if seed is not None:
+        random.seed(seed)
+    
+    client = carla.Client(CARLA_HOST, carla_port)
     client.set_timeout(600.0)
     
+    # Commands queued by the dashboard from now on (including during setup) are applied
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    channels = channel_names(session, base_dir)
+    command_inbox = None
+    if dashboard:
+        command_inbox = CommandInbox(channels['command_file'], channels['ack_file'])
+    
     print("\n" + "="*60)
     print(" Dynamic Median Traffic Simulation")
     print(" Congestion-Based Lane Management")
@@ -1075,7 +2102,8 @@ def main():
     try:
         print("\nLoading Town05...")
         world = client.load_world('Town05')
-        time.sleep(2)
+        if not HEADLESS:
+            time.sleep(2)
     except:
         print("Using current map...")
         world = client.get_world()
@@ -1086,21 +2114,23 @@ def main():
     settings.fixed_delta_seconds = 0.05
     world.apply_settings(settings)
     
-    tm = client.get_trafficmanager(8000)
+    tm = client.get_trafficmanager(tm_port)
     tm.set_synchronous_mode(True)
     tm.global_percentage_speed_difference(20.0)  # Slower traffic for congestion
     tm.set_global_distance_to_leading_vehicle(2.5)  # More spacing allows lane changes
     tm.set_hybrid_physics_mode(True)  # Better performance
     tm.set_hybrid_physics_radius(70.0)  # Physics detail radius
-    tm.set_random_device_seed(int(time.time()))  # Random behavior for natural traffic
+    tm.set_random_device_seed(seed if seed is not None else int(time.time()))  # Random behavior for natural traffic
     tm.set_respawn_dormant_vehicles(False)  # Don't respawn vehicles that go "off-road"
     print("Traffic Manager configured for 4-lane operation")
 
-    pygame.init()
-    display = pygame.display.set_mode((800, 150))
-    pygame.display.set_caption("Traffic Simulation - Automated Setup")
+    display = None
+    if not HEADLESS:
+        pygame.init()
+        display = pygame.display.set_mode((800, 150))
+        pygame.display.set_caption("Traffic Simulation - Automated Setup")
+        font = pygame.font.Font(None, 24)
     spectator = world.get_spectator()
-    font = pygame.font.Font(None, 24)
     
     print("\n" + "="*60)
     print(" Selecting 6-lane highway...")
@@ -1129,9 +2159,15 @@ def main():
     clear_all_highway_obstacles(world)
     
     print("\nBuilding custom median system...")
-    median = ConcreteMedian(client, world, target_wp)
-    vehicles = spawn_aligned_traffic(client, world, target_wp, tm)
-    data_collector = TrafficDataCollector(f"traffic_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    # Index the highway once: the median, traffic spawns and lane 4 overlay all read from it
+    road_frame = RoadFrame.build(target_wp, SECTION_LENGTH + 5.0, behind=max(300.0, MONITOR_DISTANCE))
+    
+    median = ConcreteMedian(client, world, road_frame)
+    vehicles = spawn_aligned_traffic(client, world, road_frame, tm)
+    trip_tracker = TripTracker(road_frame, 0.0, SECTION_LENGTH)
+    data_file = data_file or f"traffic_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}{'_' + session if session else ''}.csv"
+    trace_path = data_file[:-len('.csv')] + '.trace' if TRAFFIC_TRACE and data_file.endswith('.csv') else None
+    data_collector = TrafficDataCollector(data_file, trace_path=trace_path)
     
     start_loc = target_wp.transform.location
     start_rot = target_wp.transform.rotation
@@ -1143,9 +2179,14 @@ def main():
     cam_loc.x -= math.cos(yaw_rad) * 25
     cam_loc.y -= math.sin(yaw_rad) * 25
     spectator.set_transform(carla.Transform(cam_loc, carla.Rotation(pitch=-45, yaw=start_rot.yaw)))
+    
+    lane4_overlay = Lane4BoundaryOverlay(world, road_frame)
 
     elapsed_time = 0
     mode = 0  # 0: 3-3 lanes, 1: 4-2 lanes
+    controller = make_controller(controller, dt=0.05)
+    zones = DETECTOR_ZONES or default_zones()
+    detector = controller.detector
     last_shift_time = 0
     data_log_interval = 1.0
     last_log_time = 0
@@ -1165,6 +2206,15 @@ def main():
         'actual_shift_duration': 0
     }
     
+    state_channel = None
+    frame_channel = None
+    if dashboard:
+        state_channel = StatePublisher(channels['state_file'], name=channels['state_channel'],
+                                       mirror_file=MIRROR_STATE_FILE)
+        if VEHICLE_FRAMES:
+            frame_channel = FramePublisher(name=channels['frame_channel'])
+    frame_every = max(1, int(round(VEHICLE_FRAME_INTERVAL / 0.05)))
+    
     print("\n" + "="*60)
     print(" Simulation Started")
     print(" Press Ctrl+C to stop")
@@ -1175,11 +2225,15 @@ def main():
             world.tick()
             elapsed_time += 0.05
             
-            valid_vehicles = [v for v in vehicles if v.is_alive]
-            vehicles = valid_vehicles
+            # One snapshot read per tick; every analysis below works on its arrays
+            snapshot = VehicleSnapshot.capture(world, vehicles)
+            vehicles = list(snapshot.actors)
+            trip_tracker.update(snapshot, elapsed_time)
             
-            lane_counts, avg_speeds, congestion_status, fwd_congested, bwd_congested, congestion_pct = \
-                analyze_traffic(world, vehicles, target_wp, fwd_vec, right_vec, median.current_offset)
+            lane_counts, avg_speeds, congestion_status, fwd_congested, bwd_congested, congestion_pct, lane_slot, zone_stats = \
+                analyze_traffic(snapshot, target_wp, fwd_vec, right_vec, median.current_offset, road_frame, zones,
+                                MODE_LANES[mode])
+            controller.observe(fwd_congested, lane_counts, avg_speeds, zone_stats)
             
             median.tick(0.05)
             
@@ -1188,11 +2242,11 @@ def main():
                     simulation_data['median_shift_end_time'] = elapsed_time
                     simulation_data['actual_shift_duration'] = elapsed_time - simulation_data['median_shift_start_time']
             
-            draw_virtual_lane4_boundaries(world, target_wp, median.get_current_mode(), right_vec)
+            lane4_overlay.draw(median.get_current_mode(), elapsed_time)
             
-            median.enforce_separation(vehicles, tm)
+            median.enforce_separation(snapshot, tm)
             
-            if int(elapsed_time * 2) % 2 == 0:  # Update display
+            if display is not None and int(elapsed_time * 2) % 2 == 0:  # Update display
                 display.fill((20, 20, 40))
                 if mode == 1:
                     mode_text = "MODE: 4-2 Lanes (LEFT SHIFT) - LANE 4 ACTIVE"
@@ -1211,7 +2265,8 @@ def main():
                 pygame.display.flip()
             
             if elapsed_time - last_log_time >= data_log_interval:
-                data_collector.record(elapsed_time, mode, lane_counts, avg_speeds, congestion_status, congestion_pct)
+                data_collector.record(elapsed_time, mode, lane_counts, avg_speeds, congestion_status, congestion_pct,
+                                      median.current_offset)
                 
                 simulation_data['speeds'].append(avg_speeds['forward'])
                 simulation_data['vehicle_counts'].append(sum(lane_counts['forward']))
@@ -1229,158 +2284,169 @@ def main():
                 
                 last_log_time = elapsed_time
             
-            try:
-                actual_median_pos = median.current_offset
-                
-                if mode == 1:
-                    mode_str = '4-2'
-                elif mode == 2:
-                    mode_str = '2-4'
-                else:
-                    mode_str = '3-3'
-                
-                state_data = {
-                    'running': True,
-                    'mode': mode_str,
-                    'total_vehicles': len(vehicles),
-                    'forward_vehicles': sum(lane_counts['forward']),
-                    'backward_vehicles': sum(lane_counts['backward']),
-                    'forward_speed': avg_speeds['forward'],
-                    'backward_speed': avg_speeds['backward'],
-                    'congestion_level': congestion_pct,
-                    'time_elapsed': elapsed_time,
-                    'median_position': actual_median_pos,  # Real-time position during animation
-                    'median_target': median.target_offset,  # Target position
-                    'is_moving': median.is_moving,
-                    'lane_data': {
-                        'forward': lane_counts['forward'],
-                        'backward': lane_counts['backward']
-                    },
-                    'last_update': time.time()  # Timestamp for staleness detection
-                }
-                state_file = os.path.join(os.path.dirname(__file__), 'simulation_state.json')
-                with open(state_file, 'w') as f:
-                    json.dump(state_data, f, indent=2)  # Pretty print for debugging
-            except Exception as e:
-                print(f"Error exporting state: {e}")
+            if state_channel is not None:
+                try:
+                    actual_median_pos = median.current_offset
+                    
+                    if mode == 1:
+                        mode_str = '4-2'
+                    elif mode == 2:
+                        mode_str = '2-4'
+                    else:
+                        mode_str = '3-3'
+                    
+                    state_data = {
+                        'running': True,
+                        'mode': mode_str,
+                        'total_vehicles': len(vehicles),
+                        'forward_vehicles': sum(lane_counts['forward']),
+                        'backward_vehicles': sum(lane_counts['backward']),
+                        'forward_speed': avg_speeds['forward'],
+                        'backward_speed': avg_speeds['backward'],
+                        'congestion_level': congestion_pct,
+                        'time_elapsed': elapsed_time,
+                        'median_position': actual_median_pos,  # Real-time position during animation
+                        'median_target': median.target_offset,  # Target position
+                        'is_moving': median.is_moving,
+                        'lane_data': {
+                            'forward': lane_counts['forward'],
+                            'backward': lane_counts['backward']
+                        },
+                        'detector': detector.state(),
+                        'controller': controller.state(),
+                        'zones': zone_stats,
+                        'last_update': time.time()  # Timestamp for staleness detection
+                    }
+                    state_channel.publish(state_data)
+                except Exception as e:
+                    print(f"Error exporting state: {e}")
             
-            # Check for dashboard commands
-            try:
-                cmd_file = os.path.join(os.path.dirname(__file__), 'dashboard_commands.json')
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, 'r') as f:
-                        cmd = json.load(f)
-                        
-                        if cmd.get('action') == 'shift_median':
-                            mode_str = cmd.get('mode', '3-3')
-                            if mode_str == '4-2':
-                                target_mode = 1
-                            elif mode_str == '2-4':
-                                target_mode = 2
-                            else:
-                                target_mode = 0
-                            
-                            if target_mode != mode and not median.is_moving:
-                                print(f"\nDashboard command: Shifting to {mode_str} mode")
-                                median.set_lane_configuration(target_mode, target_wp, right_vec)
-                                force_vehicles_to_lane4(vehicles, target_wp, right_vec, fwd_vec)
-                                spawn_lane4_vehicles(client, world, target_wp, tm, vehicles, target_mode, right_vec)
-                                mode = target_mode
-                                last_shift_time = elapsed_time
-                        
-                        elif cmd.get('action') == 'spawn_vehicles':
-                            count = cmd.get('count', 10)
-                            direction = cmd.get('direction', 'forward')
-                            print(f"\nDashboard: Spawn {count} {direction} vehicles")
-                            if mode in [1, 2]:
-                                spawn_lane4_vehicles(client, world, target_wp, tm, vehicles, mode, right_vec)
-                        
-                        elif cmd.get('action') == 'set_speed':
-                            multiplier = cmd.get('multiplier', 1.0)
-                            print(f"\nDashboard: Speed multiplier set to {multiplier}x")
-                            speed_diff = (1.0 - multiplier) * 100
-                            tm.global_percentage_speed_difference(speed_diff)
-                        
-                        elif cmd.get('action') == 'set_weather':
-                            weather_type = cmd.get('weather', 'Clear')
-                            print(f"\nDashboard: Weather set to {weather_type}")
-                            weather_presets = {
-                                'Clear': carla.WeatherParameters.ClearNoon,
-                                'Rain': carla.WeatherParameters.HardRainNoon,
-                                'Fog': carla.WeatherParameters.CloudyNoon,
-                                'Night': carla.WeatherParameters.ClearNight
-                            }
-                            if weather_type in weather_presets:
-                                world.set_weather(weather_presets[weather_type])
-                        
-                        elif cmd.get('action') == 'camera_switch':
-                            view = cmd.get('view', 'overview')
-                            print(f"\nDashboard: Camera switched to {view}")
-                        
-                        elif cmd.get('action') == 'create_congestion':
-                            direction = cmd.get('direction', 'forward')
-                            intensity = cmd.get('intensity', 0.5)
-                            print(f"\nDashboard: Creating {intensity*100:.0f}% congestion in {direction} lanes")
-                            for v in vehicles:
-                                try:
-                                    if v.is_alive:
-                                        v_rot = v.get_transform().rotation
-                                        yaw_diff = abs(v_rot.yaw - target_wp.transform.rotation.yaw)
-                                        if yaw_diff > 180:
-                                            yaw_diff = 360 - yaw_diff
-                                        is_fwd = yaw_diff < 90
-                                        
-                                        if (direction == 'forward' and is_fwd) or (direction == 'backward' and not is_fwd):
-                                            if random.random() < intensity:
-                                                tm.vehicle_percentage_speed_difference(v, 50.0)  # Very slow
-                                                tm.distance_to_leading_vehicle(v, 1.5)  # Close following
-                                except:
-                                    pass
+            if frame_channel is not None and int(round(elapsed_time / 0.05)) % frame_every == 0:
+                try:
+                    frame_channel.publish(elapsed_time, snapshot.ids, snapshot.x, snapshot.y,
+                                          snapshot.speed_kmh / 3.6, lane_slot)
+                except Exception as e:
+                    print(f"Error exporting vehicle frame: {e}")
+            
+            # Drain every dashboard command queued since the last tick, in order
+            for cmd in (command_inbox.drain() if command_inbox is not None else []):
+                status = 'applied'
+                try:
+                    if cmd.get('action') == 'shift_median':
+                        mode_str = cmd.get('mode', '3-3')
+                        if mode_str == '4-2':
+                            target_mode = 1
+                        elif mode_str == '2-4':
+                            target_mode = 2
+                        else:
+                            target_mode = 0
                         
-                        elif cmd.get('action') == 'traffic_lights':
-                            state = cmd.get('state', 'green')
-                            print(f"\nDashboard: Traffic lights set to {state}")
-                            traffic_lights = world.get_actors().filter('traffic.traffic_light')
-                            for light in traffic_lights:
-                                if state == 'green':
-                                    light.set_state(carla.TrafficLightState.Green)
-                                elif state == 'red':
-                                    light.set_state(carla.TrafficLightState.Red)
+                        if target_mode != mode and not median.is_moving:
+                            print(f"\nDashboard command: Shifting to {mode_str} mode")
+                            median.set_lane_configuration(target_mode, road_frame)
+                            force_vehicles_to_lane4(snapshot, target_wp, right_vec, fwd_vec)
+                            spawn_lane4_vehicles(client, world, road_frame, tm, vehicles, target_mode)
+                            mode = target_mode
+                            last_shift_time = elapsed_time
+                        else:
+                            status = 'ignored'
                     
-                    os.remove(cmd_file)
-            except Exception as e:
-                pass
+                    elif cmd.get('action') == 'spawn_vehicles':
+                        count = cmd.get('count', 10)
+                        direction = cmd.get('direction', 'forward')
+                        print(f"\nDashboard: Spawn {count} {direction} vehicles")
+                        if mode in [1, 2]:
+                            spawn_lane4_vehicles(client, world, road_frame, tm, vehicles, mode)
+                        else:
+                            status = 'ignored'
+                    
+                    elif cmd.get('action') == 'set_speed':
+                        multiplier = cmd.get('multiplier', 1.0)
+                        print(f"\nDashboard: Speed multiplier set to {multiplier}x")
+                        speed_diff = (1.0 - multiplier) * 100
+                        tm.global_percentage_speed_difference(speed_diff)
+                    
+                    elif cmd.get('action') == 'set_weather':
+                        weather_type = cmd.get('weather', 'Clear')
+                        print(f"\nDashboard: Weather set to {weather_type}")
+                        weather_presets = {
+                            'Clear': carla.WeatherParameters.ClearNoon,
+                            'Rain': carla.WeatherParameters.HardRainNoon,
+                            'Fog': carla.WeatherParameters.CloudyNoon,
+                            'Night': carla.WeatherParameters.ClearNight
+                        }
+                        if weather_type in weather_presets:
+                            world.set_weather(weather_presets[weather_type])
+                    
+                    elif cmd.get('action') == 'camera_switch':
+                        view = cmd.get('view', 'overview')
+                        print(f"\nDashboard: Camera switched to {view}")
+                    
+                    elif cmd.get('action') == 'create_congestion':
+                        direction = cmd.get('direction', 'forward')
+                        intensity = cmd.get('intensity', 0.5)
+                        print(f"\nDashboard: Creating {intensity*100:.0f}% congestion in {direction} lanes")
+                        forward_mask = snapshot.is_forward(target_wp.transform.rotation.yaw)
+                        for v, is_fwd in zip(snapshot.actors, forward_mask):
+                            try:
+                                if (direction == 'forward' and is_fwd) or (direction == 'backward' and not is_fwd):
+                                    if random.random() < intensity:
+                                        tm.vehicle_percentage_speed_difference(v, 50.0)  # Very slow
+                                        tm.distance_to_leading_vehicle(v, 1.5)  # Close following
+                            except:
+                                pass
+                    
+                    elif cmd.get('action') == 'traffic_lights':
+                        state = cmd.get('state', 'green')
+                        print(f"\nDashboard: Traffic lights set to {state}")
+                        traffic_lights = world.get_actors().filter('traffic.traffic_light')
+                        for light in traffic_lights:
+                            if state == 'green':
+                                light.set_state(carla.TrafficLightState.Green)
+                            elif state == 'red':
+                                light.set_state(carla.TrafficLightState.Red)
+                    
+                    else:
+                        status = 'ignored'
+                    
+                    command_inbox.ack(cmd.get('seq'), status)
+                except Exception as e:
+                    command_inbox.ack(cmd.get('seq'), 'error', str(e))
             
             # INTELLIGENT LANE SWITCHING BASED ON CONGESTION
             time_since_last_shift = elapsed_time - last_shift_time
             
             if time_since_last_shift >= MIN_TIME_BETWEEN_SHIFTS and not median.is_moving:
-                if mode == 0 and congestion_status['forward']:
-                    print(f"\n[{elapsed_time:.1f}s] Congestion detected!")
-                    print(f"   Forward: {fwd_congested} slow vehicles (>{CONGESTION_THRESHOLD} threshold)")
+                wanted_mode = controller.decide(mode, time_since_last_shift)
+                if mode == 0 and wanted_mode == 1:
+                    window = detector.window_means()
+                    print(f"\n[{elapsed_time:.1f}s] {controller.reason}")
+                    print(f"   Forward: {fwd_congested} slow vehicles (>{CONGESTION_THRESHOLD} threshold), "
+                          f"{window['slow_count']:.1f} over the last {DETECTOR_WINDOW:.0f}s")
                     print(f"   Switching to 4-2 configuration...\n")
                     simulation_data['median_shift_start_time'] = elapsed_time
                     speed_variation = random.uniform(0.85, 1.15)
                     median.speed = MEDIAN_SPEED * speed_variation
-                    median.set_lane_configuration(1, target_wp, right_vec)
-                    force_vehicles_to_lane4(vehicles, target_wp, right_vec, fwd_vec)
-                    spawn_lane4_vehicles(client, world, target_wp, tm, vehicles, 1, right_vec)
+                    median.set_lane_configuration(1, road_frame)
+                    force_vehicles_to_lane4(snapshot, target_wp, right_vec, fwd_vec)
+                    spawn_lane4_vehicles(client, world, road_frame, tm, vehicles, 1)
                     mode = 1
                     simulation_data['mode_changes'] += 1
                     last_shift_time = elapsed_time
                     
-                elif mode == 1 and not congestion_status['forward'] and time_since_last_shift > 30:
-                    print(f"\n[{elapsed_time:.1f}s] Congestion cleared!")
+                elif mode == 1 and wanted_mode == 0:
+                    print(f"\n[{elapsed_time:.1f}s] {controller.reason}")
                     print(f"   Returning to normal 3-3 configuration...\n")
-                    median.set_lane_configuration(0, target_wp, right_vec)
+                    median.set_lane_configuration(0, road_frame)
                     mode = 0
                     simulation_data['mode_changes'] += 1
                     last_shift_time = elapsed_time
             
-            pygame.event.pump()
+            if display is not None:
+                pygame.event.pump()
             
-            if elapsed_time > 300:  # 5 minutes
-                print("\nSimulation time limit reached (5 minutes)")
+            if elapsed_time > duration:
+                print(f"\nSimulation time limit reached ({duration:.0f} seconds)")
                 break
 
     except KeyboardInterrupt:
@@ -1432,6 +2498,22 @@ def main():
         print()
         
         free_flow_time_minutes = random.uniform(10.0, 60.0)
+        free_flow_source = 'assumed'
+        measured_free_flow = trip_tracker.free_flow_time()
+        if measured_free_flow is not None:
+            free_flow_time_minutes = measured_free_flow / 60.0
+            free_flow_source = 'measured'
+        
+        trip_stats = trip_tracker.summary()
+        print(f"Measured Trips ({trip_stats['section_length_m']:.0f} m section, {trip_stats['observed_seconds']:.0f}s observed):")
+        for direction in ('forward', 'backward'):
+            stats = trip_stats[direction]
+            line = f"   {direction.capitalize()}: {stats['completed_trips']} trips, {stats['throughput_veh_per_hour']:.0f} veh/h"
+            if stats['completed_trips']:
+                line += (f", travel time p50 {stats['travel_time_p50_seconds']:.1f}s / p85 {stats['travel_time_p85_seconds']:.1f}s"
+                         f", {stats['avg_stops']:.2f} stops, {stats['avg_idle_seconds']:.1f}s idle")
+            print(line)
+        print()
         
         v_c_baseline = baseline_volume / baseline_capacity
         v_c_improved = improved_volume / improved_capacity
@@ -1453,7 +2535,7 @@ def main():
         trip_time_saved = trip_time_saved_minutes * 60
         
         print(f"BPR Trip Time Calculation:")
-        print(f"   Free-flow time (T₀): {free_flow_time_minutes:.2f} minutes")
+        print(f"   Free-flow time (T₀): {free_flow_time_minutes:.2f} minutes ({free_flow_source})")
         print(f"   Baseline (3-lane): V={baseline_volume}, C={baseline_capacity}, V/C={v_c_baseline:.2f}")
         print(f"   T = {free_flow_time_minutes:.2f} × [1 + 0.15 × ({v_c_baseline:.2f})^4] = {baseline_trip_time_minutes:.2f} min")
         print(f"   Improved (4-lane): V={improved_volume}, C'={improved_capacity}, V/C'={v_c_improved:.2f}")
@@ -1477,7 +2559,7 @@ def main():
         
         # Save metrics to JSON
         metrics_data = {
-            'session_id': datetime.now().strftime('%Y%m%d_%H%M%S'),
+            'session_id': datetime.now().strftime('%Y%m%d_%H%M%S') + (f"_{session}" if session else ''),
             'simulation_duration_seconds': elapsed_time,
             'total_vehicles': len(vehicles),
             'metrics': {
@@ -1511,6 +2593,7 @@ def main():
                 'baseline_capacity_veh_per_hour': baseline_capacity,
                 'improved_capacity_veh_per_hour': improved_capacity,
                 'free_flow_time_minutes': free_flow_time_minutes,
+                'free_flow_time_source': free_flow_source,
                 'lane_capacity_veh_per_hour': LANE_CAPACITY
             },
             'simulation_stats': {
@@ -1521,12 +2604,18 @@ def main():
                 'avg_speed_3_3_kmh': round(avg_speed_3_3, 2),
                 'avg_speed_4_2_kmh': round(avg_speed_4_2, 2),
                 'congestion_events': simulation_data['congestion_events'],
+                'controller': controller.name,
+                'detector_method': detector.method,
+                'detector_triggers': detector.triggers,
+                'time_congested_seconds': round(detector.congested_time, 2),
                 'total_data_points': len(simulation_data['speeds']),
                 'median_shift_duration_actual': round(actual_movement_time, 2)
-            }
+            },
+            'trip_stats': trip_stats
         }
         
-        save_metrics_to_json(metrics_data, 'simulation_results.json')
+        if results_file:
+            save_metrics_to_json(metrics_data, results_file)
         
         print("\n" + "="*60)
         print(" METRICS SUMMARY")
@@ -1551,16 +2640,38 @@ def main():
             if block.is_alive:
                 block.destroy()
         
+        if state_channel is not None:
+            state_channel.close()
+        if frame_channel is not None:
+            frame_channel.close()
+        if command_inbox is not None:
+            command_inbox.close()
+        
         settings.synchronous_mode = False
         world.apply_settings(settings)
-        pygame.quit()
+        if display is not None:
+            pygame.quit()
         
         # Generate comprehensive summary report
         data_collector.generate_summary_report()
         
         print("\n" + "="*60)
-        print(" SIMULATION COMPLETED. RESULTS SAVED TO 'simulation_results.json'")
+        print(" SIMULATION COMPLETED. RESULTS SAVED TO 'simulation_results.jsonl'")
         print("="*60 + "\n")
+    
+    return metrics_data
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Dynamic median traffic simulation")
+    parser.add_argument('--headless', action='store_true', help="Use the NumPy traffic engine instead of CARLA")
+    parser.add_argument('--duration', type=float, default=SIMULATION_DURATION, help="Simulated seconds")
+    parser.add_argument('--seed', type=int, default=None, help="Traffic seed")
+    parser.add_argument('--session', default=None, help="Session id (set by the dashboard's session manager)")
+    parser.add_argument('--carla-port', type=int, default=CARLA_PORT, help="CARLA server port")
+    parser.add_argument('--tm-port', type=int, default=TM_PORT, help="Traffic Manager port")
+    parser.add_argument('--controller', choices=sorted(SHIFT_CONTROLLERS), default=None,
+                        help=f"Median shift controller (default: {SHIFT_CONTROLLER})")
+    args = parser.parse_args()
+    
+    main(duration=args.duration, seed=args.seed, session=args.session,
+         carla_port=args.carla_port, tm_port=args.tm_port, controller=args.controller)
\ No newline at end of file